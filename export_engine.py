@@ -0,0 +1,4372 @@
+# -*- coding: utf-8 -*-
+"""
+Exportní jádro Crypto Exam Generatoru (bez závislosti na Qt).
+
+Obsahuje:
+- HTMLToDocxParser – převod HTML otázek na jednoduchou mezireprezentaci odstavců,
+- ImageCache – trvalou cache obrázků převedených/zmenšených pro tisk,
+- CompiledTemplate – jednou načtenou a předanalyzovanou DOCX šablonu, ze které se
+  pro každou verzi testu vyplní pouze sloty s placeholdery (přímým zápisem
+  WordprocessingML do zipu, záložně přes python-docx),
+- sample_versions – výběr otázek pro všechny verze hromadného exportu (NumPy volitelně),
+- run_export – celý běh exportu (render verzí, PDF konverze přes LibreOffice, slučování PDF)
+  s callbacky pro průběh a zrušení,
+- PLACEHOLDERS – registr poskytovatelů prostých placeholderů (počítají se jen ty, které šablona obsahuje),
+- answer_key_entries / write_answer_key – klíče správných odpovědí ke stejnému výběru verzí,
+- run_roster_export – jeden test na studenta ze seznamu CSV (průběžně do zip archivu a jednoho PDF),
+- combine_docx – složení všech verzí do jednoho DOCX (verze = sekce s vlastním záhlavím/zápatím),
+- RenderCache / write_manifest – cache vyrenderovaných verzí a manifest výběru otázek
+  pro opakování stejného balíku,
+- cli_main – headless export z příkazové řádky (python main.py export ... / python export_engine.py export ...).
+
+Modul je záměrně bez PySide6, aby ho šlo používat i mimo GUI (dávkový export,
+pracovní procesy).
+"""
+
+from __future__ import annotations
+
+import bisect
+import csv
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import posixpath
+import random
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
+from dataclasses import dataclass, field
+from datetime import datetime
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape as xml_escape
+
+import docx
+from docx.document import Document as DocxDocument
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.image.image import Image as DocxImage
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.oxml.shape import CT_Inline
+from docx.shared import Cm, Pt, RGBColor
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from lxml import etree
+
+
+# ---- HTML -> jednoduché mezireprezentace pro DOCX ----
+
+class HTMLToDocxParser(HTMLParser):
+    """
+    Převádí HTML na seznam odstavců pro DOCX.
+    Podporuje vnořené styly, seznamy a odsazení (indentation).
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.paragraphs: List[dict] = []
+        self._stack: List[dict] = []
+        self._list_stack: List[dict] = []
+        self._current_runs: List[dict] = []
+        self._current_align: str = "left"
+        self._current_indent: int = 0
+        self._in_body = False
+        self._has_body_tag = False
+        self._ignore_content = False
+
+    def _start_paragraph(self, prefix: str = "", indent: int = 0) -> None:
+        if self._current_runs:
+            self._end_paragraph()
+        self._current_runs = []
+        self._current_align = "left"
+        self._current_indent = indent
+        for item in reversed(self._stack):
+            if item['tag'] in ('p', 'div', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+                if item['styles'].get('align'):
+                    self._current_align = item['styles']['align']
+                break
+        self._current_prefix = prefix
+
+    def _end_paragraph(self) -> None:
+        if not self._current_runs and not hasattr(self, '_current_prefix'): return
+        merged = []
+        for r in self._current_runs:
+            if r['text'] == "": continue
+            if merged and all(merged[-1][k] == r[k] for k in ('b','i','u','color')):
+                merged[-1]['text'] += r['text']
+            else:
+                merged.append(r)
+        prefix = getattr(self, '_current_prefix', '')
+        if merged or prefix:
+            self.paragraphs.append({
+                'align': self._current_align,
+                'runs': merged,
+                'prefix': prefix,
+                'indent': self._current_indent
+            })
+        self._current_runs = []
+        if hasattr(self, '_current_prefix'): del self._current_prefix
+
+    def _append_text(self, text: str):
+        b = any(item['styles'].get('b') for item in self._stack)
+        i = any(item['styles'].get('i') for item in self._stack)
+        u = any(item['styles'].get('u') for item in self._stack)
+        color = None
+        for item in reversed(self._stack):
+            if item['styles'].get('color'):
+                color = item['styles']['color']
+                break
+        self._current_runs.append({'text': text, 'b': b, 'i': i, 'u': u, 'color': color})
+
+    def feed(self, data: str) -> None:
+        if "<body" in data.lower():
+            self._has_body_tag = True; self._in_body = False
+        else:
+            self._has_body_tag = False; self._in_body = True
+        super().feed(data)
+
+    def handle_starttag(self, tag, attrs):
+        tag = tag.lower()
+        attrs_d = dict(attrs)
+        if tag == 'body': self._in_body = True; return
+        if tag in ('head', 'style', 'script', 'meta', 'title', 'html', '!doctype'): self._ignore_content = True; return
+        if not self._in_body or self._ignore_content: return
+
+        styles = self._parse_style(attrs_d.get('style', ''))
+        if attrs_d.get('align'): styles['align'] = attrs_d['align'].lower()
+        if tag in ('b', 'strong'): styles['b'] = True
+        if tag in ('i', 'em'): styles['i'] = True
+        if tag == 'u': styles['u'] = True
+
+        # Explicitní margin - ZVÝŠENÁ CITLIVOST (20px = 1 level)
+        margin_left = styles.get('margin-left', '0px')
+        explicit_indent_val = 0
+        if 'px' in margin_left:
+            try:
+                px = float(margin_left.replace('px', '').strip())
+                explicit_indent_val = int(px / 20) # Changed from 30 to 20
+            except: pass
+
+        parent_style = self._stack[-1]['styles'] if self._stack else {}
+        merged_styles = parent_style.copy()
+        merged_styles.update(styles)
+        self._stack.append({'tag': tag, 'attrs': attrs_d, 'styles': merged_styles})
+
+        list_nesting = len(self._list_stack)
+        base_indent = max(0, list_nesting - 1) if tag == 'li' else max(0, list_nesting)
+        final_indent = base_indent + explicit_indent_val
+
+        if tag in ('p', 'div'):
+            self._start_paragraph(indent=final_indent)
+        elif tag == 'br':
+            self._append_text("\n")
+        elif tag in ('ul', 'ol'):
+            t = attrs_d.get('type', '1')
+            self._list_stack.append({'tag': tag, 'type': t, 'count': 0})
+        elif tag == 'li':
+            prefix = self._get_list_prefix()
+            self._start_paragraph(prefix=prefix, indent=final_indent)
+
+    def handle_endtag(self, tag):
+        tag = tag.lower()
+        if tag == 'body': self._in_body = False; return
+        if tag in ('head', 'style', 'script', 'meta', 'title', 'html'): self._ignore_content = False; return
+        if not self._in_body or self._ignore_content: return
+        if tag in ('p', 'div', 'li'): self._end_paragraph()
+        if tag in ('ul', 'ol'):
+            if self._list_stack: self._list_stack.pop()
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i]['tag'] == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        if not self._in_body or self._ignore_content: return
+        if not data: return
+        in_block = False
+        current_indent = 0
+        list_nesting = len(self._list_stack)
+        current_indent = max(0, list_nesting)
+        for item in reversed(self._stack):
+            if item['tag'] in ('p', 'div', 'li'):
+                in_block = True
+                break
+        if not in_block:
+            if not data.strip(): return
+            self._start_paragraph(indent=current_indent)
+        self._append_text(data)
+
+    def _parse_style(self, style_str: str) -> dict:
+        res = {}
+        if not style_str: return res
+        for part in style_str.split(';'):
+            if ':' in part:
+                k,v = part.split(':', 1)
+                k=k.strip().lower(); v=v.strip().lower()
+                if k=='color':
+                    m = re.search(r'#?([0-9a-f]{6})', v)
+                    if m: res['color']=m.group(1)
+                    else:
+                         m2 = re.search(r'rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)', v)
+                         if m2: r,g,b=[int(x) for x in m2.groups()]; res['color']=f"{r:02X}{g:02X}{b:02X}"
+                elif k=='text-align': res['align']=v
+                elif k=='margin-left': res['margin-left']=v
+                elif k=='font-weight':
+                    if 'bold' in v or (re.search(r'\d+',v) and int(re.search(r'\d+',v).group(0))>=600): res['b']=True
+                elif k=='font-style' and 'italic' in v: res['i']=True
+                elif k=='text-decoration' and 'underline' in v: res['u']=True
+        return res
+
+    def _get_list_prefix(self) -> str:
+        if not self._list_stack: return ""
+        L = self._list_stack[-1]
+        if L['tag'] == 'ul': return "•\t"
+        elif L['tag'] == 'ol':
+            L['count'] += 1; n = L['count']; t = L.get('type', '1')
+            val = f"{n}."
+            if t == 'a': val = f"{self._to_alpha(n, False)}."
+            elif t == 'A': val = f"{self._to_alpha(n, True)}."
+            elif t == 'i': val = f"{self._to_roman(n, False)}."
+            elif t == 'I': val = f"{self._to_roman(n, True)}."
+            return f"{val}\t"
+        return ""
+    def _to_alpha(self, n, upper):
+        s=""; n-=1
+        while n>=0: s=chr(97+n%26)+s; n=n//26-1
+        return s.upper() if upper else s
+    def _to_roman(self, n, upper):
+        val=[(50,'L'),(40,'XL'),(10,'X'),(9,'IX'),(5,'V'),(4,'IV'),(1,'I')]; res=""
+        for v,r in val:
+            while n>=v: res+=r; n-=v
+        return res if upper else res.lower()
+
+
+# LRU cache rozparsovaného HTML (klíč = SHA-1 z text_html). Sdílí se mezi verzemi
+# i mezi spuštěními průvodce; po úpravě otázky se změní hash, takže se HTML parsuje
+# nejvýše jednou na každou editaci.
+HTML_PARSE_CACHE_SIZE = 2048
+_html_parse_cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+_html_parse_lock = threading.Lock()
+
+
+def html_hash(html: str) -> str:
+    return hashlib.sha1(html.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def _parse_html_paragraphs_uncached(html: str) -> List[dict]:
+    parser = HTMLToDocxParser()
+    parser.feed(html)
+    return parser.paragraphs
+
+
+def parse_html_paragraphs(html: str) -> List[dict]:
+    """
+    Surový převod HTML na odstavce pro export do šablony.
+    Na rozdíl od main.parse_html_to_paragraphs nedělá flush ani ořez prázdných
+    odstavců – přesně takto se HTML v exportu zpracovávalo vždy.
+    Výsledek je sdílený z cache, volající ho nesmí měnit.
+    """
+    key = html_hash(html)
+    with _html_parse_lock:
+        cached = _html_parse_cache.get(key)
+        if cached is not None:
+            _html_parse_cache.move_to_end(key)
+            return cached
+    paragraphs = _parse_html_paragraphs_uncached(html)
+    with _html_parse_lock:
+        _html_parse_cache[key] = paragraphs
+        _html_parse_cache.move_to_end(key)
+        while len(_html_parse_cache) > HTML_PARSE_CACHE_SIZE:
+            _html_parse_cache.popitem(last=False)
+    return paragraphs
+
+
+# ---- Předparsovaný rich-text AST uložený u otázky ----
+#
+# Kompaktní normalizovaná podoba výstupu HTMLToDocxParser:
+#   {"v": RICH_AST_VERSION, "h": SHA-1 z text_html,
+#    "p": [[align, prefix, indent, [[text, "biu", color?], ...]], ...]}
+# Verze se zvyšuje při každé změně parseru; AST se starou verzí nebo jiným hashem
+# se považuje za neplatný a otázka se rozparsuje z HTML.
+
+RICH_AST_VERSION = 1
+
+
+def build_rich_ast(html: str) -> dict:
+    html = html or ""
+    paras = []
+    for p in parse_html_paragraphs(html):
+        runs = []
+        for r in p["runs"]:
+            run = [r["text"], "".join(f for f in "biu" if r.get(f))]
+            if r.get("color"):
+                run.append(str(r["color"]).upper())
+            runs.append(run)
+        paras.append([p.get("align", "left"), p.get("prefix", ""), int(p.get("indent", 0) or 0), runs])
+    return {"v": RICH_AST_VERSION, "h": html_hash(html), "p": paras}
+
+
+def rich_ast_is_current(ast, html: str) -> bool:
+    return (isinstance(ast, dict) and ast.get("v") == RICH_AST_VERSION
+            and ast.get("h") == html_hash(html or ""))
+
+
+def rich_ast_paragraphs(ast: dict) -> List[dict]:
+    """Rozbalí AST do formátu odstavců, se kterým pracuje export (jako HTMLToDocxParser.paragraphs)."""
+    out = []
+    for align, prefix, indent, runs in ast.get("p", []):
+        out.append({
+            'align': align,
+            'runs': [{'text': r[0], 'b': 'b' in r[1], 'i': 'i' in r[1], 'u': 'u' in r[1],
+                      'color': r[2] if len(r) > 2 else None} for r in runs],
+            'prefix': prefix,
+            'indent': indent,
+        })
+    return out
+
+
+def rich_ast_plain_text(ast: dict) -> str:
+    """Čistý text z AST (odstavce oddělené novým řádkem) – pro vyhledávání."""
+    return "\n".join(prefix + "".join(r[0] for r in runs) for _align, prefix, _indent, runs in ast.get("p", []))
+
+
+def question_paragraphs(html: str, ast: Optional[dict] = None) -> List[dict]:
+    """
+    Odstavce otázky pro export: z předaného AST, pokud má aktuální verzi (platnost vůči
+    HTML ověřuje volající při sestavení náhrad), jinak parse HTML přes LRU cache.
+    """
+    if isinstance(ast, dict) and ast.get("v") == RICH_AST_VERSION and "p" in ast:
+        return rich_ast_paragraphs(ast)
+    return parse_html_paragraphs(html)
+
+
+# ---- Kompilovaná šablona ----
+
+_QUESTION_PH_RE = re.compile(r"^Otazka\d+$")
+# Kandidát na placeholder <Klíč> nebo {Klíč}; zda jde o známý klíč, se rozhoduje až při renderu.
+_PLACEHOLDER_TOKEN_RE = re.compile(r"<([^<>{}]+)>|\{([^<>{}]+)\}")
+
+
+def _scan_placeholder_tokens(p_elem) -> Tuple[str, List[tuple]]:
+    """
+    Jeden průchod přes běhy odstavce: vrátí (text odstavce, [(start, end, klíč, w:r), ...]).
+    Text se skládá po runech (i uvnitř hyperlinků) stejně jako Paragraph.text, takže se najde
+    i placeholder, který Word rozdělil do více runů; w:r je run, ve kterém token začíná.
+    """
+    runs = p_elem.xpath("w:r | w:hyperlink/w:r")
+    pieces = [r.text for r in runs]
+    text = "".join(pieces)
+    if "<" not in text and "{" not in text:
+        return text, []
+    starts: List[int] = []
+    pos = 0
+    for piece in pieces:
+        starts.append(pos)
+        pos += len(piece)
+    tokens = []
+    for m in _PLACEHOLDER_TOKEN_RE.finditer(text):
+        run_idx = bisect.bisect_right(starts, m.start()) - 1
+        tokens.append((m.start(), m.end(), m.group(1) or m.group(2), runs[run_idx] if run_idx >= 0 else None))
+    return text, tokens
+
+
+def _extract_page_breaks(p_elem) -> list:
+    """Vrátí w:br type=page ze všech runů odstavce (kopie se dělají až při obnově)."""
+    breaks = []
+    for run_elem in p_elem.iter(qn("w:r")):
+        for br_elem in run_elem.findall(qn("w:br")):
+            if br_elem.get(qn("w:type")) == "page":
+                breaks.append(br_elem)
+    return breaks
+
+
+def _restore_page_breaks(paragraph: Paragraph, breaks: list) -> None:
+    if not breaks:
+        return
+    new_run = OxmlElement("w:r")
+    for br in breaks:
+        new_run.append(br.__copy__())
+    paragraph._p.append(new_run)
+
+
+def _size_from_rPr(rPr) -> Optional[Pt]:
+    """Velikost z rPr/w:sz (half-points) nebo None."""
+    try:
+        if rPr is None:
+            return None
+        sz = rPr.find(qn("w:sz"))
+        if sz is not None and getattr(sz, "val", None):
+            return Pt(int(sz.val) / 2.0)
+    except Exception:
+        pass
+    return None
+
+
+def _apply_run_style(run, template_rPr, base_font_size) -> None:
+    """Nejprve klon rPr placeholderu (rodina + další), pak VŽDY nastav velikost písma."""
+    if template_rPr is not None:
+        try:
+            run._element.rPr = deepcopy(template_rPr)
+        except Exception:
+            pass
+    if base_font_size:
+        run.font.size = base_font_size
+    # run.font.name NENASTAVUJEME – řídí se rPr/styl šablony
+
+
+def _apply_run_format(run, r_data: dict) -> None:
+    if r_data.get("b"): run.bold = True
+    if r_data.get("i"): run.italic = True
+    if r_data.get("u"): run.underline = True
+    if r_data.get("color"):
+        try:
+            rgb = r_data["color"]
+            run.font.color.rgb = RGBColor(int(rgb[:2], 16), int(rgb[2:4], 16), int(rgb[4:], 16))
+        except Exception:
+            pass
+
+
+def _picture_size(image_w_cm: float, image_h_cm: float) -> tuple:
+    """(width, height) pro add_picture. Pokud je obojí 0, zachováme původní default (14 cm);
+    pokud je výška 0, necháme Word dopočítat poměr."""
+    w_use = float(image_w_cm or 0.0)
+    h_use = float(image_h_cm or 0.0)
+    if w_use <= 0.0 and h_use <= 0.0:
+        w_use = 14.0
+    return (Cm(w_use) if w_use > 0.0 else None, Cm(h_use) if h_use > 0.0 else None)
+
+
+def _prepare_image(img_path_obj: Path) -> tuple:
+    """Vrátí (cesta k vložení, dočasný soubor nebo None). HEIC/HEIF se převádí na JPG (macOS sips)."""
+    if img_path_obj.suffix.lower() not in ('.heic', '.heif'):
+        return img_path_obj, None
+    temp_jpg = None
+    try:
+        fd, temp_jpg = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+        # Použijeme systémový nástroj sips (je na každém macu)
+        cmd = ["sips", "-s", "format", "jpeg", str(img_path_obj), "--out", temp_jpg]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return Path(temp_jpg), temp_jpg
+    except Exception as e:
+        print(f"[ERROR]   Chyba konverze HEIC: {e}", file=sys.stderr)
+        # Fallback - zkusíme vložit originál, i když to asi selže
+        return img_path_obj, temp_jpg
+
+
+def _cleanup_temp(temp_path: Optional[str]) -> None:
+    if temp_path and os.path.exists(temp_path):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def _output_file_mode(path) -> int:
+    """Práva pro výstupní soubor: jako dosavadní cíl, jinak běžná 0666 po umask."""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        mask = os.umask(0)
+        os.umask(mask)
+        return 0o666 & ~mask
+
+# ---- Cache předzpracovaných obrázků ----
+
+DEFAULT_PRINT_DPI = 300
+_HEIC_SUFFIXES = ('.heic', '.heif')
+# Formáty s průhledností/ostrými hranami (schémata, screenshoty) zůstávají PNG, fotky jdou do JPEG.
+_PNG_SUFFIXES = ('.png', '.gif', '.bmp', '.tif', '.tiff')
+
+
+class ImageCache:
+    """
+    Trvalá obsahově adresovaná cache obrázků pro export (typicky data/.cache/images).
+
+    Klíčem je SHA-256 obsahu zdrojového souboru + cílový rozměr v cm + tisková DPI.
+    V cache je obrázek převedený do formátu, který Word umí (HEIC/HEIF → JPEG), a zmenšený
+    na rozlišení odpovídající tisku v dané velikosti. Menší obrázky se nepřevzorkovávají –
+    pro ně si cache jen poznamená, že se má vložit originál.
+    Převod: Pillow (HEIC přes volitelný pillow-heif), jinak macOS `sips`, jinak originál.
+    print_dpi = 0 vypíná zmenšování (cache pak převádí jen HEIC).
+    """
+
+    def __init__(self, cache_dir, print_dpi: int = DEFAULT_PRINT_DPI) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.print_dpi = max(0, int(print_dpi or 0))
+        self._digests: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, path: Path) -> str:
+        st = path.stat()
+        key = (str(path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._digests.get(key)
+        if cached is not None:
+            return cached
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            self._digests[key] = digest
+        return digest
+
+    def _target_px(self, image_w_cm: float, image_h_cm: float) -> Tuple[Optional[int], Optional[int]]:
+        """Cílový počet pixelů pro tisk (stejná pravidla rozměru jako _picture_size)."""
+        if self.print_dpi <= 0:
+            return None, None
+        w_use = float(image_w_cm or 0.0)
+        h_use = float(image_h_cm or 0.0)
+        if w_use <= 0.0 and h_use <= 0.0:
+            w_use = 14.0
+        to_px = lambda cm: max(1, int(round(cm / 2.54 * self.print_dpi))) if cm > 0.0 else None
+        return to_px(w_use), to_px(h_use)
+
+    @staticmethod
+    def _scaled_size(size: Tuple[int, int], target: Tuple[Optional[int], Optional[int]]) -> Optional[Tuple[int, int]]:
+        """Nová velikost (w, h) se zachováním poměru, nebo None, pokud zmenšení není potřeba."""
+        w, h = size
+        scale = 1.0
+        if target[0]:
+            scale = min(scale, target[0] / w)
+        if target[1]:
+            scale = min(scale, target[1] / h)
+        if scale >= 1.0:
+            return None
+        return max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+
+    def prepare(self, src, image_w_cm: float = 0.0, image_h_cm: float = 0.0) -> Path:
+        """Vrátí cestu k obrázku, který se má vložit do DOCX (z cache, nebo originál)."""
+        src = Path(src)
+        is_heic = src.suffix.lower() in _HEIC_SUFFIXES
+        if self.print_dpi <= 0 and not is_heic:
+            return src
+        try:
+            digest = self._digest(src)
+        except OSError:
+            return src
+
+        target = self._target_px(image_w_cm, image_h_cm)
+        ext = ".png" if src.suffix.lower() in _PNG_SUFFIXES else ".jpg"
+        name = f"{digest}_{float(image_w_cm or 0):.2f}x{float(image_h_cm or 0):.2f}_{self.print_dpi}"
+        folder = self.cache_dir / digest[:2]
+        out_path = folder / (name + ext)
+        keep_marker = folder / (name + ".orig")
+        if out_path.exists():
+            return out_path
+        if keep_marker.exists():
+            return src
+
+        try:
+            folder.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"[WARN] Cache obrázků není dostupná ({e}), vkládám originál.", file=sys.stderr)
+            return src
+
+        result = self._convert_pillow(src, out_path, target, is_heic)
+        if result is None:
+            result = self._convert_sips(src, out_path, target, is_heic)
+        if result == "orig":
+            try:
+                keep_marker.touch()
+            except OSError:
+                pass
+            return src
+        if result == "done":
+            return out_path
+        return src
+
+    @staticmethod
+    def _tmp_path(out_path: Path) -> str:
+        fd, tmp = tempfile.mkstemp(suffix=out_path.suffix, dir=str(out_path.parent))
+        os.close(fd)
+        return tmp
+
+    def _convert_pillow(self, src: Path, out_path: Path, target, is_heic: bool) -> Optional[str]:
+        """'done' = uloženo do cache, 'orig' = vložit originál, None = Pillow nepoužitelný."""
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return None
+        if is_heic:
+            try:
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+            except ImportError:
+                return None
+        tmp = None
+        try:
+            with Image.open(src) as im:
+                new_size = self._scaled_size(im.size, target)
+                if new_size is None and not is_heic:
+                    return "orig"
+                im = ImageOps.exif_transpose(im)
+                if new_size is not None:
+                    im = im.resize(new_size, Image.LANCZOS)
+                tmp = self._tmp_path(out_path)
+                dpi = (self.print_dpi, self.print_dpi) if self.print_dpi else (96, 96)
+                if out_path.suffix == ".png":
+                    im.save(tmp, "PNG", optimize=True, dpi=dpi)
+                else:
+                    if im.mode not in ("RGB", "L"):
+                        im = im.convert("RGB")
+                    im.save(tmp, "JPEG", quality=88, optimize=True, dpi=dpi)
+            os.replace(tmp, out_path)
+            return "done"
+        except Exception as e:
+            print(f"[WARN] Pillow nezvládl obrázek {src.name}: {e}", file=sys.stderr)
+            _cleanup_temp(tmp)
+            return None
+
+    def _convert_sips(self, src: Path, out_path: Path, target, is_heic: bool) -> Optional[str]:
+        """Záloha přes macOS `sips` (převod formátu + zmenšení)."""
+        tmp = None
+        try:
+            info = subprocess.run(["sips", "-g", "pixelWidth", "-g", "pixelHeight", str(src)],
+                                  check=True, capture_output=True, text=True).stdout
+            w = int(re.search(r"pixelWidth:\s*(\d+)", info).group(1))
+            h = int(re.search(r"pixelHeight:\s*(\d+)", info).group(1))
+            new_size = self._scaled_size((w, h), target)
+            if new_size is None and not is_heic:
+                return "orig"
+            tmp = self._tmp_path(out_path)
+            fmt = "png" if out_path.suffix == ".png" else "jpeg"
+            cmd = ["sips", "-s", "format", fmt]
+            if new_size is not None:
+                cmd += ["-z", str(new_size[1]), str(new_size[0])]
+            cmd += [str(src), "--out", tmp]
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.replace(tmp, out_path)
+            return "done"
+        except Exception:
+            _cleanup_temp(tmp)
+            return None
+
+
+
+class _StoryParent:
+    """Minimální rodič pro Paragraph – python-docx z něj potřebuje jen .part (styly, obrázky)."""
+    def __init__(self, part) -> None:
+        self.part = part
+
+
+class _Slot:
+    """
+    Jeden odstavec šablony s kandidáty na placeholder (tokeny <Klíč> / {Klíč} i přes hranice runů).
+    Styl placeholderu se analyzuje nad nedotčenou kostrou šablony jen jednou.
+    """
+    __slots__ = ("part", "index", "text", "tokens", "block_key", "base_p", "page_breaks",
+                 "_block_style", "_inline_styles")
+
+    def __init__(self, part, index: int, base_p, text: str, tokens: List[tuple]) -> None:
+        self.part = part
+        self.index = index
+        self.base_p = base_p
+        self.text = text
+        self.tokens = tokens
+        # Odstavec tvořený jediným tokenem je kandidát na blokový (rich) placeholder
+        self.block_key = None
+        if len(self.tokens) == 1:
+            start, end, key, _run = self.tokens[0]
+            if self.text.strip() == self.text[start:end]:
+                self.block_key = key
+        self.page_breaks = _extract_page_breaks(base_p)
+        self._block_style = None
+        self._inline_styles: Dict[tuple, tuple] = {}
+
+    def block_style(self) -> tuple:
+        """(template_rPr, base_font_size) pro blokový placeholder – z prvního runu odstavce."""
+        if self._block_style is None:
+            paragraph = Paragraph(self.base_p, _StoryParent(self.part))
+            template_rPr = None
+            base_font_size = None
+            try:
+                src_run = paragraph.runs[0] if paragraph.runs else None
+                if src_run is not None:
+                    # 1) pokus přes API
+                    base_font_size = src_run.font.size
+                    # 2) doplněk: čti w:sz (half-points) přímo z rPr
+                    rPr = getattr(src_run._element, "rPr", None)
+                    if rPr is not None:
+                        template_rPr = deepcopy(rPr)
+                        if base_font_size is None:
+                            base_font_size = _size_from_rPr(rPr)
+                # 3) fallback: velikost ze stylu odstavce
+                if base_font_size is None and paragraph.style and getattr(paragraph.style.font, "size", None):
+                    base_font_size = paragraph.style.font.size
+            except Exception:
+                pass
+            self._block_style = (template_rPr, base_font_size)
+        return self._block_style
+
+    def inline_style(self, keys_found: List[str]) -> tuple:
+        """(base_bold, template_rPr, base_font_size) pro inline placeholdery – podle runu s tokenem."""
+        key = tuple(keys_found)
+        cached = self._inline_styles.get(key)
+        if cached is not None:
+            return cached
+
+        paragraph = Paragraph(self.base_p, _StoryParent(self.part))
+        base_bold = None
+        template_rPr = None
+        base_font_size = None
+
+        # a) run, ve kterém začíná první nahrazovaný token (i když ho Word rozdělil do více runů)
+        source_run = None
+        for _start, _end, k, r_elem in self.tokens:
+            if k in keys_found and r_elem is not None:
+                source_run = Run(r_elem, paragraph)
+                break
+        if source_run is None:
+            # fallback: první neprázdný run
+            for run in paragraph.runs:
+                if (run.text or "").strip():
+                    source_run = run
+                    break
+
+        if source_run is not None:
+            base_bold = source_run.bold
+            base_font_size = source_run.font.size
+            rPr = getattr(source_run._element, "rPr", None)
+            if base_font_size is None:
+                base_font_size = _size_from_rPr(rPr)
+            try:
+                if rPr is not None:
+                    template_rPr = deepcopy(rPr)
+            except Exception:
+                template_rPr = None
+
+        # b) fallback: velikost ze stylu odstavce (typické pro bullets)
+        try:
+            if (base_font_size is None) and paragraph.style and getattr(paragraph.style.font, "size", None):
+                base_font_size = paragraph.style.font.size
+        except Exception:
+            pass
+
+        # c) poslední fallback – jen pro Otazka\d+ defaultně 9 pt
+        if base_font_size is None and any(_QUESTION_PH_RE.match(k) for k in keys_found):
+            base_font_size = Pt(9)
+
+        cached = (base_bold, template_rPr, base_font_size)
+        self._inline_styles[key] = cached
+        return cached
+
+
+def _resolve_slot(slot: _Slot, simple_repl: Dict[str, str], rich_repl_html: Dict[str, object]):
+    """
+    Rozhodne, co se slotem udělat (společné pro python-docx i přímý XML zápis):
+     - ("block", (html, image_path, w_cm, h_cm, ast)) – odstavec je celý jeden rich placeholder,
+     - ("inline", (keys_found, segments)) – placeholdery uvnitř textu,
+     - (None, None) – odstavec zůstává beze změny.
+    """
+    if not slot.tokens:
+        return None, None
+
+    # 1) BLOCK CHECK
+    if slot.block_key is not None and slot.block_key in rich_repl_html:
+        val = rich_repl_html[slot.block_key]
+        if isinstance(val, tuple):
+            return "block", (
+                val[0], val[1],
+                float((val[2] if len(val) > 2 else 0.0) or 0.0),
+                float((val[3] if len(val) > 3 else 0.0) or 0.0),
+                val[4] if len(val) > 4 else None,
+            )
+        return "block", (val, None, 0.0, 0.0, None)
+
+    # 2) INLINE CHECK (bez obrázků) – jeden průchod přes tokeny nalezené při kompilaci
+    full_text = slot.text
+    keys_found: List[str] = []
+    infos: dict = {}
+    segments: list = []
+    pos = 0
+    for start, end, k, _run in slot.tokens:
+        info = infos.get(k)
+        if info is None:
+            if k in rich_repl_html:
+                val = rich_repl_html[k]
+                if isinstance(val, tuple):
+                    info = {"type": "rich", "val": val[0], "ast": val[4] if len(val) > 4 else None}
+                else:
+                    info = {"type": "rich", "val": val, "ast": None}
+            elif k in simple_repl:
+                info = {"type": "simple", "val": simple_repl[k]}
+            else:
+                continue
+            infos[k] = info
+            keys_found.append(k)
+        if start > pos:
+            segments.append(full_text[pos:start])
+        segments.append(info)
+        pos = end
+    if not keys_found:
+        return None, None
+    if pos < len(full_text):
+        segments.append(full_text[pos:])
+    return "inline", (keys_found, segments)
+
+
+class CompiledTemplate:
+    """
+    DOCX šablona načtená a zanalyzovaná jednou pro celý export.
+
+    Při kompilaci se zaznamenají všechny odstavce s možnými placeholdery (tělo,
+    tabulky, záhlaví a zápatí) včetně stylu placeholderu a zalomení stránek.
+    Každá verze se pak vyrenderuje přímým zápisem XML do zipu šablony (_XmlPatchWriter);
+    záložní cesta přes python-docx dostane hlubokou kopii XML kostry a vyplní jen tyto sloty.
+    Šablona se tak neotevírá ani neprochází znovu.
+    """
+
+    def __init__(self, template_path, image_cache: Optional[ImageCache] = None) -> None:
+        self.template_path = Path(template_path)
+        self.image_cache = image_cache
+        # Úroveň deflate výstupního zipu (None = výchozí); mezivýstupy pro PDF viz INTERMEDIATE_COMPRESSLEVEL
+        self.compresslevel: Optional[int] = None
+        self.template_hash = hashlib.sha256(self.template_path.read_bytes()).hexdigest()
+        self._doc = docx.Document(str(self.template_path))
+        self._doc_part = self._doc.part
+
+        # Story party v pořadí zpracování (dokument, pak záhlaví/zápatí všech sekcí).
+        # Přístup k záhlaví/zápatí chybějící definici vytvoří – stejně jako dřív při exportu.
+        self._parts: List = [self._doc_part]
+        slot_sources: List[Tuple[object, object]] = []
+
+        # 1. Body
+        for p in self._doc.paragraphs:
+            slot_sources.append((self._doc_part, p._p))
+        # 2. Tables in Body
+        for table in self._doc.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    for p in cell.paragraphs:
+                        slot_sources.append((self._doc_part, p._p))
+        # 3. Headers / Footers
+        for section in self._doc.sections:
+            for hf in (section.header, section.first_page_header, section.footer, section.first_page_footer):
+                hf_part = hf.part
+                if hf_part not in self._parts:
+                    self._parts.append(hf_part)
+                for p in hf.paragraphs:
+                    slot_sources.append((hf_part, p._p))
+
+        # Indexy odstavců v rámci party (pořadí w:p je v kopii stejné jako v originálu)
+        positions: Dict[int, Dict[object, int]] = {}
+        for part in self._parts:
+            positions[id(part)] = {p_elem: i for i, p_elem in enumerate(part._element.iter(qn("w:p")))}
+
+        self._slots: List[_Slot] = []
+        seen = set()
+        for part, p_elem in slot_sources:
+            idx = positions[id(part)].get(p_elem)
+            if idx is None or (id(part), idx) in seen:
+                continue
+            seen.add((id(part), idx))
+            text, tokens = _scan_placeholder_tokens(p_elem)
+            if tokens:  # odstavce bez kandidátů se dál vůbec neřeší
+                self._slots.append(_Slot(part, idx, p_elem, text, tokens))
+
+        self._placeholder_keys: Optional[set] = None
+
+        # Nedotčené kostry a výchozí relace (obrázky přidané při vyplnění se zase zahodí)
+        self._base_elements = {id(part): part._element for part in self._parts}
+        self._base_rels = {id(part): dict(part.rels) for part in self._parts}
+
+        # Rychlá cesta: přímý zápis XML do zipu šablony (python-docx zůstává jako záloha)
+        try:
+            self._writer: Optional[_XmlPatchWriter] = _XmlPatchWriter(self)
+        except Exception as e:
+            print(f"[WARN] Přímý zápis DOCX není pro tuto šablonu k dispozici: {e}", file=sys.stderr)
+            self._writer = None
+
+    @property
+    def slot_count(self) -> int:
+        return len(self._slots)
+
+    def placeholder_keys(self) -> set:
+        """Všechny klíče tokenů <Klíč> / {Klíč} nalezené v šabloně (tělo, tabulky, záhlaví, zápatí)."""
+        if self._placeholder_keys is None:
+            self._placeholder_keys = {key for slot in self._slots for _start, _end, key, _run in slot.tokens}
+        return self._placeholder_keys
+
+    # -- Klonování kostry --
+
+    def _clone(self) -> Dict[int, List]:
+        """Naklonuje XML všech story part a vrátí {id(part): [w:p, ...]} pro vyhledání slotů."""
+        paragraphs: Dict[int, List] = {}
+        for part in self._parts:
+            rels = part.rels
+            base_rels = self._base_rels[id(part)]
+            for rId in [r for r in rels.keys() if r not in base_rels]:
+                del rels[rId]
+                rels._target_parts_by_rId.pop(rId, None)
+            part._element = deepcopy(self._base_elements[id(part)])
+            if any(s.part is part for s in self._slots):
+                paragraphs[id(part)] = list(part._element.iter(qn("w:p")))
+        return paragraphs
+
+    def fill(self, simple_repl: Dict[str, str], rich_repl_html: Dict[str, object]):
+        """
+        Vyplní novou kopii šablony a vrátí docx.Document připravený k uložení.
+        rich_repl_html může být:
+         - Dict[str, str] -> {placeholder: html_content}
+         - Dict[str, tuple] -> {placeholder: (html_content, image_path[, image_width_cm, image_height_cm[, rich_ast]])}
+        Dokument je platný jen do dalšího volání fill() (sdílí balíček šablony).
+        """
+        paragraphs = self._clone()
+        # Nejprve najdeme všechny sloty v kopii, teprve pak vkládáme nové odstavce
+        work = [(slot, Paragraph(paragraphs[id(slot.part)][slot.index], _StoryParent(slot.part)))
+                for slot in self._slots]
+        for slot, paragraph in work:
+            self._process_slot(slot, paragraph, simple_repl, rich_repl_html)
+        return DocxDocument(self._doc_part._element, self._doc_part)
+
+    def render_bytes(self, simple_repl: Dict[str, str], rich_repl_html: Dict[str, object]) -> bytes:
+        """Vyplněný DOCX jako bajty – přímým zápisem XML, při chybě přes python-docx (fill)."""
+        if self._writer is not None:
+            try:
+                return self._writer.render_bytes(simple_repl, rich_repl_html, self.compresslevel)
+            except Exception as e:
+                print(f"[WARN] Přímý zápis DOCX selhal, použije se python-docx: {e}", file=sys.stderr)
+        buf = io.BytesIO()
+        self.fill(simple_repl, rich_repl_html).save(buf)
+        return buf.getvalue()
+
+    @staticmethod
+    def save_bytes(data: bytes, output_path) -> None:
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output_path.write_bytes(data)
+
+    def render(self, output_path, simple_repl: Dict[str, str], rich_repl_html: Dict[str, object]) -> None:
+        self.save_bytes(self.render_bytes(simple_repl, rich_repl_html), output_path)
+
+    # -- Vyplnění jednoho slotu (Inline i Block) --
+
+    def _process_slot(self, slot: _Slot, p: Paragraph, simple_repl: Dict[str, str],
+                      rich_repl_html: Dict[str, object]) -> None:
+        kind, data = _resolve_slot(slot, simple_repl, rich_repl_html)
+        if kind == "block":
+            self._insert_rich_block(slot, p, *data)
+            return
+        if kind is None:
+            return
+
+        keys_found, segments = data
+        base_bold, template_rPr, base_font_size = slot.inline_style(keys_found)
+
+        # Vyčistit obsah, ale zachovat vlastnosti odstavce
+        p.clear()
+
+        for seg in segments:
+            if isinstance(seg, str):
+                run = p.add_run(seg)
+                _apply_run_style(run, template_rPr, base_font_size)
+            elif seg["type"] == "simple":
+                run = p.add_run(str(seg["val"]))
+                _apply_run_style(run, template_rPr, base_font_size)
+                if base_bold is not None:
+                    run.bold = base_bold
+            else:
+                for p_idx, p_data in enumerate(question_paragraphs(seg["val"], seg["ast"])):
+                    if p_idx > 0:
+                        p.add_run().add_break()
+                    for r_data in p_data["runs"]:
+                        parts = r_data["text"].split("\n")
+                        for idx_part, part in enumerate(parts):
+                            if part:
+                                run = p.add_run(part)
+                                _apply_run_style(run, template_rPr, base_font_size)  # nejprve velikost/styl
+                                _apply_run_format(run, r_data)                     # pak jen b/i/u/color
+                            if idx_part < len(parts) - 1:
+                                p.add_run().add_break()
+
+        _restore_page_breaks(p, slot.page_breaks)
+
+    def _resolve_image(self, img_path_obj: Path, image_w_cm: float, image_h_cm: float) -> tuple:
+        """Vrátí (cesta k vložení, dočasný soubor nebo None) – přednostně z cache obrázků."""
+        if self.image_cache is not None:
+            cached = self.image_cache.prepare(img_path_obj, image_w_cm, image_h_cm)
+            if cached != img_path_obj:
+                return cached, None
+        return _prepare_image(img_path_obj)
+
+    def _new_paragraph_after(self, anchor, paragraph: Paragraph) -> Paragraph:
+        """Nový odstavec za anchor se stylem placeholderu (zabraňuje pádu na default 12 pt)."""
+        new_p = Paragraph(OxmlElement("w:p"), paragraph._parent)
+        try:
+            new_p.style = paragraph.style
+        except Exception:
+            pass
+        anchor.addnext(new_p._p)
+        return new_p
+
+    def _insert_rich_block(self, slot: _Slot, paragraph: Paragraph, html_content, image_path=None,
+                           image_w_cm: float = 0.0, image_h_cm: float = 0.0, ast: Optional[dict] = None) -> None:
+        paras_data = question_paragraphs(html_content, ast)
+        template_rPr, base_font_size = slot.block_style()
+        breaks = slot.page_breaks
+
+        def _styled_run(target: Paragraph, text: Optional[str] = None):
+            run = target.add_run(text)
+            _apply_run_style(run, template_rPr, base_font_size)
+            return run
+
+        # Pokud je obsah prázdný a není ani obrázek -> vyčistit a konec
+        if not paras_data and not image_path:
+            paragraph.clear()
+            _restore_page_breaks(paragraph, breaks)
+            return
+
+        p_insert = paragraph._p
+
+        # --- VLOŽENÍ TEXTU ---
+        for i, p_data in enumerate(paras_data):
+            if i == 0:
+                new_p = paragraph
+                new_p.clear()
+            else:
+                new_p = self._new_paragraph_after(p_insert, paragraph)
+                p_insert = new_p._p
+
+            # Zarovnání
+            align = p_data.get('align', 'left')
+            if align == 'center': new_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            elif align == 'right': new_p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            elif align == 'justify': new_p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+            else: new_p.alignment = WD_ALIGN_PARAGRAPH.LEFT
+
+            # Mezerování
+            new_p.paragraph_format.space_before = Pt(0)
+            new_p.paragraph_format.space_after = Pt(0)
+
+            # Prefix (odrážky)
+            if p_data.get('prefix'):
+                new_p.paragraph_format.left_indent = Pt(48)
+                new_p.paragraph_format.first_line_indent = Pt(-24)
+                _styled_run(new_p, p_data['prefix'])
+
+            # Obsah (Runs)
+            for r_data in p_data['runs']:
+                parts = r_data['text'].split('\n')
+                for idx, part in enumerate(parts):
+                    if part:
+                        _apply_run_format(_styled_run(new_p, part), r_data)
+                    if idx < len(parts) - 1:
+                        _styled_run(new_p).add_break()
+
+        # --- VLOŽENÍ OBRÁZKU ---
+        if image_path:
+            img_path_obj = Path(image_path)
+            if not img_path_obj.exists():
+                print(f"[ERROR]   Obrázek NEEXISTUJE! {img_path_obj}", file=sys.stderr)
+                return
+
+            final_img_path, temp_jpg = self._resolve_image(img_path_obj, image_w_cm, image_h_cm)
+
+            if not paras_data:
+                paragraph.clear()
+                img_p = paragraph
+            else:
+                img_p = self._new_paragraph_after(p_insert, paragraph)
+                p_insert = img_p._p
+
+            img_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            img_p.paragraph_format.space_before = Pt(6)
+            img_p.paragraph_format.space_after = Pt(6)
+
+            try:
+                run = _styled_run(img_p)  # aby vložené popisky/mezery držely velikost
+                width, height = _picture_size(image_w_cm, image_h_cm)
+                run.add_picture(str(final_img_path), width=width, height=height)
+            except Exception as e:
+                print(f"[ERROR] Chyba při vkládání obrázku: {e}", file=sys.stderr)
+            finally:
+                # Úklid dočasného souboru
+                _cleanup_temp(temp_jpg)
+
+        # --- OBNOVA PAGE BREAKS ---
+        if breaks:
+            break_p = self._new_paragraph_after(p_insert, paragraph)
+            _restore_page_breaks(break_p, breaks)
+
+
+# ---- Přímý zápis WordprocessingML (rychlá cesta exportu) ----
+
+RT_IMAGE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+_SLOT_MARKER = "ceg-slot-3f9c"
+_SLOT_MARKER_RE = re.compile(rb"<!--ceg-slot-3f9c:\d+-->")
+_XMLNS_DECL_RE = re.compile(r' xmlns:(\w+)="([^"]*)"')
+_INVALID_XML_CHARS_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_REL_ID_RE = re.compile(r'\bId="([^"]+)"')
+_XML_DECL = b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n"
+
+
+def _run_content_xml(text: str) -> str:
+    """Obsah w:r pro text – stejně jako Run.text v python-docx (\\t -> w:tab, \\n/\\r -> w:br)."""
+    out: List[str] = []
+    buf: List[str] = []
+
+    def flush() -> None:
+        if buf:
+            t = "".join(buf)
+            buf.clear()
+            space = ' xml:space="preserve"' if len(t.strip()) < len(t) else ""
+            out.append(f"<w:t{space}>{xml_escape(t)}</w:t>")
+
+    for ch in _INVALID_XML_CHARS_RE.sub("", text):
+        if ch == "\t":
+            flush()
+            out.append("<w:tab/>")
+        elif ch in "\r\n":
+            flush()
+            out.append("<w:br/>")
+        else:
+            buf.append(ch)
+    flush()
+    return "".join(out)
+
+
+def _rels_name(part_name: str) -> str:
+    return posixpath.join(posixpath.dirname(part_name), "_rels", posixpath.basename(part_name) + ".rels")
+
+
+class _Story:
+    """Story part (dokument, záhlaví, zápatí) rozřezaná na neměnné úseky XML mezi sloty."""
+    def __init__(self, name: str, rels_xml: Optional[str], elem, slots: List[_Slot]) -> None:
+        self.name = name
+        self.rels_name = _rels_name(name)
+        self.rels_xml = rels_xml
+        self.rel_ids = set(_REL_ID_RE.findall(rels_xml or ""))
+        self.image_rels = {
+            m.group(2): m.group(1)
+            for m in re.finditer(r'<Relationship\b[^>]*?Id="([^"]+)"[^>]*?Target="([^"]+)"', rels_xml or "")
+        }
+        # Značky se čtou zpět v pořadí dokumentu -> sloty musí být seřazené stejně (tabulky jsou v
+        # compiled._slots až za odstavci těla, i když v dokumentu stojí před nimi)
+        self.slots = sorted(slots, key=lambda s: s.index)
+        self.nsmap = dict(elem.nsmap)
+        ids = [int(v) for v in elem.xpath("//@id") if v.isdigit()]
+        self.first_shape_id = max(ids) + 1 if ids else 1
+
+        # Sloty nahradíme komentářovými značkami a serializujeme zbytek jen jednou
+        work = deepcopy(elem)
+        paragraphs = list(work.iter(qn("w:p")))
+        for n, slot in enumerate(slots):
+            p = paragraphs[slot.index]
+            p.getparent().replace(p, etree.Comment(f"{_SLOT_MARKER}:{n}"))
+        self.segments = _SLOT_MARKER_RE.split(serialize_part_xml(work))
+        if len(self.segments) != len(slots) + 1:
+            raise ValueError(f"{name}: nepodařilo se rozdělit XML podle slotů")
+
+
+class _XmlPatchWriter:
+    """
+    Rychlá cesta exportu: místo objektového API python-docx skládá bloky otázek jako hotové
+    XML fragmenty a vkládá je přímo do word/document.xml (a záhlaví/zápatí) v zipu šablony.
+    Styly odstavců a běhů (pPr/rPr placeholderu, velikost písma, b/i/u/barva) se vyrábějí přes
+    python-docx jen jednou pro každou kombinaci a dál se používají jako hotové řetězce, takže
+    výstup odpovídá cestě přes python-docx (první odstavec si drží pPr placeholderu včetně numPr,
+    další dostanou jeho pStyle, zalomení stránek se obnovují).
+    """
+
+    def __init__(self, compiled: "CompiledTemplate") -> None:
+        self._resolve_image = compiled._resolve_image
+        buf = io.BytesIO()
+        compiled._doc.save(buf)  # balík včetně záhlaví/zápatí doplněných při kompilaci
+        with zipfile.ZipFile(buf) as zf:
+            self._entries = [(info.filename, zf.read(info)) for info in zf.infolist()]
+        data = dict(self._entries)
+
+        self._content_types = data["[Content_Types].xml"].decode("utf-8")
+        self._default_exts = {e.lower() for e in re.findall(r'<Default\b[^>]*?Extension="([^"]+)"', self._content_types)}
+        self._media_by_sha1: Dict[str, str] = {}
+        self._media_numbers = set()
+        for name, blob in self._entries:
+            m = re.match(r"word/media/image(\d+)\.\w+$", name)
+            if m:
+                self._media_numbers.add(int(m.group(1)))
+                self._media_by_sha1.setdefault(hashlib.sha1(blob).hexdigest(), name)
+
+        self._stories: List[_Story] = []
+        for part in compiled._parts:
+            slots = [s for s in compiled._slots if s.part is part]
+            if not slots:
+                continue
+            name = str(part.partname).lstrip("/")
+            if name not in data:
+                raise ValueError(f"V balíku šablony chybí {name}")
+            rels = data.get(_rels_name(name))
+            rels_xml = rels.decode("utf-8") if rels is not None else None
+            self._stories.append(_Story(name, rels_xml, compiled._base_elements[id(part)], slots))
+
+        self._fragments: Dict[tuple, str] = {}
+        self._slot_xml_cache: Dict[int, dict] = {}
+
+    # -- Fragmenty (memoizované) --
+
+    @staticmethod
+    def _fragment(el, nsmap: dict) -> str:
+        """Serializuje prvek bez deklarací jmenných prostorů, které už má kořen části."""
+        xml = etree.tostring(el, encoding="unicode")
+        return _XMLNS_DECL_RE.sub(lambda m: "" if nsmap.get(m.group(1)) == m.group(2) else m.group(0), xml)
+
+    def _slot_static(self, story: _Story, slot: _Slot) -> dict:
+        """Neměnné části slotu: otevírací tag w:p, původní odstavec a běh se zalomením stránek."""
+        cached = self._slot_xml_cache.get(id(slot))
+        if cached is None:
+            shell = etree.Element(slot.base_p.tag, attrib=dict(slot.base_p.attrib), nsmap=slot.base_p.nsmap)
+            open_tag = self._fragment(shell, story.nsmap)
+            open_tag = open_tag[:-2] + ">" if open_tag.endswith("/>") else open_tag.split(">", 1)[0] + ">"
+            breaks = ""
+            if slot.page_breaks:
+                breaks = "<w:r>" + "".join(self._fragment(br, story.nsmap) for br in slot.page_breaks) + "</w:r>"
+            cached = {
+                "open": open_tag,
+                "original": self._fragment(slot.base_p, story.nsmap),
+                "breaks": breaks,
+            }
+            self._slot_xml_cache[id(slot)] = cached
+        return cached
+
+    def _ppr(self, story: _Story, slot: _Slot, keep: bool, align: Optional[str] = None,
+             spacing: Optional[float] = None, prefix: bool = False) -> str:
+        """
+        pPr odstavce bloku. keep=True – pPr placeholderu (včetně numPr), jinak nový odstavec se
+        stylem placeholderu. Úpravy dělá python-docx, aby odpovídaly pomalé cestě.
+        """
+        key = ("ppr", id(slot), keep, align, spacing, prefix)
+        cached = self._fragments.get(key)
+        if cached is not None:
+            return cached
+        p_elem = OxmlElement("w:p")
+        parent = _StoryParent(slot.part)
+        if keep:
+            if slot.base_p.pPr is not None:
+                p_elem.append(deepcopy(slot.base_p.pPr))
+        para = Paragraph(p_elem, parent)
+        if not keep:
+            try:
+                para.style = Paragraph(slot.base_p, parent).style
+            except Exception:
+                pass
+        if align is not None:
+            para.alignment = {
+                "center": WD_ALIGN_PARAGRAPH.CENTER,
+                "right": WD_ALIGN_PARAGRAPH.RIGHT,
+                "justify": WD_ALIGN_PARAGRAPH.JUSTIFY,
+            }.get(align, WD_ALIGN_PARAGRAPH.LEFT)
+        if spacing is not None:
+            para.paragraph_format.space_before = Pt(spacing)
+            para.paragraph_format.space_after = Pt(spacing)
+        if prefix:
+            para.paragraph_format.left_indent = Pt(48)
+            para.paragraph_format.first_line_indent = Pt(-24)
+        cached = self._fragment(p_elem.pPr, story.nsmap) if p_elem.pPr is not None else ""
+        self._fragments[key] = cached
+        return cached
+
+    def _rpr(self, story: _Story, slot: _Slot, template_rPr, base_font_size,
+             r_data: Optional[dict] = None, bold: Optional[bool] = None) -> str:
+        fmt = (bool(r_data.get("b")), bool(r_data.get("i")), bool(r_data.get("u")), r_data.get("color")) if r_data else None
+        key = ("rpr", id(story), id(template_rPr), int(base_font_size) if base_font_size else None, fmt, bold)
+        cached = self._fragments.get(key)
+        if cached is not None:
+            return cached
+        r_elem = OxmlElement("w:r")
+        run = Run(r_elem, _StoryParent(slot.part))
+        _apply_run_style(run, template_rPr, base_font_size)
+        if bold is not None:
+            run.bold = bold
+        if r_data:
+            _apply_run_format(run, r_data)
+        cached = self._fragment(r_elem.rPr, story.nsmap) if r_elem.rPr is not None else ""
+        self._fragments[key] = cached
+        # template_rPr držíme naživu spolu s klíčem (id se nesmí recyklovat)
+        self._fragments[("keep", id(template_rPr))] = template_rPr
+        return cached
+
+    # -- Obrázky --
+
+    def _image_rel(self, state: dict, story: _Story, image) -> str:
+        media_by_sha1 = state["media_by_sha1"]
+        name = media_by_sha1.get(image.sha1)
+        if name is None:
+            numbers = state["media_numbers"]
+            n = next(i for i in range(1, len(numbers) + 2) if i not in numbers)
+            numbers.add(n)
+            name = f"word/media/image{n}.{image.ext}"
+            media_by_sha1[image.sha1] = name
+            state["media"][name] = image.blob
+            ext = image.ext.lower()
+            if ext not in state["default_exts"]:
+                state["default_exts"].add(ext)
+                state["content_types_add"].append(f'<Default Extension="{ext}" ContentType="{image.content_type}"/>')
+
+        st = state["stories"][story.name]
+        target = posixpath.relpath(name, posixpath.dirname(story.name))
+        rId = st["image_rels"].get(target)
+        if rId is None:
+            ids = st["rel_ids"]
+            rId = next(f"rId{i}" for i in range(1, len(ids) + 2) if f"rId{i}" not in ids)
+            ids.add(rId)
+            st["image_rels"][target] = rId
+            st["new_rels"].append(f'<Relationship Id="{rId}" Type="{RT_IMAGE}" Target="{target}"/>')
+        return rId
+
+    def _drawing_xml(self, state: dict, story: _Story, img_path: Path, image_w_cm: float, image_h_cm: float) -> str:
+        image = DocxImage.from_file(str(img_path))
+        rId = self._image_rel(state, story, image)
+        width, height = _picture_size(image_w_cm, image_h_cm)
+        cx, cy = image.scaled_dimensions(width, height)
+        st = state["stories"][story.name]
+        shape_id = st["next_id"]
+        st["next_id"] += 1
+        inline = CT_Inline.new_pic_inline(shape_id, rId, image.filename, cx, cy)
+        return "<w:drawing>" + self._fragment(inline, story.nsmap) + "</w:drawing>"
+
+    # -- Sloty --
+
+    def _block_xml(self, state: dict, story: _Story, slot: _Slot, html_content, image_path,
+                   image_w_cm: float, image_h_cm: float, ast: Optional[dict]) -> str:
+        static = self._slot_static(story, slot)
+        paras_data = question_paragraphs(html_content, ast)
+        template_rPr, base_font_size = slot.block_style()
+        rpr = self._rpr(story, slot, template_rPr, base_font_size)
+
+        # Pokud je obsah prázdný a není ani obrázek -> vyčistit a konec
+        if not paras_data and not image_path:
+            return static["open"] + self._ppr(story, slot, True) + static["breaks"] + "</w:p>"
+
+        out: List[str] = []
+        for i, p_data in enumerate(paras_data):
+            prefix = p_data.get('prefix')
+            runs: List[str] = []
+            if prefix:
+                runs.append(f"<w:r>{rpr}{_run_content_xml(prefix)}</w:r>")
+            for r_data in p_data['runs']:
+                fmt_rpr = None
+                parts = r_data['text'].split('\n')
+                for idx, part in enumerate(parts):
+                    if part:
+                        if fmt_rpr is None:
+                            fmt_rpr = self._rpr(story, slot, template_rPr, base_font_size, r_data)
+                        runs.append(f"<w:r>{fmt_rpr}{_run_content_xml(part)}</w:r>")
+                    if idx < len(parts) - 1:
+                        runs.append(f"<w:r>{rpr}<w:br/></w:r>")
+            ppr = self._ppr(story, slot, i == 0, p_data.get('align', 'left'), 0, bool(prefix))
+            out.append((static["open"] if i == 0 else "<w:p>") + ppr + "".join(runs) + "</w:p>")
+
+        if image_path:
+            img_path_obj = Path(image_path)
+            if not img_path_obj.exists():
+                print(f"[ERROR]   Obrázek NEEXISTUJE! {img_path_obj}", file=sys.stderr)
+                return "".join(out)
+            final_img_path, temp_jpg = self._resolve_image(img_path_obj, image_w_cm, image_h_cm)
+            try:
+                drawing = self._drawing_xml(state, story, final_img_path, image_w_cm, image_h_cm)
+            except Exception as e:
+                print(f"[ERROR] Chyba při vkládání obrázku: {e}", file=sys.stderr)
+                drawing = ""
+            finally:
+                _cleanup_temp(temp_jpg)
+            keep = not paras_data
+            out.append((static["open"] if keep else "<w:p>") + self._ppr(story, slot, keep, "center", 6)
+                       + f"<w:r>{rpr}{drawing}</w:r></w:p>")
+
+        if static["breaks"]:
+            out.append("<w:p>" + self._ppr(story, slot, False) + static["breaks"] + "</w:p>")
+        return "".join(out)
+
+    def _inline_xml(self, story: _Story, slot: _Slot, keys_found: List[str], segments: list) -> str:
+        static = self._slot_static(story, slot)
+        base_bold, template_rPr, base_font_size = slot.inline_style(keys_found)
+        rpr = self._rpr(story, slot, template_rPr, base_font_size)
+        runs: List[str] = []
+        for seg in segments:
+            if isinstance(seg, str):
+                runs.append(f"<w:r>{rpr}{_run_content_xml(seg)}</w:r>")
+            elif seg["type"] == "simple":
+                bold_rpr = self._rpr(story, slot, template_rPr, base_font_size, bold=base_bold)
+                runs.append(f"<w:r>{bold_rpr}{_run_content_xml(str(seg['val']))}</w:r>")
+            else:
+                for p_idx, p_data in enumerate(question_paragraphs(seg["val"], seg["ast"])):
+                    if p_idx > 0:
+                        runs.append("<w:r><w:br/></w:r>")
+                    for r_data in p_data["runs"]:
+                        parts = r_data["text"].split("\n")
+                        for idx_part, part in enumerate(parts):
+                            if part:
+                                fmt_rpr = self._rpr(story, slot, template_rPr, base_font_size, r_data)
+                                runs.append(f"<w:r>{fmt_rpr}{_run_content_xml(part)}</w:r>")
+                            if idx_part < len(parts) - 1:
+                                runs.append("<w:r><w:br/></w:r>")
+        return static["open"] + self._ppr(story, slot, True) + "".join(runs) + static["breaks"] + "</w:p>"
+
+    # -- Render verze --
+
+    def render_bytes(self, simple_repl: Dict[str, str], rich_repl_html: Dict[str, object],
+                     compresslevel: Optional[int] = None) -> bytes:
+        state = {
+            "media": {},
+            "media_by_sha1": dict(self._media_by_sha1),
+            "media_numbers": set(self._media_numbers),
+            "default_exts": set(self._default_exts),
+            "content_types_add": [],
+            "stories": {
+                story.name: {
+                    "rel_ids": set(story.rel_ids),
+                    "image_rels": dict(story.image_rels),
+                    "new_rels": [],
+                    "next_id": story.first_shape_id,
+                }
+                for story in self._stories
+            },
+        }
+
+        replaced: Dict[str, bytes] = {}
+        for story in self._stories:
+            pieces = [story.segments[0]]
+            for n, slot in enumerate(story.slots):
+                kind, data = _resolve_slot(slot, simple_repl, rich_repl_html)
+                if kind == "block":
+                    xml = self._block_xml(state, story, slot, *data)
+                elif kind == "inline":
+                    xml = self._inline_xml(story, slot, *data)
+                else:
+                    xml = self._slot_static(story, slot)["original"]
+                pieces.append(xml.encode("utf-8"))
+                pieces.append(story.segments[n + 1])
+            replaced[story.name] = b"".join(pieces)
+
+            new_rels = state["stories"][story.name]["new_rels"]
+            if new_rels:
+                base = story.rels_xml or (
+                    _XML_DECL.decode("utf-8")
+                    + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"></Relationships>'
+                )
+                replaced[story.rels_name] = base.replace("</Relationships>", "".join(new_rels) + "</Relationships>").encode("utf-8")
+
+        if state["content_types_add"]:
+            ct = re.sub(r"(<Types\b[^>]*>)", lambda m: m.group(1) + "".join(state["content_types_add"]),
+                        self._content_types, count=1)
+            replaced["[Content_Types].xml"] = ct.encode("utf-8")
+
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+            written = set()
+            for name, blob in self._entries:
+                zf.writestr(name, replaced.get(name, blob))
+                written.add(name)
+            for name, blob in replaced.items():
+                if name not in written:
+                    zf.writestr(name, blob)
+            for name, blob in state["media"].items():
+                zf.writestr(name, blob)
+        return out.getvalue()
+
+
+# ---- Paralelní render verzí (pracovní procesy) ----
+
+# Minimální počet verzí, od kterého se vyplatí spouštět pracovní procesy
+EXPORT_PARALLEL_MIN_VERSIONS = 4
+
+_worker_template: Optional[CompiledTemplate] = None
+_worker_template_key: Optional[tuple] = None
+
+
+def export_worker_count(jobs: int) -> int:
+    """Počet pracovních procesů pro daný počet verzí (nejvýše počet jader)."""
+    return max(1, min(jobs, os.cpu_count() or 1))
+
+
+def render_version_job(template_path: str, output_path: str,
+                       simple_repl: Dict[str, str], rich_repl_html: Dict[str, object],
+                       image_cache_dir: Optional[str] = None,
+                       print_dpi: int = DEFAULT_PRINT_DPI,
+                       compresslevel: Optional[int] = None) -> str:
+    """
+    Vyrenderuje jednu verzi v pracovním procesu.
+    Dostává jen neměnná data verze (náhrady + snímek HTML/obrázků vybraných otázek);
+    zkompilovaná šablona se v procesu drží v cache a sdílí mezi úlohami.
+    Cache obrázků je na disku, takže ji procesy sdílejí i mezi sebou.
+    """
+    global _worker_template, _worker_template_key
+    try:
+        mtime = os.path.getmtime(template_path)
+    except OSError:
+        mtime = None
+    key = (template_path, mtime, image_cache_dir, print_dpi)
+    if _worker_template is None or _worker_template_key != key:
+        cache = ImageCache(image_cache_dir, print_dpi) if image_cache_dir else None
+        _worker_template = CompiledTemplate(template_path, image_cache=cache)
+        _worker_template_key = key
+    _worker_template.compresslevel = compresslevel
+    _worker_template.render(output_path, simple_repl, rich_repl_html)
+    return output_path
+
+
+# ---- PDF konverze a slučování ----
+
+class ExportError(Exception):
+    """Chyba exportu, kterou má smysl ukázat uživateli (text je česky)."""
+
+
+LIBREOFFICE_CANDIDATES = [
+    "libreoffice",                                            # Standard Linux/PATH
+    "soffice",                                                # Generic bin
+    "/Applications/LibreOffice.app/Contents/MacOS/soffice",   # macOS standard path
+    "/usr/bin/libreoffice",
+    "/usr/local/bin/libreoffice",
+    r"C:\Program Files\LibreOffice\program\soffice.exe",      # Windows x64
+    r"C:\Program Files (x86)\LibreOffice\program\soffice.exe" # Windows x86
+]
+
+
+def find_libreoffice() -> Optional[str]:
+    """Najde spustitelný soubor LibreOffice (PATH i standardní instalační složky)."""
+    for cand in LIBREOFFICE_CANDIDATES:
+        # shutil.which hledá v PATH, Path(cand).exists() hledá konkrétní soubor
+        if shutil.which(cand) or Path(cand).exists():
+            return cand
+    return None
+
+
+def convert_docx_to_pdf(docx_path, lo_executable: Optional[str] = None, timeout: int = 60) -> Optional[Path]:
+    """
+    Konvertuje DOCX na PDF pomocí LibreOffice (headless), PDF vznikne vedle DOCX.
+    Vrací cestu k PDF, None pokud LibreOffice PDF nevytvořil; ExportError při chybějícím
+    LibreOffice, timeoutu nebo jiné chybě spuštění.
+    """
+    docx_path = Path(docx_path)
+    lo_executable = lo_executable or find_libreoffice()
+    if not lo_executable:
+        raise ExportError(
+            "Nemohu najít nainstalovaný LibreOffice.\n"
+            "Pokud jej máte nainstalovaný, ujistěte se, že je ve standardní složce "
+            "(/Applications/LibreOffice.app na macOS)."
+        )
+    pdf_path = docx_path.with_suffix('.pdf')
+    cmd = [lo_executable, '--headless', '--convert-to', 'pdf', '--outdir', str(pdf_path.parent), str(docx_path)]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise ExportError("Konverze trvala příliš dlouho (timeout).")
+    except Exception as e:
+        raise ExportError(f"Neočekávaná chyba při konverzi PDF:\n{e}")
+
+    if result.returncode != 0:
+        print(f"LibreOffice chyba (Code {result.returncode}):\nSTDERR: {result.stderr}\nSTDOUT: {result.stdout}", file=sys.stderr)
+    # Někdy se stane, že returncode je 0, ale soubor nikde (např. sandbox issues)
+    return pdf_path if pdf_path.exists() else None
+
+
+def merge_pdfs_subprocess(pdf_paths: List[Path], output_path: Path) -> bool:
+    """Fallback: slučování PDF pomocí externích nástrojů (macOS join.py nebo GS)."""
+    # A. macOS Built-in Script (Automator) – standardně přítomen na macOS
+    macos_join_script = "/System/Library/Automator/Combine PDF Pages.action/Contents/Resources/join.py"
+    if sys.platform == "darwin" and Path(macos_join_script).exists():
+        try:
+            cmd = ["python3", macos_join_script, "-o", str(output_path)]
+            cmd.extend([str(p) for p in pdf_paths if p.exists()])
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            if result.returncode == 0:
+                return True
+            print(f"macOS join.py failed: {result.stderr}", file=sys.stderr)
+        except Exception as e:
+            print(f"macOS join.py exception: {e}", file=sys.stderr)
+
+    # B. Ghostscript
+    try:
+        cmd = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite', f'-sOutputFile={output_path}']
+        cmd.extend([str(p) for p in pdf_paths if p.exists()])
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        return result.returncode == 0
+    except FileNotFoundError:
+        print("Ghostscript (gs) nebyl nalezen.", file=sys.stderr)
+        return False
+    except Exception as e:
+        print(f"Ghostscript error: {e}", file=sys.stderr)
+        return False
+
+
+def merge_pdfs(pdf_paths: List[Path], output_path: Path, cleanup: bool = True) -> bool:
+    """
+    Spojí více PDF souborů do jednoho. Zkouší: PyPDF2 -> macOS join.py -> Ghostscript.
+    Zdrojová PDF maže (cleanup) jen při úspěchu, aby po chybě zůstala aspoň jednotlivá.
+    """
+    success = False
+    try:
+        from PyPDF2 import PdfMerger
+        merger = PdfMerger()
+        for pdf_path in pdf_paths:
+            if pdf_path.exists():
+                merger.append(str(pdf_path))
+        merger.write(str(output_path))
+        merger.close()
+        success = True
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"Chyba PyPDF2: {e}", file=sys.stderr)
+
+    if not success:
+        success = merge_pdfs_subprocess(pdf_paths, output_path)
+    if not success:
+        return False
+
+    if cleanup:
+        for pdf_path in pdf_paths:
+            try:
+                pdf_path.unlink()
+            except Exception as e:
+                print(f"Nemohu smazat dočasný PDF {pdf_path}: {e}", file=sys.stderr)
+    return True
+
+
+# ---- Jeden DOCX se sekcemi (všechny verze v jednom souboru) ----
+
+_RT_PREFIX = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/"
+_REMAP_REL_TYPES = {"image", "header", "footer", "hyperlink"}
+_REL_RE = re.compile(r"<Relationship\b[^>]*?/>")
+_ATTR_RE = re.compile(r'(\w+)="([^"]*)"')
+_BODY_RE = re.compile(r"(<w:body\b[^>]*>)(.*)(</w:body>)", re.S)
+_FINAL_SECTPR_RE = re.compile(r"(<w:sectPr\b(?:[^>]*/>|.*?</w:sectPr>))\s*$", re.S)
+_FIRST_SECTPR_RE = re.compile(r"<w:sectPr\b(?:[^>]*/>|.*?</w:sectPr>)", re.S)
+_REL_ATTR_RE = re.compile(r'\b(r:(?:id|embed|link|pict))="([^"]+)"')
+_DOCPR_ID_RE = re.compile(r'(<wp:docPr\b[^>]*?\bid=")(\d+)"')
+_BOOKMARK_ID_RE = re.compile(r'(<w:bookmark(?:Start|End)\b[^>]*?\bw:id=")(\d+)"')
+_NUM_ID_RE = re.compile(r'(<w:numId w:val=")(\d+)"')
+_NUM_RE = re.compile(r'<w:num w:numId="(\d+)"[^>]*>.*?<w:abstractNumId w:val="(\d+)"', re.S)
+# Prvky sectPr, které musí následovat až za w:pgNumType (pořadí dle schématu)
+_AFTER_PGNUM_RE = re.compile(r"<w:(?:cols|formProt|vAlign|noEndnote|titlePg|textDirection|bidi|rtlGutter|"
+                             r"docGrid|printerSettings|sectPrChange)\b")
+
+
+def _parse_rels(xml: str) -> List[Dict[str, str]]:
+    return [dict(_ATTR_RE.findall(m.group(0))) for m in _REL_RE.finditer(xml)]
+
+
+def _part_target(source_dir: str, target: str) -> str:
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(source_dir, target))
+
+
+def _restart_page_numbers(sect_pr: str) -> str:
+    """Sekce začne číslovat stránky od 1 (každá verze má vlastní číslování)."""
+    if "<w:pgNumType" in sect_pr:
+        if "w:start=" in sect_pr.split("<w:pgNumType", 1)[1].split(">", 1)[0]:
+            return sect_pr
+        return sect_pr.replace("<w:pgNumType", '<w:pgNumType w:start="1"', 1)
+    if sect_pr.endswith("/>"):
+        return sect_pr[:-2] + '><w:pgNumType w:start="1"/></w:sectPr>'
+    m = _AFTER_PGNUM_RE.search(sect_pr)
+    pos = m.start() if m else sect_pr.rindex("</w:sectPr>")
+    return sect_pr[:pos] + '<w:pgNumType w:start="1"/>' + sect_pr[pos:]
+
+
+class _DocxCombiner:
+    """
+    Skládá vyrenderované verze (stejná šablona) do jednoho DOCX: každá verze je vlastní sekce
+    s vlastními záhlavími/zápatími (PoznamkaVerze verze), vlastním číslováním stránek a číslované
+    seznamy začínají znovu od 1. Tělo se průběžně zapisuje do dočasného souboru a média i záhlaví
+    rovnou do výstupního zipu, takže paměť nezávisí na počtu verzí. Stejné obrázky se ukládají jednou.
+    """
+
+    def __init__(self, output_path, total: int) -> None:
+        self.output_path = Path(output_path)
+        self.total = total
+        self.count = 0
+        self._body = tempfile.TemporaryFile()
+        self._tmp_out = None
+        self._zip = None
+        self._finished = False
+
+    def __enter__(self) -> "_DocxCombiner":
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self._tmp_out = tempfile.mkstemp(suffix=".docx", dir=str(self.output_path.parent))
+        os.close(fd)
+        self._zip = zipfile.ZipFile(self._tmp_out, "w", zipfile.ZIP_DEFLATED)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._body.close()
+        if self._zip is not None:
+            self._zip.close()
+        if exc_type is None and self._finished:
+            os.chmod(self._tmp_out, _output_file_mode(self.output_path))  # mkstemp zakládá 0600
+            os.replace(self._tmp_out, self.output_path)
+        else:
+            _cleanup_temp(self._tmp_out)
+
+    # -- Verze --
+
+    def add(self, docx_path) -> None:
+        with zipfile.ZipFile(docx_path) as zf:
+            data = {info.filename: zf.read(info) for info in zf.infolist()}
+        document = data["word/document.xml"].decode("utf-8")
+        m = _BODY_RE.search(document)
+        if m is None:
+            raise ValueError(f"{Path(docx_path).name}: chybí w:body")
+        body = m.group(2)
+        if self.count == 0:
+            self._init_base(data, document[:m.end(1)], document[m.start(3):])
+        else:
+            body = self._remap_version(data, body)
+        self.count += 1
+        if self.count < self.total:
+            # Koncový sectPr verze se přesune do posledního odstavce -> konec sekce (nová stránka)
+            sm = _FINAL_SECTPR_RE.search(body)
+            if sm:
+                body = body[:sm.start()] + "<w:p><w:pPr>" + sm.group(1) + "</w:pPr></w:p>"
+        self._body.write(body.encode("utf-8"))
+
+    def _init_base(self, data: Dict[str, bytes], head: str, tail: str) -> None:
+        """První verze dává kostru balíku (styly, nastavení, motivy...) i jmenné prostory těla."""
+        self._head, self._tail = head, tail
+        self._content_types = data["[Content_Types].xml"].decode("utf-8")
+        self._default_exts = {e.lower() for e in re.findall(r'<Default\b[^>]*?Extension="([^"]+)"', self._content_types)}
+        self._ct_add: List[str] = []
+        self._doc_rels = data["word/_rels/document.xml.rels"].decode("utf-8")
+        self._rels_add: List[str] = []
+        numbering = data.get("word/numbering.xml")
+        self._numbering = numbering.decode("utf-8") if numbering is not None else None
+        self._num_add: List[str] = []
+        self._num_abstract = dict(_NUM_RE.findall(self._numbering)) if self._numbering else {}
+        self._next_num = max((int(n) for n in self._num_abstract), default=0) + 1
+        self._media_by_sha1: Dict[str, str] = {}
+        self._names = set(data)
+        skip = {"[Content_Types].xml", "word/document.xml", "word/_rels/document.xml.rels", "word/numbering.xml"}
+        for name, blob in data.items():
+            if name.startswith("word/media/"):
+                self._media_by_sha1.setdefault(hashlib.sha1(blob).hexdigest(), name)
+            if name not in skip:
+                self._zip.writestr(name, blob)
+        document = data["word/document.xml"].decode("utf-8")
+        self._next_docpr = max((int(v) for v in re.findall(r'<wp:docPr\b[^>]*?\bid="(\d+)"', document)), default=0) + 1
+        self._next_bookmark = max((int(v) for v in re.findall(r'<w:bookmarkStart\b[^>]*?\bw:id="(\d+)"', document)),
+                                  default=0) + 1
+
+    def _free_name(self, stem: str, ext: str) -> str:
+        n = 1
+        while f"{stem}{n}{ext}" in self._names:
+            n += 1
+        name = f"{stem}{n}{ext}"
+        self._names.add(name)
+        return name
+
+    def _media(self, blob: bytes, ext: str, content_type: Optional[str]) -> str:
+        sha1 = hashlib.sha1(blob).hexdigest()
+        name = self._media_by_sha1.get(sha1)
+        if name is None:
+            name = self._free_name("word/media/image", f".{ext}")
+            self._zip.writestr(name, blob)
+            self._media_by_sha1[sha1] = name
+            if ext.lower() not in self._default_exts and content_type:
+                self._default_exts.add(ext.lower())
+                self._ct_add.append(f'<Default Extension="{ext}" ContentType="{content_type}"/>')
+        return name
+
+    def _copy_media_rels(self, data: Dict[str, bytes], part_name: str, new_part: str, ext_types: Dict[str, str]) -> None:
+        """Záhlaví/zápatí si nese vlastní relace (obrázky); cíle se přesměrují na sdílená média."""
+        rels = data.get(_rels_name(part_name))
+        if rels is None:
+            return
+        rels_xml = rels.decode("utf-8")
+        src_dir, new_dir = posixpath.dirname(part_name), posixpath.dirname(new_part)
+        for rel in _parse_rels(rels_xml):
+            if rel.get("Type") != RT_IMAGE or rel.get("TargetMode") == "External":
+                continue
+            old = _part_target(src_dir, rel["Target"])
+            if old in data:
+                ext = old.rsplit(".", 1)[-1]
+                new = self._media(data[old], ext, ext_types.get(ext.lower()))
+                rels_xml = rels_xml.replace(f'Target="{rel["Target"]}"',
+                                            f'Target="{posixpath.relpath(new, new_dir)}"')
+        self._zip.writestr(_rels_name(new_part), rels_xml)
+
+    def _remap_version(self, data: Dict[str, bytes], body: str) -> str:
+        v = self.count + 1
+        ct = data["[Content_Types].xml"].decode("utf-8")
+        ext_types = {e.lower(): t for e, t in re.findall(r'<Default\b[^>]*?Extension="([^"]+)"[^>]*?ContentType="([^"]+)"', ct)}
+        overrides = dict(re.findall(r'<Override\b[^>]*?PartName="([^"]+)"[^>]*?ContentType="([^"]+)"', ct))
+
+        rid_map: Dict[str, str] = {}
+        for rel in _parse_rels(data["word/_rels/document.xml.rels"].decode("utf-8")):
+            kind = rel.get("Type", "").replace(_RT_PREFIX, "")
+            if kind not in _REMAP_REL_TYPES:
+                continue  # styly, číslování, nastavení... jsou u všech verzí stejné
+            new_id = f"v{v}{rel['Id']}"
+            target = rel["Target"]
+            if rel.get("TargetMode") != "External":
+                old = _part_target("word", target)
+                if old not in data:
+                    continue
+                if kind == "image":
+                    ext = old.rsplit(".", 1)[-1]
+                    new = self._media(data[old], ext, ext_types.get(ext.lower()))
+                else:
+                    new = self._free_name(f"word/{kind}", ".xml")
+                    self._zip.writestr(new, data[old])
+                    self._copy_media_rels(data, old, new, ext_types)
+                    content_type = overrides.get("/" + old)
+                    if content_type:
+                        self._ct_add.append(f'<Override PartName="/{new}" ContentType="{content_type}"/>')
+                target = posixpath.relpath(new, "word")
+            mode = ' TargetMode="External"' if rel.get("TargetMode") == "External" else ""
+            self._rels_add.append(f'<Relationship Id="{new_id}" Type="{rel["Type"]}" Target="{target}"{mode}/>')
+            rid_map[rel["Id"]] = new_id
+
+        body = _REL_ATTR_RE.sub(lambda m: f'{m.group(1)}="{rid_map.get(m.group(2), m.group(2))}"', body)
+
+        def docpr(m):
+            self._next_docpr += 1
+            return f'{m.group(1)}{self._next_docpr - 1}"'
+        body = _DOCPR_ID_RE.sub(docpr, body)
+
+        bookmarks: Dict[str, int] = {}
+        def bookmark(m):
+            new = bookmarks.get(m.group(2))
+            if new is None:
+                new = bookmarks[m.group(2)] = self._next_bookmark
+                self._next_bookmark += 1
+            return f'{m.group(1)}{new}"'
+        body = _BOOKMARK_ID_RE.sub(bookmark, body)
+
+        # Číslované seznamy: každá verze dostane vlastní w:num (stejný abstractNum, start od 1)
+        num_map: Dict[str, str] = {}
+        def numid(m):
+            old = m.group(2)
+            abstract = self._num_abstract.get(old)
+            if abstract is None:
+                return m.group(0)  # numId 0 = bez číslování
+            new = num_map.get(old)
+            if new is None:
+                new = num_map[old] = str(self._next_num)
+                self._next_num += 1
+                overrides_xml = "".join(f'<w:lvlOverride w:ilvl="{lvl}"><w:startOverride w:val="1"/></w:lvlOverride>'
+                                        for lvl in range(9))
+                self._num_add.append(f'<w:num w:numId="{new}"><w:abstractNumId w:val="{abstract}"/>{overrides_xml}</w:num>')
+            return f'{m.group(1)}{new}"'
+        body = _NUM_ID_RE.sub(numid, body)
+
+        # Nová verze začíná stránkou 1
+        fm = _FIRST_SECTPR_RE.search(body)
+        if fm:
+            body = body[:fm.start()] + _restart_page_numbers(fm.group(0)) + body[fm.end():]
+        return body
+
+    # -- Dokončení --
+
+    def finish(self) -> None:
+        zf = self._zip
+        ct = self._content_types
+        zf.writestr("[Content_Types].xml", ct.replace("</Types>", "".join(self._ct_add) + "</Types>"))
+        zf.writestr("word/_rels/document.xml.rels",
+                    self._doc_rels.replace("</Relationships>", "".join(self._rels_add) + "</Relationships>"))
+        if self._numbering is not None:
+            numbering = self._numbering
+            added = "".join(self._num_add)
+            pos = numbering.find("<w:numIdMacAtCleanup")
+            if pos < 0:
+                pos = numbering.rindex("</w:numbering>")
+            zf.writestr("word/numbering.xml", numbering[:pos] + added + numbering[pos:])
+        self._body.seek(0)
+        with zf.open("word/document.xml", "w") as out:
+            out.write(self._head.encode("utf-8"))
+            shutil.copyfileobj(self._body, out)
+            out.write(self._tail.encode("utf-8"))
+        self._finished = True
+
+
+def combine_docx(docx_paths: List[Path], output_path, progress=None, should_cancel=None) -> bool:
+    """
+    Složí verze (vyrenderované ze stejné šablony) do jednoho DOCX – každá verze = nová sekce
+    od nové stránky. Vrací False, pokud bylo skládání zrušeno (výstup pak nevznikne).
+    """
+    progress = progress or (lambda *a: None)
+    should_cancel = should_cancel or (lambda: False)
+    total = len(docx_paths)
+    with _DocxCombiner(output_path, total) as combiner:
+        for idx, path in enumerate(docx_paths):
+            if should_cancel():
+                return False  # nedokončený výstup se zahodí při opuštění bloku
+            combiner.add(path)
+            progress("combine", idx + 1, total, f"Skládám verze do jednoho DOCX {idx + 1}/{total}...")
+        combiner.finish()
+    return True
+
+
+# ---- Cache vyrenderovaných verzí a manifest výběru ----
+
+class RenderCache:
+    """
+    Cache vyrenderovaných verzí (DOCX i PDF) v data/.cache/render.
+
+    Klíč verze = hash šablony + hodnoty placeholderů, které šablona opravdu obsahuje
+    + obsah vybraných otázek (hash HTML, obrázek včetně velikosti/mtime, rozměr) + tisková DPI.
+    Nezměněná verze se tak při opakovaném exportu jen zkopíruje (a ušetří i konverzi LibreOffice).
+    """
+
+    def __init__(self, cache_dir, max_entries: int = 2000) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+
+    def key(self, compiled: "CompiledTemplate", simple_repl: Dict[str, str],
+            rich_repl_html: Dict[str, object]) -> str:
+        used = compiled.placeholder_keys()
+        h = hashlib.sha256()
+        h.update(compiled.template_hash.encode("ascii"))
+        dpi = compiled.image_cache.print_dpi if compiled.image_cache is not None else 0
+        h.update(f"|dpi={dpi}|z={compiled.compresslevel}".encode("ascii"))
+        for k in sorted(k for k in simple_repl if k in used and k not in rich_repl_html):
+            h.update(f"|s:{k}={simple_repl[k]}".encode("utf-8"))
+        for k in sorted(k for k in rich_repl_html if k in used):
+            val = rich_repl_html[k]
+            if not isinstance(val, tuple):
+                val = (val, None)
+            html, img = val[0], val[1]
+            w = float((val[2] if len(val) > 2 else 0.0) or 0.0)
+            hh = float((val[3] if len(val) > 3 else 0.0) or 0.0)
+            img_id = ""
+            if img:
+                try:
+                    st = os.stat(img)
+                    img_id = f"{img}:{st.st_size}:{st.st_mtime_ns}"
+                except OSError:
+                    img_id = f"{img}:missing"
+            h.update(f"|r:{k}={html_hash(html or '')}:{img_id}:{w:.3f}:{hh:.3f}".encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key: str, ext: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{ext}"
+
+    def fetch(self, key: str, ext: str, target) -> bool:
+        """Zkopíruje uloženou verzi na target; False = v cache není."""
+        src = self.path(key, ext)
+        if not src.exists():
+            return False
+        try:
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(src, target)
+            os.utime(src)  # pro úklid podle stáří (LRU)
+            return True
+        except OSError as e:
+            print(f"[WARN] Render cache: {e}", file=sys.stderr)
+            return False
+
+    def store(self, key: str, ext: str, source) -> None:
+        dest = self.path(key, ext)
+        tmp = None
+        try:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=ext, dir=str(dest.parent))
+            os.close(fd)
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, dest)
+        except OSError as e:
+            print(f"[WARN] Render cache: {e}", file=sys.stderr)
+            _cleanup_temp(tmp)
+
+    def prune(self) -> None:
+        """Smaže nejdéle nepoužité soubory nad limit max_entries."""
+        try:
+            files = [p for p in self.cache_dir.glob("*/*") if p.is_file()]
+        except OSError:
+            return
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda p: p.stat().st_mtime)
+        for p in files[:len(files) - self.max_entries]:
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(base_output_path) -> Path:
+    """Manifest leží vedle výstupu: test.docx -> test.manifest.json."""
+    p = Path(base_output_path)
+    return p.with_name(f"{p.stem}.manifest.json")
+
+
+def write_manifest(base_output_path, compiled: "CompiledTemplate", selections: List[Dict[str, str]],
+                   result: Optional["ExportResult"] = None, combined: bool = False, **info) -> Path:
+    """
+    Uloží výběr všech verzí (placeholder -> id otázky), seed/hash a otisk šablony vedle výstupu,
+    aby šlo stejný balík vygenerovat znovu (viz read_manifest).
+    """
+    versions = []
+    for i, selection in enumerate(selections):
+        out = Path(base_output_path) if combined else version_output_path(base_output_path, i, len(selections) > 1)
+        versions.append({
+            "index": i + 1,
+            "output": out.name,  # u složeného DOCX je verze i+1 jeho (i+1). sekcí
+            "selection": selection,
+            "render_key": (result.render_keys.get(i) if result is not None else None),
+        })
+    data = {
+        "manifest_version": MANIFEST_VERSION,
+        "created": datetime.now().isoformat(),
+        "template": str(compiled.template_path),
+        "template_hash": compiled.template_hash,
+        "combined": combined,
+        **info,
+        "versions": versions,
+    }
+    path = manifest_path(base_output_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def read_manifest(path) -> Optional[dict]:
+    """Načte manifest; None, pokud chybí nebo má neznámý formát."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("manifest_version") != MANIFEST_VERSION:
+        return None
+    if not isinstance(data.get("versions"), list):
+        return None
+    return data
+
+
+# ---- Mezivýstupy pro PDF (RAM, nízká komprese) ----
+
+# DOCX, které jsou jen vstupem LibreOffice, se balí nejrychlejším deflate
+INTERMEDIATE_COMPRESSLEVEL = 1
+# /dev/shm se použije jen při dostatku místa (v kontejnerech bývá jen 64 MB)
+INTERMEDIATE_MIN_FREE = 512 * 1024 * 1024
+
+
+def intermediate_dir(prefix: str = "ceg_") -> Path:
+    """Dočasná složka pro mezivýstupy – v RAM (/dev/shm), pokud je k dispozici, jinak systémový temp."""
+    base = None
+    shm = Path("/dev/shm")
+    try:
+        if shm.is_dir() and os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= INTERMEDIATE_MIN_FREE:
+            base = str(shm)
+    except OSError:
+        pass
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=base))
+
+
+def finalize_intermediates(result: "ExportResult", work_dir, output_dir) -> bool:
+    """
+    Úklid po exportu s DOCX jen jako mezivýstupem: DOCX, ze kterého PDF vzniklo, se zahodí.
+    DOCX bez PDF (verze, složený balík i klíč odpovědí) se přesune do output_dir, aby export
+    nepřišel vniveč. result.docx_discarded = PDF vzniklo ze všech. Vrací True, pokud se něco zachránilo.
+    """
+    output_dir = Path(output_dir)
+    rescued = False
+    if result.combined_docx is not None:
+        items = [("combined", result.combined_docx)]
+    else:
+        items = sorted(result.rendered.items())
+    items += [(("key", n), p) for n, p in enumerate(result.key_files)]
+    try:
+        for i, path in items:
+            if path in result.pdf_sources or not path.exists():
+                continue
+            output_dir.mkdir(parents=True, exist_ok=True)
+            dest = output_dir / path.name
+            shutil.move(str(path), str(dest))
+            rescued = True
+            if i == "combined":
+                result.combined_docx = dest
+            elif isinstance(i, tuple):
+                result.key_files[i[1]] = dest
+            else:
+                result.rendered[i] = dest
+    except OSError as e:
+        print(f"[ERROR] Přesun DOCX z dočasné složky: {e}", file=sys.stderr)
+    result.docx_discarded = bool(items) and all(path in result.pdf_sources for _i, path in items)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return rescued
+
+
+# ---- Celý běh exportu (render verzí → PDF → sloučení) ----
+
+@dataclass
+class ExportResult:
+    """Výsledek běhu run_export. rendered/failed jsou klíčované indexem verze."""
+    rendered: Dict[int, Path] = field(default_factory=dict)
+    failed: Dict[int, str] = field(default_factory=dict)
+    pdf_files: List[Path] = field(default_factory=list)
+    final_pdf: Optional[Path] = None
+    merged: bool = False
+    pdf_errors: List[str] = field(default_factory=list)
+    merge_failed: bool = False
+    cancelled: bool = False
+    render_keys: Dict[int, str] = field(default_factory=dict)  # klíče RenderCache verzí
+    cache_hits: int = 0                                         # verze převzaté z cache (bez renderu)
+    combined_docx: Optional[Path] = None                        # všechny verze v jednom DOCX (sekce)
+    key_files: List[Path] = field(default_factory=list)         # klíče odpovědí (DOCX)
+    key_pdfs: List[Path] = field(default_factory=list)          # klíče odpovědí převedené do PDF
+    key_errors: List[str] = field(default_factory=list)
+    pdf_sources: set = field(default_factory=set)               # DOCX, ze kterých PDF vzniklo
+    docx_discarded: bool = False  # DOCX byly jen mezivýstup pro PDF a nezachovaly se
+    error: Optional[str] = None  # neočekávaná chyba celého běhu (nastavuje volající)
+
+    @property
+    def docx_files(self) -> List[Path]:
+        if self.combined_docx is not None:
+            return [self.combined_docx]
+        return [self.rendered[i] for i in sorted(self.rendered)]
+
+
+def _render_parallel(template_path: str, jobs: List[tuple], result: ExportResult,
+                     image_cache: Optional[ImageCache], on_rendered, should_cancel,
+                     mp_context=None, compresslevel: Optional[int] = None) -> List[tuple]:
+    """
+    Rozdělí render verzí mezi pracovní procesy (ProcessPoolExecutor).
+    Vrací úlohy, které se paralelně nezpracovaly (např. pool nešel spustit) – ty doběhnou sekvenčně.
+    Při zrušení se nezačaté verze stornují, rozpracované se nechají doběhnout.
+    """
+    cache_args = (str(image_cache.cache_dir), image_cache.print_dpi) if image_cache is not None else ()
+    try:
+        with ProcessPoolExecutor(max_workers=export_worker_count(len(jobs)), mp_context=mp_context) as pool:
+            futures = {
+                pool.submit(render_version_job, template_path, str(target_path), repl_plain, rich_map,
+                            *cache_args, compresslevel=compresslevel): (i, target_path)
+                for i, target_path, repl_plain, rich_map in jobs
+            }
+            for fut in as_completed(futures):
+                i, target_path = futures[fut]
+                if fut.cancelled():
+                    continue
+                try:
+                    fut.result()
+                    result.rendered[i] = target_path
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"[ERROR] Verze {i+1}: {e}", file=sys.stderr)
+                    result.failed[i] = str(e)
+                on_rendered(i)
+                if should_cancel() and not result.cancelled:
+                    result.cancelled = True
+                    for f in futures:
+                        f.cancel()
+    except (BrokenProcessPool, OSError) as e:
+        print(f"[WARN] Paralelní export selhal, zbytek verzí se vygeneruje sekvenčně: {e}", file=sys.stderr)
+    if result.cancelled:
+        return []
+    return [job for job in jobs if job[0] not in result.rendered and job[0] not in result.failed]
+
+
+def run_export(compiled: CompiledTemplate, jobs: List[tuple], *,
+               parallel: bool = False,
+               image_cache: Optional[ImageCache] = None,
+               pdf_dir: Optional[Path] = None,
+               merged_pdf_name: Optional[str] = None,
+               stop_on_error: bool = False,
+               mp_context=None,
+               render_cache: Optional[RenderCache] = None,
+               combined_output: Optional[Path] = None,
+               answer_keys: Optional[List[tuple]] = None,
+               progress=None, file_ready=None, should_cancel=None) -> ExportResult:
+    """
+    Provede export bez vazby na GUI: vyrenderuje verze (jobs = [(index, cesta, náhrady, rich mapa)]),
+    volitelně je převede na PDF do pdf_dir a při více PDF je sloučí do merged_pdf_name.
+
+    Callbacky (všechny volitelné):
+     - progress(fáze, hotovo, celkem, text) – fáze 'docx' / 'keys' / 'combine' / 'pdf' / 'merge' (celkem 0 = neurčitý průběh),
+     - file_ready(druh, cesta) – druh 'docx' / 'pdf' pro každý vzniklý soubor,
+     - should_cancel() – zrušení se kontroluje mezi verzemi a mezi konverzemi; hotové soubory zůstávají.
+    S render_cache se verze (DOCX i PDF), které se od minula nezměnily, jen zkopírují z cache.
+    S combined_output jsou soubory verzí jen mezivýstup: složí se do jednoho DOCX (verze = sekce),
+    smažou se a na PDF se převádí jen tento jediný soubor (bez slučování PDF).
+    answer_keys = argumenty write_answer_key (viz answer_key_jobs); klíče vznikají ve stejném běhu
+    po verzích a jdou stejnou PDF konverzí, jen se neslučují s testy.
+    """
+    progress = progress or (lambda *a: None)
+    file_ready = file_ready or (lambda *a: None)
+    should_cancel = should_cancel or (lambda: False)
+    result = ExportResult()
+    count = len(jobs)
+
+    def on_rendered(i: int) -> None:
+        if i in result.rendered and combined_output is None:
+            file_ready("docx", str(result.rendered[i]))
+        done = len(result.rendered) + len(result.failed)
+        progress("docx", done, count, f"Generuji DOCX {done}/{count}...")
+
+    # --- CACHE: nezměněné verze se jen zkopírují ---
+    pending = jobs
+    if render_cache is not None:
+        pending = []
+        for job in jobs:
+            i, target_path, repl_plain, rich_map = job
+            key = render_cache.key(compiled, repl_plain, rich_map)
+            result.render_keys[i] = key
+            if render_cache.fetch(key, ".docx", target_path):
+                result.rendered[i] = target_path
+                result.cache_hits += 1
+                on_rendered(i)
+            else:
+                pending.append(job)
+
+    # --- RENDER VERZÍ ---
+    if parallel and len(pending) >= EXPORT_PARALLEL_MIN_VERSIONS and export_worker_count(len(pending)) > 1:
+        pending = _render_parallel(str(compiled.template_path), pending, result, image_cache, on_rendered, should_cancel,
+                                   mp_context, compiled.compresslevel)
+
+    for i, target_path, repl_plain, rich_map in pending:
+        if should_cancel():
+            result.cancelled = True
+            break
+        try:
+            compiled.render(target_path, repl_plain, rich_map)
+            result.rendered[i] = target_path
+        except Exception as e:
+            print(f"[ERROR] Verze {i+1}: {e}", file=sys.stderr)
+            result.failed[i] = str(e)
+            if stop_on_error:
+                return result
+        on_rendered(i)
+
+    if render_cache is not None:
+        for i, target_path in result.rendered.items():
+            if i in result.render_keys and not render_cache.path(result.render_keys[i], ".docx").exists():
+                render_cache.store(result.render_keys[i], ".docx", target_path)
+
+    # --- KLÍČE ODPOVĚDÍ ---
+    if answer_keys and result.rendered and not result.cancelled:
+        for idx, key_job in enumerate(answer_keys):
+            progress("keys", idx, len(answer_keys), "Generuji klíč odpovědí...")
+            try:
+                key_file = write_answer_key(*key_job)
+            except Exception as e:
+                print(f"[ERROR] Klíč odpovědí: {e}", file=sys.stderr)
+                result.key_errors.append(f"{Path(key_job[0]).name}: {e}")
+                continue
+            result.key_files.append(key_file)
+            file_ready("docx", str(key_file))
+
+    # --- SLOŽENÍ VERZÍ DO JEDNOHO DOCX ---
+    if combined_output is not None:
+        parts = result.docx_files
+        combined = False
+        if parts and not result.cancelled:
+            progress("combine", 0, len(parts), "Skládám verze do jednoho DOCX...")
+            try:
+                combined = combine_docx(parts, combined_output, progress, should_cancel)
+            except Exception as e:
+                print(f"[ERROR] Skládání verzí do jednoho DOCX: {e}", file=sys.stderr)
+                result.error = f"Verze se nepodařilo složit do jednoho DOCX:\n{e}"
+            result.cancelled = result.cancelled or (not combined and result.error is None)
+        for part in parts:
+            try:
+                part.unlink()
+            except OSError:
+                pass
+        if not combined:
+            result.rendered.clear()  # mezivýstupy bez složeného dokumentu nemají cenu
+            return result
+        result.combined_docx = Path(combined_output)
+        file_ready("docx", str(result.combined_docx))
+
+    if result.cancelled or pdf_dir is None or not result.rendered:
+        if render_cache is not None:
+            render_cache.prune()
+        return result
+
+    # --- PDF KONVERZE ---
+    if result.combined_docx is not None:
+        rendered_items = [(None, result.combined_docx)]  # jediná konverze pro celý balík
+    else:
+        rendered_items = sorted(result.rendered.items())
+    rendered_items += [(("key", n), key_file) for n, key_file in enumerate(result.key_files)]
+    progress("pdf", 0, len(rendered_items), "Převádím DOCX na PDF...")
+    lo_executable = find_libreoffice()
+    lo_missing = False
+    for idx, (i, docx_file) in enumerate(rendered_items):
+        if should_cancel():
+            result.cancelled = True
+            return result
+        progress("pdf", idx, len(rendered_items), f"PDF Konverze: {docx_file.name}")
+        key = result.render_keys.get(i)
+        pdf_path = docx_file.with_suffix('.pdf')
+        if isinstance(i, tuple):  # klíč odpovědí – jde do PDF zvlášť, neslučuje se s testy
+            if not lo_missing:
+                try:
+                    pdf_file = convert_docx_to_pdf(docx_file, lo_executable)
+                except ExportError as e:
+                    result.pdf_errors.append(str(e))
+                    lo_missing = lo_executable is None
+                    continue
+                if pdf_file and pdf_file.exists():
+                    result.key_pdfs.append(pdf_file)
+                    result.pdf_sources.add(docx_file)
+        elif key and render_cache.fetch(key, ".pdf", pdf_path):
+            result.pdf_files.append(pdf_path)
+            result.pdf_sources.add(docx_file)
+        elif not lo_missing:
+            try:
+                pdf_file = convert_docx_to_pdf(docx_file, lo_executable)
+            except ExportError as e:
+                result.pdf_errors.append(str(e))
+                lo_missing = lo_executable is None  # bez LibreOffice nemá smysl zkoušet další soubory
+                continue
+            if pdf_file and pdf_file.exists():
+                result.pdf_files.append(pdf_file)
+                result.pdf_sources.add(docx_file)
+                if key:
+                    render_cache.store(key, ".pdf", pdf_file)
+        progress("pdf", idx + 1, len(rendered_items), f"PDF Konverze: {docx_file.name}")
+    if render_cache is not None:
+        render_cache.prune()
+
+    if result.key_pdfs:
+        pdf_dir = Path(pdf_dir)
+        pdf_dir.mkdir(parents=True, exist_ok=True)
+        moved = []
+        for key_pdf in result.key_pdfs:
+            dest = pdf_dir / key_pdf.name
+            try:
+                shutil.move(str(key_pdf), str(dest))
+            except OSError as e:
+                result.key_errors.append(f"{key_pdf.name}: {e}")
+                result.pdf_sources.discard(key_pdf.with_suffix(".docx"))  # bez PDF -> DOCX zachránit
+                continue
+            moved.append(dest)
+            file_ready("pdf", str(dest))
+        result.key_pdfs = moved
+
+    if not result.pdf_files:
+        return result
+
+    # --- SLOUČENÍ / PŘESUN DO SLOŽKY PRO TISK ---
+    if should_cancel():
+        result.cancelled = True
+        return result
+    pdf_dir = Path(pdf_dir)
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    if merged_pdf_name and len(result.pdf_files) > 1:
+        progress("merge", 0, 0, "Slučuji PDF soubory...")
+        final_pdf = pdf_dir / merged_pdf_name
+        if merge_pdfs(result.pdf_files, final_pdf, cleanup=True):
+            result.final_pdf = final_pdf
+            result.merged = True
+            file_ready("pdf", str(final_pdf))
+        else:
+            result.merge_failed = True
+            moved = []
+            for tmp_pdf in result.pdf_files:
+                if tmp_pdf.exists():
+                    try:
+                        dest = pdf_dir / tmp_pdf.name
+                        shutil.move(str(tmp_pdf), str(dest))
+                        moved.append(dest)
+                        file_ready("pdf", str(dest))
+                    except Exception:
+                        pass
+            result.pdf_files = moved
+    else:
+        final_pdf = pdf_dir / result.pdf_files[0].name
+        shutil.move(str(result.pdf_files[0]), str(final_pdf))
+        result.final_pdf = final_pdf
+        result.pdf_files = [final_pdf]
+        file_ready("pdf", str(final_pdf))
+    return result
+
+
+# ---- Export pro seznam studentů (CSV) ----
+
+ROSTER_CHUNK_SIZE = 100         # studentů v jedné dávce (render → zip → složený DOCX → jedno PDF)
+_ROSTER_NAME_COLUMNS = ("student", "jmeno a prijmeni", "prijmeni a jmeno", "cele jmeno", "name", "full name")
+_ROSTER_FIRST_COLUMNS = ("jmeno", "krestni jmeno", "first name", "firstname")
+_ROSTER_LAST_COLUMNS = ("prijmeni", "last name", "lastname", "surname")
+_ROSTER_ID_COLUMNS = ("studentid", "id", "uco", "osobni cislo", "login", "cislo studenta", "student id")
+
+
+def _fold_header(name: str) -> str:
+    """Název sloupce bez diakritiky a velikosti písmen (Příjmení -> prijmeni)."""
+    folded = unicodedata.normalize("NFKD", name.strip().lower())
+    return " ".join("".join(ch for ch in folded if not unicodedata.combining(ch)).replace("_", " ").split())
+
+
+def roster_student(row: Dict[str, str]) -> Tuple[str, str]:
+    """(jméno, identifikátor) studenta z řádku CSV podle obvyklých názvů sloupců."""
+    by_fold = {_fold_header(k): (v or "").strip() for k, v in row.items() if k}
+    name = next((by_fold[c] for c in _ROSTER_NAME_COLUMNS if by_fold.get(c)), "")
+    if not name:
+        first = next((by_fold[c] for c in _ROSTER_FIRST_COLUMNS if by_fold.get(c)), "")
+        last = next((by_fold[c] for c in _ROSTER_LAST_COLUMNS if by_fold.get(c)), "")
+        name = f"{first} {last}".strip()
+    sid = next((by_fold[c] for c in _ROSTER_ID_COLUMNS if by_fold.get(c)), "")
+    return name, sid
+
+
+def _roster_reader(f):
+    sample = f.read(4096)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+    except csv.Error:
+        dialect = csv.excel
+    return csv.DictReader(f, dialect=dialect)
+
+
+def count_roster(path) -> int:
+    """Počet studentů (neprázdných řádků) v CSV – jeden rychlý průchod bez držení dat."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return sum(1 for row in _roster_reader(f) if any((v or "").strip() for v in row.values() if isinstance(v, str)))
+
+
+def iter_roster(path):
+    """
+    Prochází seznam studentů (CSV, oddělovač ; , nebo tab, UTF-8 i s BOM) po řádcích.
+    Každý řádek dostane navíc klíče Student a StudentID (viz roster_student).
+    """
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in _roster_reader(f):
+            row = {k.strip(): (v or "").strip() for k, v in row.items() if k and isinstance(v, str)}
+            if not any(row.values()):
+                continue
+            name, sid = roster_student(row)
+            row.setdefault("Student", name)
+            row.setdefault("StudentID", sid)
+            yield row
+
+
+def roster_output_paths(base_output_path, pdf_dir=None) -> Tuple[Path, Path]:
+    """(zip archiv s testy studentů, sloučené PDF pro tisk) odvozené od zvoleného výstupu."""
+    p = Path(base_output_path)
+    archive = p.with_name(f"{p.stem}_studenti.zip")
+    pdf = Path(pdf_dir) / f"{p.stem}_studenti.pdf" if pdf_dir is not None else p.with_name(f"{p.stem}_studenti.pdf")
+    return archive, pdf
+
+
+def roster_file_stem(index: int, row: Dict[str, str]) -> str:
+    """Název souboru studenta v archivu: 001_Jan_Novak (jen bezpečné znaky)."""
+    label = row.get("Student") or row.get("StudentID") or "student"
+    folded = unicodedata.normalize("NFKD", label)
+    safe = "".join(ch for ch in folded if not unicodedata.combining(ch))
+    safe = re.sub(r"[^A-Za-z0-9._-]+", "_", safe).strip("_") or "student"
+    return f"{index + 1:03d}_{safe[:60]}"
+
+
+@dataclass
+class RosterResult:
+    """Výsledek run_roster_export (archiv, sloučené PDF, chyby podle pořadí studenta)."""
+    total: int = 0
+    rendered: int = 0
+    failed: Dict[int, str] = field(default_factory=dict)
+    archive: Optional[Path] = None
+    final_pdf: Optional[Path] = None
+    pdf_errors: List[str] = field(default_factory=list)
+    merge_failed: bool = False
+    history: List[Tuple[str, str]] = field(default_factory=list)   # (soubor v archivu, hash) pro historii
+    cancelled: bool = False
+    error: Optional[str] = None
+
+    @property
+    def docx_files(self) -> List[Path]:
+        return [self.archive] if self.archive is not None and self.rendered else []
+
+
+def run_roster_export(compiled: "CompiledTemplate", entries, total: int, archive_path, *,
+                      pdf_path=None, chunk_size: int = ROSTER_CHUNK_SIZE,
+                      image_cache: Optional[ImageCache] = None,
+                      render_cache: Optional[RenderCache] = None,
+                      mp_context=None, parallel: bool = True,
+                      manifest: Optional[dict] = None,
+                      progress=None, file_ready=None, should_cancel=None) -> RosterResult:
+    """
+    Export jednoho testu na studenta. entries je iterátor (název souboru, náhrady, rich mapa, metadata)
+    a čte se po dávkách chunk_size, takže paměť nezávisí na velikosti třídy:
+    dávka se vyrenderuje (run_export), soubory se hned přidají do zip archivu,
+    při PDF se dávka složí do jednoho DOCX (combine_docx) a převede jedinou konverzí.
+    PDF dávek se nakonec sloučí do pdf_path. Metadata studentů jdou do manifest.json v archivu.
+    """
+    progress = progress or (lambda *a: None)
+    file_ready = file_ready or (lambda *a: None)
+    should_cancel = should_cancel or (lambda: False)
+    result = RosterResult(total=total)
+    archive_path = Path(archive_path)
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    work_dir = intermediate_dir("ceg_roster_")
+    chunk_pdfs: List[Path] = []
+    students_meta: List[dict] = []
+    lo_executable = find_libreoffice() if pdf_path is not None else None
+    try:
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            it = iter(entries)
+            start = 0
+            while True:
+                if should_cancel():
+                    result.cancelled = True
+                    break
+                chunk = []
+                for stem, repl_plain, rich_map, meta in it:
+                    chunk.append((start + len(chunk), work_dir / f"{stem}.docx", repl_plain, rich_map, meta))
+                    if len(chunk) >= chunk_size:
+                        break
+                if not chunk:
+                    break
+
+                def chunk_progress(stage, done, _total, _text, base=start):
+                    if stage == "docx":
+                        progress("docx", base + done, total, f"Generuji testy studentů {base + done}/{total}...")
+
+                part = run_export(compiled, [c[:4] for c in chunk], parallel=parallel, image_cache=image_cache,
+                                  mp_context=mp_context, render_cache=render_cache,
+                                  progress=chunk_progress, should_cancel=should_cancel)
+                result.failed.update(part.failed)
+                for i, docx_file in sorted(part.rendered.items()):
+                    meta = chunk[i - start][4]
+                    zf.write(docx_file, docx_file.name)
+                    meta = dict(meta, output=docx_file.name, render_key=part.render_keys.get(i))
+                    students_meta.append(meta)
+                    result.history.append((docx_file.name, meta.get("hash", "")))
+                    result.rendered += 1
+                if part.cancelled:
+                    result.cancelled = True
+
+                files = part.docx_files
+                if pdf_path is not None and files and not result.cancelled and lo_executable is not None:
+                    chunk_docx = work_dir / f"davka_{len(chunk_pdfs) + 1:04d}.docx"
+                    label = f"studenti {start + 1}–{start + len(chunk)}"
+                    progress("pdf", start, total, f"PDF Konverze: {label}")
+                    try:
+                        combine_docx(files, chunk_docx)
+                        chunk_pdf = convert_docx_to_pdf(chunk_docx, lo_executable)
+                        if chunk_pdf is not None and Path(chunk_pdf).exists():
+                            chunk_pdfs.append(Path(chunk_pdf))
+                        else:
+                            result.pdf_errors.append(f"{label}: LibreOffice nevytvořil PDF.")
+                    except Exception as e:
+                        result.pdf_errors.append(f"{label}: {e}")
+                    _cleanup_temp(str(chunk_docx))
+                for docx_file in files:
+                    _cleanup_temp(str(docx_file))
+                start += len(chunk)
+                if result.cancelled:
+                    break
+
+            if manifest is not None:
+                data = dict(manifest, manifest_version=MANIFEST_VERSION, created=datetime.now().isoformat(),
+                            template=str(compiled.template_path), template_hash=compiled.template_hash,
+                            students=students_meta)
+                zf.writestr("manifest.json", json.dumps(data, indent=2, ensure_ascii=False))
+
+        result.archive = archive_path
+        file_ready("archive", str(archive_path))
+
+        if pdf_path is not None and lo_executable is None:
+            result.pdf_errors.append("LibreOffice nebyl nalezen – PDF pro tisk nevzniklo.")
+        if chunk_pdfs and not result.cancelled:
+            pdf_path = Path(pdf_path)
+            pdf_path.parent.mkdir(parents=True, exist_ok=True)
+            if len(chunk_pdfs) == 1:
+                shutil.move(str(chunk_pdfs[0]), str(pdf_path))
+                result.final_pdf = pdf_path
+            else:
+                progress("merge", 0, 0, "Slučuji PDF soubory...")
+                if merge_pdfs(chunk_pdfs, pdf_path, cleanup=True):
+                    result.final_pdf = pdf_path
+                else:
+                    result.merge_failed = True
+                    for n, chunk_pdf in enumerate(chunk_pdfs, 1):  # PDF dávek zachovat vedle cíle
+                        if chunk_pdf.exists():
+                            shutil.move(str(chunk_pdf), str(pdf_path.with_name(f"{pdf_path.stem}_{n:03d}.pdf")))
+            if result.final_pdf is not None:
+                file_ready("pdf", str(result.final_pdf))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+# ---- Výběr otázek pro verze (hromadný export) ----
+
+def _numpy():
+    """NumPy je volitelný – bez něj běží stejný algoritmus v čistém Pythonu."""
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+@dataclass
+class VersionSample:
+    """Výběr otázek pro všechny verze (řádek = verze, sloupec = placeholder) a dosažené statistiky."""
+    rows: List[list] = field(default_factory=list)
+    seed: Optional[int] = None
+    max_overlap: Optional[int] = 0   # nejvíc společných otázek mezi dvěma verzemi (None = neměřeno)
+    mean_overlap: float = 0.0     # průměr přes všechny dvojice verzí
+    usage_min: int = 0            # v kolika verzích je nejméně / nejvíce použitá otázka z poolu
+    usage_max: int = 0
+    cap_violations: int = 0       # verze, u kterých se limit překryvu nepodařilo dodržet
+    with_replacement: bool = False
+    backend: str = "python"
+
+    def summary(self) -> str:
+        if not self.rows or not self.rows[0]:
+            return "bez výběru"
+        peak = f"max {self.max_overlap}, " if self.max_overlap is not None else ""
+        text = (f"překryv verzí {peak}průměr {self.mean_overlap:.2f}; "
+                f"využití otázek {self.usage_min}–{self.usage_max}×; seed {self.seed}")
+        if self.with_replacement:
+            text += "; málo otázek – vybíráno s opakováním"
+        if self.cap_violations:
+            text += f"; limit překryvu nedodržen u {self.cap_violations} verzí"
+        return text
+
+
+def _deck_rows(n: int, needed: int, versions: int, seed: int, np) -> List[List[int]]:
+    """
+    Celá matice výběru najednou: zamíchané permutace poolu za sebou („balíček karet“)
+    rozřezané po `needed`. Každá otázka se tak použije stejněkrát (±1).
+    Duplicitu v řádku může způsobit jen přechod mezi permutacemi – ta se opraví nejméně použitou otázkou.
+    """
+    total = versions * needed
+    k = -(-total // n)
+    if np is not None:
+        rng = np.random.default_rng(seed)
+        mat = rng.permuted(np.tile(np.arange(n), (k, 1)), axis=1).ravel()[:total].reshape(versions, needed)
+        srt = np.sort(mat, axis=1)
+        bad = np.nonzero((srt[:, 1:] == srt[:, :-1]).any(axis=1))[0].tolist() if needed > 1 else []
+        rows = mat.tolist()
+        usage = np.bincount(mat.ravel(), minlength=n).tolist()
+        pick = random.Random(seed)
+    else:
+        pick = random.Random(seed)
+        deck: List[int] = []
+        for _ in range(k):
+            perm = list(range(n))
+            pick.shuffle(perm)
+            deck.extend(perm)
+        rows = [deck[i * needed:(i + 1) * needed] for i in range(versions)]
+        usage = [0] * n
+        for q in deck[:total]:
+            usage[q] += 1
+        bad = [i for i, row in enumerate(rows) if len(set(row)) < needed]
+
+    for i in bad:
+        row = rows[i]
+        seen = set()
+        for pos, q in enumerate(row):
+            if q in seen:
+                free = [c for c in range(n) if c not in seen and c not in row[pos + 1:]]
+                low = min(usage[c] for c in free)
+                repl = pick.choice([c for c in free if usage[c] == low])
+                usage[q] -= 1
+                usage[repl] += 1
+                row[pos] = repl
+                q = repl
+            seen.add(q)
+    return rows
+
+
+def sample_versions(pool: List, needed: int, versions: int, seed: Optional[int] = None,
+                    max_overlap: Optional[int] = None, attempts: int = 40) -> VersionSample:
+    """
+    Vybere otázky pro všechny verze najednou (verze × placeholdery).
+
+    - rovnoměrné využití: otázky se berou z „balíčku“ zamíchaných permutací poolu,
+    - max_overlap: nejvýše tolik společných otázek smí mít libovolné dvě verze; verze, která limit
+      překročí, se přelosuje z nejméně použitých otázek (nejlepší pokus se ponechá),
+    - seed: stejný seed + stejný pool = stejný výběr (s NumPy a bez něj se výsledky liší).
+    Pokud je v poolu méně otázek, než je potřeba, vybírá se s opakováním (jako dřív random.choice).
+    NumPy (je-li k dispozici) zrychlí jen losování balíčku; překryv se počítá jen s limitem,
+    přes invertovaný index otázka -> verze. Bez limitu se max. překryv neměří (max_overlap = None).
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    result = VersionSample(seed=seed)
+    pool = list(pool)
+    n = len(pool)
+    if needed <= 0 or versions <= 0 or n == 0:
+        result.rows = [[] for _ in range(max(0, versions))]
+        return result
+
+    np = _numpy()
+    result.backend = "numpy" if np is not None else "python"
+    rng = random.Random(seed)
+    if n < needed:
+        result.with_replacement = True
+        rows = [[rng.randrange(n) for _ in range(needed)] for _ in range(versions)]
+        cap = None
+    else:
+        rows = _deck_rows(n, needed, versions, seed, np)
+        cap = max_overlap if max_overlap is not None and 0 <= max_overlap < needed else None
+
+    usage = [0] * n            # počet verzí, ve kterých otázka je
+    worst_all = 0
+    # Překryv se hlídá jen s limitem: invertovaný index otázka -> verze (oba backendy stejně)
+    # a otázky rozdělené podle využití, aby přelosování nemuselo pokaždé třídit celý pool.
+    holders: List[List[int]] = [[] for _ in range(n)] if cap is not None else []
+    tiers: List[List[int]] = [list(range(n))] if cap is not None else []
+    slot = list(range(n)) if cap is not None else []
+
+    def overlap_with_previous(qs) -> int:
+        counts = Counter()
+        for q in qs:
+            counts.update(holders[q])
+        return max(counts.values()) if counts else 0
+
+    def least_used(k: int) -> List[int]:
+        """k náhodných otázek z nejméně použitých (po vrstvách využití)."""
+        cand: List[int] = []
+        for tier in tiers:
+            rest = k - len(cand)
+            cand.extend(tier if len(tier) <= rest else rng.sample(tier, rest))
+            if len(cand) >= k:
+                break
+        return cand
+
+    def commit(i: int, qs) -> None:
+        for q in qs:
+            holders[q].append(i)
+            # přesun otázky o vrstvu výš (swap-remove, O(1))
+            tier, pos = tiers[usage[q]], slot[q]
+            tier[pos] = tier[-1]
+            slot[tier[pos]] = pos
+            tier.pop()
+            if usage[q] + 1 == len(tiers):
+                tiers.append([])
+            slot[q] = len(tiers[usage[q] + 1])
+            tiers[usage[q] + 1].append(q)
+
+    failed_in_row = 0
+    for i in range(versions):
+        qs = set(rows[i])
+        if cap is not None:
+            worst = overlap_with_previous(qs)
+            if worst > cap:
+                # Přelosování: náhodně mezi nejméně použitými otázkami, ponecháme nejlepší pokus.
+                # Když limit opakovaně nejde dodržet (nesplnitelný), zkoušíme už jen pár pokusů.
+                best_row, best_worst = rows[i], worst
+                for _ in range(attempts if failed_in_row < 10 else 2):
+                    cand = least_used(needed)
+                    rng.shuffle(cand)
+                    cand_worst = overlap_with_previous(cand)
+                    if cand_worst < best_worst:
+                        best_row, best_worst = cand, cand_worst
+                        if cand_worst <= cap:
+                            break
+                rows[i], worst = best_row, best_worst
+                qs = set(best_row)
+                if worst > cap:
+                    result.cap_violations += 1
+                    failed_in_row += 1
+                else:
+                    failed_in_row = 0
+            commit(i, qs)
+            worst_all = max(worst_all, worst)
+        for q in qs:
+            usage[q] += 1
+
+    pairs = versions * (versions - 1) / 2
+    result.max_overlap = worst_all if cap is not None else None
+    result.mean_overlap = (sum(u * (u - 1) / 2 for u in usage) / pairs) if pairs else 0.0
+    result.usage_min, result.usage_max = min(usage), max(usage)
+    result.rows = [[pool[j] for j in row] for row in rows]
+    return result
+
+
+# ---- Skládání verzí podle omezení (témata, body, bonusy) ----
+
+@dataclass
+class AssemblyConstraints:
+    """Omezení hromadného výběru; výchozí hodnoty = žádná omezení (čisté sample_versions)."""
+    one_per_subgroup: bool = False   # každá klasická otázka verze z jiné podskupiny
+    target_points: int = 0           # součet `points` klasických otázek verze (0 = bez cíle)
+    equal_bonus: bool = False        # stejná hodnota bonusů (správně / špatně) ve všech verzích
+
+    @property
+    def classic(self) -> bool:
+        return self.one_per_subgroup or self.target_points > 0
+
+
+@dataclass
+class AssemblyReport:
+    """Co solver (assemble_versions) splnit nemohl: omezení vzdaná předem a verze, kde se nepovedlo."""
+    impossible: List[str] = field(default_factory=list)
+    violations: Counter = field(default_factory=Counter)   # popis omezení -> počet verzí
+    target_points: int = 0
+    bonus_value: Optional[Tuple[float, float]] = None
+    elapsed: float = 0.0
+
+    def summary(self) -> str:
+        parts = []
+        if self.target_points:
+            parts.append(f"součet bodů {self.target_points}")
+        if self.bonus_value is not None:
+            parts.append(f"bonusy +{self.bonus_value[0]:.2f} / {self.bonus_value[1]:.2f}")
+        parts.extend(f"{label}: nesplněno u {n} verzí" for label, n in self.violations.items())
+        parts.extend(self.impossible)
+        return "; ".join(parts)
+
+
+def _sums_reachable(groups: List[List[int]], needed: int) -> List[int]:
+    """
+    Bitové masky součtů, které jde složit z právě k položek (k = 0..needed), nejvýš jedné z každé
+    skupiny (skupina = hodnoty bodů otázek jedné podskupiny, u „bez témat“ jedna hodnota na otázku).
+    """
+    reach = [0] * (needed + 1)
+    reach[0] = 1
+    for values in groups:
+        for c in range(needed - 1, -1, -1):
+            if reach[c]:
+                add = 0
+                for p in values:
+                    add |= reach[c] << p
+                reach[c + 1] |= add
+    return reach
+
+
+def _round_robin(buckets: Dict[object, List[str]], ptr: Dict[object, int], key, in_row: set) -> Optional[str]:
+    """Další otázka z koše (rovnoměrné využití), která ve verzi ještě není."""
+    bucket = buckets[key]
+    for _ in range(len(bucket)):
+        qid = bucket[ptr[key] % len(bucket)]
+        ptr[key] += 1
+        if qid not in in_row:
+            return qid
+    return None
+
+
+def _solve_classic(pool: List[str], needed: int, versions: int, rng: random.Random, lookup,
+                   topics: Dict[str, str], constraints: AssemblyConstraints,
+                   report: AssemblyReport) -> List[List[str]]:
+    points = {qid: int(getattr(lookup(qid), "points", 1) or 0) for qid in pool}
+    per_topic = constraints.one_per_subgroup
+    by_topic: Dict[object, Dict[int, List[str]]] = {}
+    for qid in pool:
+        by_topic.setdefault(topics.get(qid, "") if per_topic else None, {}).setdefault(points[qid], []).append(qid)
+    if per_topic and len(by_topic) < needed:
+        report.impossible.append(f"jedna otázka na podskupinu nejde: {len(by_topic)} podskupin pro {needed} otázek")
+        per_topic = False
+        by_topic = {None: {}}
+        for qid in pool:
+            by_topic[None].setdefault(points[qid], []).append(qid)
+
+    target = constraints.target_points
+    reach: List[int] = []
+    if target > 0:
+        if per_topic:
+            groups = [sorted(vals) for vals in by_topic.values()]
+        else:
+            groups = [[p] for p, ids in by_topic[None].items() for _ in range(min(len(ids), needed))]
+        reach = _sums_reachable(groups, needed)
+        mask = reach[needed]
+        if not (mask >> target) & 1:
+            sums = [s for s in range(mask.bit_length()) if (mask >> s) & 1]
+            nearest = min(sums, key=lambda s: (abs(s - target), s)) if sums else 0
+            report.impossible.append(f"součet {target} b. nejde složit z {needed} otázek "
+                                     f"(možné {sums[0] if sums else 0}–{sums[-1] if sums else 0}), použito {nearest}")
+            target = nearest
+    report.target_points = target if constraints.target_points > 0 else 0
+
+    buckets: Dict[tuple, List[str]] = {}
+    for t, by_points in by_topic.items():
+        for p, ids in by_points.items():
+            ids = list(ids)
+            rng.shuffle(ids)
+            buckets[(t, p)] = ids
+    ptr = {key: 0 for key in buckets}
+    # Meze pro kontrolu proveditelnosti zbytku: nejmenší/největší body v tématu
+    t_min = sorted((min(v), t) for t, v in by_topic.items())
+    t_max = sorted(((max(v), t) for t, v in by_topic.items()), reverse=True)
+
+    def feasible(k: int, rest: int, used_topics: set) -> bool:
+        # přesná dosažitelnost (bez ohledu na už použitá témata) + meze se zbylými tématy
+        if k == 0:
+            return rest == 0
+        if rest < 0 or not (reach[k] >> rest) & 1:
+            return False
+        if not per_topic:
+            return True
+        lo = [p for p, t in t_min if t not in used_topics][:k]
+        hi = [p for p, t in t_max if t not in used_topics][:k]
+        return len(lo) == k and sum(lo) <= rest <= sum(hi)
+
+    topic_usage: Counter = Counter()
+    rows: List[List[str]] = []
+    label_points = f"součet {target} b."
+    label_topics = "jedna otázka na podskupinu"
+    for _v in range(versions):
+        best: Optional[List[str]] = None
+        for _attempt in range(8 if target > 0 else 1):
+            row: List[str] = []
+            in_row: set = set()
+            used_topics: set = set()
+            order = sorted(by_topic, key=lambda t: topic_usage[t] + rng.random()) if per_topic else [None]
+            rest = target
+            for slot in range(needed):
+                k_after = needed - slot - 1
+                choice = None
+                for t in order:
+                    if per_topic and t in used_topics:
+                        continue
+                    values = list(by_topic[t])
+                    # náhodně, ale úměrně velikosti koše (rozložení bodů ve verzích kopíruje pool)
+                    values.sort(key=lambda p: -len(by_topic[t][p]) * rng.random())
+                    for p in values:
+                        if target > 0 and not feasible(k_after, rest - p, used_topics | {t}):
+                            continue
+                        qid = _round_robin(buckets, ptr, (t, p), in_row)
+                        if qid is not None:
+                            choice = (t, p, qid)
+                            break
+                    if choice is not None:
+                        break
+                if choice is None and target > 0:
+                    # cíl už nejde trefit – verze se dokončí otázkou s body nejblíž zbývajícímu průměru
+                    for t in order:
+                        if per_topic and t in used_topics:
+                            continue
+                        for p in sorted(by_topic[t], key=lambda p: abs(rest - p * (k_after + 1))):
+                            qid = _round_robin(buckets, ptr, (t, p), in_row)
+                            if qid is not None:
+                                choice = (t, p, qid)
+                                break
+                        if choice is not None:
+                            break
+                if choice is None:
+                    break
+                t, p, qid = choice
+                row.append(qid)
+                in_row.add(qid)
+                if per_topic:
+                    used_topics.add(t)
+                rest -= p
+            if len(row) == needed and (target <= 0 or rest == 0):
+                best = row
+                break
+            if best is None or len(row) > len(best):
+                best = row
+        if target > 0 and sum(points[q] for q in best) != target:
+            report.violations[label_points] += 1
+        if len(best) < needed:
+            report.violations[label_topics if per_topic else "málo otázek"] += 1
+            fill = [qid for qid in pool if qid not in best]
+            best = best + [rng.choice(fill or pool) for _ in range(needed - len(best))]
+        if per_topic:
+            topic_usage.update(topics.get(q, "") for q in best)
+        rows.append(best)
+    return rows
+
+
+def _solve_bonus(pool: List[str], needed: int, versions: int, rng: random.Random, lookup,
+                 report: AssemblyReport) -> Optional[List[List[str]]]:
+    """Bonusy se stejnou hodnotou (součet bonus_correct i bonus_wrong) ve všech verzích."""
+    classes: Dict[Tuple[float, float], List[str]] = {}
+    for qid in pool:
+        q = lookup(qid)
+        key = (round(float(getattr(q, "bonus_correct", 0.0) or 0.0), 2),
+               round(float(getattr(q, "bonus_wrong", 0.0) or 0.0), 2))
+        classes.setdefault(key, []).append(qid)
+    keys = sorted(classes)
+    # Skladby (multimnožiny tříd hodnot) se stejným součtem; vybere se součet s největší kapacitou
+    by_total: Dict[Tuple[float, float], List[tuple]] = {}
+    capacity: Counter = Counter()
+    combos = itertools.combinations_with_replacement(range(len(keys)), needed)
+    for combo in itertools.islice(combos, 200000):
+        counts = Counter(combo)
+        cap = min(len(classes[keys[c]]) // m for c, m in counts.items())
+        if cap <= 0:
+            continue
+        total = (round(sum(keys[c][0] for c in combo), 2), round(sum(keys[c][1] for c in combo), 2))
+        by_total.setdefault(total, []).append(combo)
+        capacity[total] += cap
+    if not by_total:
+        report.impossible.append(f"stejná hodnota bonusů nejde: v poolu je {len(pool)} bonusů pro {needed} míst")
+        return None
+    total = max(capacity, key=lambda t: (capacity[t], t))
+    report.bonus_value = total
+    buckets = {}
+    for c in range(len(keys)):
+        ids = list(classes[keys[c]])
+        rng.shuffle(ids)
+        buckets[c] = ids
+    ptr = {c: 0 for c in buckets}
+    options = by_total[total]
+    rows = []
+    for v in range(versions):
+        combo = options[v % len(options)]
+        row, in_row = [], set()
+        for c in combo:
+            qid = _round_robin(buckets, ptr, c, in_row)
+            row.append(qid)
+            in_row.add(qid)
+        rng.shuffle(row)
+        rows.append(row)
+    return rows
+
+
+def _sample_stats(result: VersionSample, pool: List[str]) -> VersionSample:
+    """Překryv a využití otázek pro výběr, který nevznikl v sample_versions."""
+    holders: Dict[str, List[int]] = {}
+    worst = 0
+    for i, row in enumerate(result.rows):
+        counts: Counter = Counter()
+        for qid in set(row):
+            counts.update(holders.get(qid, ()))
+            holders.setdefault(qid, []).append(i)
+        if counts:
+            worst = max(worst, max(counts.values()))
+    versions = len(result.rows)
+    usage = [len(holders.get(qid, ())) for qid in pool] or [0]
+    pairs = versions * (versions - 1) / 2
+    result.max_overlap = worst
+    result.mean_overlap = (sum(u * (u - 1) / 2 for u in usage) / pairs) if pairs else 0.0
+    result.usage_min, result.usage_max = min(usage), max(usage)
+    return result
+
+
+def assemble_versions(pool: List[str], bonus_pool: List[str], needed: int, needed_bonus: int, versions: int,
+                      lookup, topics: Dict[str, str], constraints: AssemblyConstraints,
+                      seed: Optional[int] = None, max_overlap: Optional[int] = None
+                      ) -> Tuple[VersionSample, VersionSample, AssemblyReport]:
+    """
+    Výběr otázek pro verze s omezeními (AssemblyConstraints) nad předpočítanými pooly.
+    Klasické otázky skládá hladový solver: koše podle (podskupina, body) s rovnoměrným
+    round-robin výběrem, zbytek verze se průběžně ověřuje mezemi dosažitelného součtu.
+    Dosažitelnost cílového součtu se předem spočítá přesně (bitová maska součtů).
+    Bonusy mají ve všech verzích stejný součet bodů. Co splnit nejde, se povolí a uvede v reportu.
+    Bez aktivního omezení se příslušná část vybere přes sample_versions (i s limitem překryvu).
+    """
+    t0 = time.perf_counter()
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    report = AssemblyReport()
+    if constraints.classic and needed > 0 and pool:
+        rng = random.Random(seed)
+        sample_q = _sample_stats(VersionSample(
+            rows=_solve_classic(list(pool), needed, versions, rng, lookup, topics, constraints, report),
+            seed=seed, backend="solver"), pool)
+    else:
+        sample_q = sample_versions(pool, needed, versions, seed=seed, max_overlap=max_overlap)
+    rows_b = None
+    if constraints.equal_bonus and needed_bonus > 0 and bonus_pool:
+        rows_b = _solve_bonus(list(bonus_pool), needed_bonus, versions, random.Random(seed + 1), lookup, report)
+    if rows_b is not None:
+        sample_b = _sample_stats(VersionSample(rows=rows_b, seed=seed + 1, backend="solver"), bonus_pool)
+    else:
+        sample_b = sample_versions(bonus_pool, needed_bonus, versions, seed=seed + 1)
+    report.elapsed = time.perf_counter() - t0
+    return sample_q, sample_b, report
+
+
+def constraint_key(constraints: AssemblyConstraints, lookup, topics: Dict[str, str]):
+    """Klíč otázky, který musí náhrada zachovat, aby verze dál splňovala omezení (None = bez omezení)."""
+    if not (constraints.classic or constraints.equal_bonus):
+        return None
+
+    def key(qid):
+        q = lookup(qid)
+        if q is None:
+            return None
+        if getattr(q, "type", "classic") == "bonus":
+            if not constraints.equal_bonus:
+                return ("bonus",)
+            return ("bonus", round(float(q.bonus_correct or 0.0), 2), round(float(q.bonus_wrong or 0.0), 2))
+        return ("classic",
+                topics.get(qid, "") if constraints.one_per_subgroup else None,
+                int(getattr(q, "points", 1) or 0) if constraints.target_points > 0 else None)
+    return key
+
+
+# ---- Odhad počtu stránek verze (bez LibreOffice) ----
+
+_PT_PER_CM = 72.0 / 2.54
+_EMU_PER_PT = 12700
+# Empirické konstanty sazby: průměrná šířka znaku a výška řádku vůči velikosti písma,
+# odsazení jedné úrovně seznamu a poměr výška/šířka obrázku, když je zadaná jen šířka.
+_CHAR_WIDTH = 0.5
+_LINE_HEIGHT = 1.2
+_INDENT_PT = 18.0
+_IMAGE_RATIO = 0.75
+
+
+def _font_pt(rPr) -> Optional[float]:
+    """Velikost písma v pt přímo z atributu w:sz/@w:val (půlbody) nebo None."""
+    sz = rPr.find(qn("w:sz")) if rPr is not None else None
+    value = sz.get(qn("w:val")) if sz is not None else None
+    return int(value) / 2.0 if value and value.isdigit() else None
+
+
+class PageEstimator:
+    """
+    Rychlý odhad počtu stránek verze z geometrie stránky šablony, bez konverze do PDF.
+
+    Tělo šablony se při vytvoření jednou rozloží na bloky (odstavce, řádky tabulek, zalomení
+    stránek). Za blokové placeholdery otázek se při odhadu dosadí výška otázky: řádky odstavců
+    z AST (délka textu × šířka znaku vůči šířce sazby, písmo placeholderu) a obrázek podle
+    image_width_cm / image_height_cm. Text se může rozdělit mezi stránky, obrázek a řádek tabulky ne.
+    Odhad je hrubý, ale stejný pro všechny verze – hodí se k porovnání a vyrovnání délky verzí.
+    """
+
+    def __init__(self, compiled: "CompiledTemplate") -> None:
+        doc = compiled._doc
+        section = doc.sections[0]
+
+        def pt(value, default: float) -> float:
+            return value / _EMU_PER_PT if value else default
+
+        page_h = pt(section.page_height, 29.7 * _PT_PER_CM)
+        page_w = pt(section.page_width, 21.0 * _PT_PER_CM)
+        self.usable_height = max(72.0, page_h - pt(section.top_margin, 72.0) - pt(section.bottom_margin, 72.0))
+        self.usable_width = max(72.0, page_w - pt(section.left_margin, 72.0) - pt(section.right_margin, 72.0))
+        self._styles = doc.styles.element
+        self.font_pt, self.space_after, self.line_factor = self._defaults()
+        self._slots = {slot.base_p: slot for slot in compiled._slots if slot.part is compiled._doc_part}
+        # ("fixed", výška, dělitelné) | ("slot", klíč, písmo, šířka) | ("table", [[[položky buňky], ...], ...])
+        # | ("break",)
+        self._layout: List[tuple] = []
+        self._units_cache: Dict[tuple, List[tuple]] = {}
+        for child in doc.element.body.iterchildren():
+            if child.tag == qn("w:p"):
+                self._layout.extend(self._paragraph_items(child, self.usable_width))
+            elif child.tag == qn("w:tbl"):
+                self._layout.append(self._table_item(child))
+        first_slot = next(self._iter_slots(self._layout), None)
+        self.question_font = first_slot[2] if first_slot is not None else self.font_pt
+
+    # -- Šablona --
+
+    def _defaults(self) -> Tuple[float, float, float]:
+        """(velikost písma, mezera za odstavcem v pt, násobek řádkování) z docDefaults a stylu Normal."""
+        font_pt, space_after, line = 11.0, 0.0, 1.0
+        defaults = self._styles.find(qn("w:docDefaults"))
+        sources = []
+        if defaults is not None:
+            sources.append((defaults.find(f"{qn('w:rPrDefault')}/{qn('w:rPr')}"),
+                            defaults.find(f"{qn('w:pPrDefault')}/{qn('w:pPr')}")))
+        normal = self._styles.get_by_id("Normal") if hasattr(self._styles, "get_by_id") else None
+        if normal is not None:
+            sources.append((normal.find(qn("w:rPr")), normal.find(qn("w:pPr"))))
+        for rPr, pPr in sources:
+            font_pt = _font_pt(rPr) or font_pt
+            spacing = pPr.find(qn("w:spacing")) if pPr is not None else None
+            if spacing is not None:
+                after = spacing.get(qn("w:after"))
+                if after and after.isdigit():
+                    space_after = int(after) / 20.0
+                value = spacing.get(qn("w:line"))
+                if value and value.isdigit() and spacing.get(qn("w:lineRule"), "auto") == "auto":
+                    line = int(value) / 240.0
+        return font_pt, space_after, line
+
+    def _paragraph_font(self, p_elem) -> float:
+        for r in p_elem.iter(qn("w:r")):
+            size = _font_pt(r.find(qn("w:rPr")))
+            if size is not None:
+                return size
+        pPr = p_elem.find(qn("w:pPr"))
+        style_el = pPr.find(qn("w:pStyle")) if pPr is not None else None
+        if style_el is not None and hasattr(self._styles, "get_by_id"):
+            style = self._styles.get_by_id(style_el.get(qn("w:val")))
+            size = _font_pt(style.find(qn("w:rPr"))) if style is not None else None
+            if size is not None:
+                return size
+        return self.font_pt
+
+    def _paragraph_items(self, p_elem, width: float) -> List[tuple]:
+        pPr = p_elem.find(qn("w:pPr"))
+        items: List[tuple] = []
+        if pPr is not None and pPr.find(qn("w:pageBreakBefore")) is not None:
+            items.append(("break",))
+        slot = self._slots.get(p_elem)
+        if slot is not None and slot.block_key is not None and (
+                _TEMPLATE_Q_RE.match(slot.block_key) or _TEMPLATE_B_RE.match(slot.block_key)):
+            items.append(("slot", slot.block_key, self._paragraph_font(p_elem), width))
+        else:
+            text = "".join(t.text or "" for t in p_elem.iter(qn("w:t")))
+            height = self.text_height(text, self._paragraph_font(p_elem), width)
+            height += sum(int(e.get("cy") or 0) / _EMU_PER_PT for e in p_elem.iter(qn("wp:extent")))
+            items.append(("fixed", height, True))
+        if any(br.get(qn("w:type")) == "page" for br in p_elem.iter(qn("w:br"))):
+            items.append(("break",))
+        if pPr is not None and pPr.find(qn("w:sectPr")) is not None:
+            sect_type = pPr.find(f"{qn('w:sectPr')}/{qn('w:type')}")
+            if sect_type is None or sect_type.get(qn("w:val")) in ("nextPage", "oddPage", "evenPage"):
+                items.append(("break",))
+        return items
+
+    def _table_item(self, tbl) -> tuple:
+        rows = []
+        for tr in tbl.iterchildren(qn("w:tr")):
+            cells = list(tr.iterchildren(qn("w:tc")))
+            width = self.usable_width / max(1, len(cells))
+            rows.append([[item for p in tc.iter(qn("w:p")) for item in self._paragraph_items(p, width)
+                          if item[0] != "break"] for tc in cells])
+        return ("table", rows)
+
+    def _iter_slots(self, items):
+        for item in items:
+            if item[0] == "slot":
+                yield item
+            elif item[0] == "table":
+                for row in item[1]:
+                    for cell in row:
+                        yield from self._iter_slots(cell)
+
+    # -- Výšky --
+
+    def text_height(self, text: str, font_pt: float, width: float) -> float:
+        """Výška odstavce v pt: počet řádků (zalomení podle průměrné šířky znaku) × výška řádku."""
+        per_line = max(1, int(max(36.0, width) / (font_pt * _CHAR_WIDTH)))
+        lines = sum(max(1, -(-len(part) // per_line)) for part in text.split("\n"))
+        return lines * font_pt * _LINE_HEIGHT * self.line_factor + self.space_after
+
+    def question_units(self, q, font_pt: Optional[float] = None, width: Optional[float] = None) -> List[tuple]:
+        """[(výška v pt, dělitelné)] za otázku: odstavce textu a případný obrázek (cache podle id otázky)."""
+        font_pt = font_pt or self.question_font
+        width = width or self.usable_width
+        key = (getattr(q, "id", id(q)), getattr(q, "text_html", ""), font_pt, width)
+        units = self._units_cache.get(key)
+        if units is not None:
+            return units
+        ast = getattr(q, "rich_ast", None)
+        html = getattr(q, "text_html", "") or ""
+        units = []
+        for para in question_paragraphs(html, ast if rich_ast_is_current(ast, html) else None):
+            text = para.get("prefix", "") + "".join(r["text"] for r in para["runs"])
+            units.append((self.text_height(text, font_pt, width - int(para.get("indent", 0) or 0) * _INDENT_PT), True))
+        if getattr(q, "image_path", ""):
+            w_cm = float(getattr(q, "image_width_cm", 0.0) or 0.0)
+            h_cm = float(getattr(q, "image_height_cm", 0.0) or 0.0)
+            if h_cm <= 0.0:
+                h_cm = (w_cm if w_cm > 0.0 else 14.0) * _IMAGE_RATIO
+            units.append((min(self.usable_height, h_cm * _PT_PER_CM) + self.space_after, False))
+        self._units_cache[key] = units
+        return units
+
+    def question_height(self, q) -> float:
+        return sum(h for h, _split in self.question_units(q))
+
+    def _units(self, items, selection: Dict[str, object]):
+        for item in items:
+            kind = item[0]
+            if kind == "fixed":
+                yield item[1], item[2]
+            elif kind == "slot":
+                q = selection.get(item[1])
+                if q is not None:
+                    yield from self.question_units(q, item[2], item[3])
+            elif kind == "table":
+                for row in item[1]:
+                    height = max((sum(h for h, _s in self._units(cell, selection)) for cell in row), default=0.0)
+                    yield height, height > self.usable_height
+            else:
+                yield None, False
+
+    def pages(self, selection: Dict[str, object]) -> int:
+        """Odhad počtu stránek verze; selection = {placeholder: otázka}."""
+        return self.flow(selection)[0]
+
+    def flow(self, selection: Dict[str, object]) -> Tuple[int, float]:
+        """(počet stránek, zaplněná výška poslední stránky v pt)."""
+        pages, used = 1, 0.0
+        for height, splittable in self._units(self._layout, selection):
+            if height is None:  # zalomení stránky
+                pages, used = pages + 1, 0.0
+            elif used + height <= self.usable_height:
+                used += height
+            elif splittable:
+                rest = used + height - self.usable_height
+                pages += 1 + int(rest // self.usable_height)
+                used = rest % self.usable_height
+            else:
+                pages, used = pages + 1, min(height, self.usable_height)
+        return pages, used
+
+
+@dataclass
+class PageBalance:
+    """Odhad stran všech verzí po vyrovnání (rebalance_pages)."""
+    pages: List[int] = field(default_factory=list)
+    max_pages: int = 0
+    swaps: int = 0                                       # vyměněných otázek
+    adjusted: int = 0                                    # upravených verzí
+    too_long: List[int] = field(default_factory=list)   # indexy verzí, které se nepodařilo zkrátit
+
+    def summary(self) -> str:
+        if not self.pages:
+            return ""
+        text = f"odhad stran {min(self.pages)}–{max(self.pages)}"
+        if self.max_pages:
+            text += f" (limit {self.max_pages})"
+        if self.adjusted:
+            text += f"; zkráceno verzí: {self.adjusted} (výměn otázek: {self.swaps})"
+        if self.too_long:
+            text += f"; nad limitem zůstává {len(self.too_long)} verzí"
+        return text
+
+
+def rebalance_pages(rows: List[Dict[str, str]], estimator: PageEstimator, lookup,
+                    pools: Dict[str, List[str]], max_pages: int = 0, group_key=None) -> PageBalance:
+    """
+    Odhadne stránky každé verze a verze delší než max_pages zkrátí (rows se mění na místě):
+    nejdelší otázku verze vymění za kratší otázku ze stejného poolu, která ve verzi ještě není.
+    Náhrada se hledá v poolu seřazeném podle výšky (bisect): nejdelší otázka, se kterou se verze
+    podle odhadu vejde, z nich ta nejméně použitá; jinak nejkratší dostupná a pokračuje se další výměnou.
+    pools: placeholder -> pool id otázek, ze kterého se smí brát náhrada. max_pages=0 = jen odhad.
+    group_key(id) -> klíč: náhrada jen se stejným klíčem (omezení z assemble_versions, viz constraint_key).
+    Výměny nerespektují limit překryvu verzí ze sample_versions (zkrácených verzí bývá málo).
+    """
+    result = PageBalance(max_pages=max_pages)
+    questions: Dict[str, object] = {}
+    heights: Dict[str, float] = {}
+    by_height: Dict[tuple, Tuple[List[float], List[str]]] = {}
+
+    def get(qid):
+        if qid not in questions:
+            questions[qid] = lookup(qid)
+        return questions[qid]
+
+    def height(qid) -> float:
+        h = heights.get(qid)
+        if h is None:
+            q = get(qid)
+            h = heights[qid] = estimator.question_height(q) if q is not None else 0.0
+        return h
+
+    def sorted_pool(pool, qid) -> Tuple[List[float], List[str]]:
+        gk = group_key(qid) if group_key is not None else None
+        entry = by_height.get((id(pool), gk))
+        if entry is None:
+            # celý pool se rozdělí podle klíče najednou, každá skupina seřazená podle výšky
+            groups: Dict[object, List[str]] = {}
+            for other in pool:
+                groups.setdefault(group_key(other) if group_key is not None else None, []).append(other)
+            for key, ids in groups.items():
+                ids.sort(key=height)
+                by_height[(id(pool), key)] = ([height(o) for o in ids], ids)
+            entry = by_height.setdefault((id(pool), gk), ([], []))
+        return entry
+
+    usage = Counter(qid for row in rows for ph, qid in row.items() if qid and ph in pools)
+    scan_limit = 256
+    for i, row in enumerate(rows):
+        pages, used = estimator.flow({ph: get(qid) for ph, qid in row.items() if qid})
+        if max_pages and pages > max_pages:
+            changed = False
+            tried = set()
+            while pages > max_pages:
+                candidates_ph = [ph for ph in row if ph in pools and row[ph] and ph not in tried]
+                if not candidates_ph:
+                    break
+                ph = max(candidates_ph, key=lambda p: height(row[p]))
+                current = row[ph]
+                hs, ordered = sorted_pool(pools[ph], current)
+                excess = (pages - max_pages - 1) * estimator.usable_height + used
+                cut = bisect.bisect_left(hs, height(current))          # jen kratší otázky
+                fit = bisect.bisect_right(hs, height(current) - excess, 0, cut)
+                in_row = set(row.values())
+                # nejdelší vyhovující odshora (nejmenší zásah do verze); když se nevejde ani nejkratší,
+                # bere se z nejkratších a pokračuje se další výměnou. Z okna vždy ta nejméně použitá.
+                window = range(fit - 1, max(-1, fit - 1 - scan_limit), -1) if fit else range(min(cut, scan_limit))
+                replacement = None
+                for j in window:
+                    qid = ordered[j]
+                    if qid not in in_row and (replacement is None or usage[qid] < usage[replacement]):
+                        replacement = qid
+                        if not usage[qid]:
+                            break
+                if replacement is None:
+                    tried.add(ph)
+                    continue
+                row[ph] = replacement
+                usage[current] -= 1
+                usage[replacement] += 1
+                result.swaps += 1
+                changed = True
+                pages, used = estimator.flow({p: get(qid) for p, qid in row.items() if qid})
+            result.adjusted += int(changed)
+            if pages > max_pages:
+                result.too_long.append(i)
+        result.pages.append(pages)
+    return result
+
+
+# ---- Banka otázek a skládání verzí (společné pro GUI i headless export) ----
+
+@dataclass
+class BankQuestion:
+    """Otázka z questions.json v rozsahu, který potřebuje export (bez závislosti na GUI modelu)."""
+    id: str
+    type: str = "classic"
+    text_html: str = "<p><br></p>"
+    title: str = ""
+    points: int = 1
+    bonus_correct: float = 0.0
+    bonus_wrong: float = 0.0
+    image_path: str = ""
+    image_width_cm: float = 0.0
+    image_height_cm: float = 0.0
+    correct_answer: str = ""
+    rich_ast: Dict = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, q: dict) -> "BankQuestion":
+        qtype = q.get("type", "classic")
+        def num(key: str, default: float) -> float:
+            try:
+                return round(float(q.get(key, default)), 2)
+            except (TypeError, ValueError):
+                return default
+        return cls(
+            id=q.get("id", ""),
+            type=qtype,
+            text_html=q.get("text_html", "<p><br></p>"),
+            title=q.get("title", ""),
+            points=int(q.get("points", 1) or 0),
+            bonus_correct=num("bonus_correct", 1.0 if qtype == "bonus" else 0.0),
+            bonus_wrong=num("bonus_wrong", 0.0),
+            image_path=q.get("image_path", "") or "",
+            image_width_cm=float(q.get("image_width_cm", 0.0) or 0.0),
+            image_height_cm=float(q.get("image_height_cm", 0.0) or 0.0),
+            correct_answer=q.get("correct_answer", "") or "",
+            rich_ast=q.get("rich_ast") or {},
+        )
+
+
+@dataclass
+class BankNode:
+    """Skupina / podskupina z questions.json."""
+    id: str
+    name: str
+    subgroups: List["BankNode"] = field(default_factory=list)
+    questions: List[BankQuestion] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, node: dict) -> "BankNode":
+        return cls(
+            id=node["id"],
+            name=node.get("name", ""),
+            subgroups=[cls.from_dict(sg) for sg in node.get("subgroups", [])],
+            questions=[BankQuestion.from_dict(q) for q in node.get("questions", [])],
+        )
+
+
+def load_question_bank(path) -> List[BankNode]:
+    """Načte skupiny z questions.json (stejný formát, jaký ukládá aplikace)."""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    return [BankNode.from_dict(g) for g in raw.get("groups", [])]
+
+
+class QuestionPools:
+    """
+    Předpočítané množiny id otázek pro každý uzel stromu (skupina/podskupina) a typ otázky,
+    vždy včetně všech vnořených podskupin.
+
+    Pool pro libovolnou kombinaci zdrojů je sjednocení hotových frozensetů (bez procházení stromu).
+    NOVÉ: questions je index id -> otázka (vyhledání otázek verzí a preflight bez průchodu stromem),
+    topics id otázky -> id uzlu, ve kterém přímo leží (podskupina pro assemble_versions).
+    Instance si pamatuje revizi modelu, ze které vznikla; MainWindow ji po změně revize zahodí.
+    """
+
+    def __init__(self, groups: List, revision: int = 0) -> None:
+        self.revision = revision
+        self.pools: Dict[str, Dict[str, frozenset]] = {}
+        self.questions: Dict[str, object] = {}
+        self.topics: Dict[str, str] = {}
+        for g in groups:
+            self._build(g)
+
+    def _build(self, node) -> Dict[str, frozenset]:
+        by_type: Dict[str, set] = {}
+        for q in getattr(node, "questions", None) or []:
+            by_type.setdefault(q.type, set()).add(q.id)
+            self.questions.setdefault(q.id, q)
+            self.topics.setdefault(q.id, node.id)
+        for sub in getattr(node, "subgroups", None) or []:
+            for qtype, ids in self._build(sub).items():
+                by_type.setdefault(qtype, set()).update(ids)
+        pools = {qtype: frozenset(ids) for qtype, ids in by_type.items()}
+        self.pools[node.id] = pools
+        return pools
+
+    def pool(self, node_id: str, qtype: str) -> frozenset:
+        return self.pools.get(node_id, {}).get(qtype, frozenset())
+
+    def union(self, node_ids, qtype: str) -> set:
+        """Sjednocení poolů zadaných uzlů pro daný typ (neznámá id se ignorují)."""
+        out: set = set()
+        for node_id in node_ids:
+            out |= self.pool(node_id, qtype)
+        return out
+
+
+def ensure_rich_ast(q) -> Dict:
+    """Vrátí platný rich-text AST otázky; pokud chybí nebo neodpovídá HTML, přestaví ho a uloží k otázce."""
+    ast = getattr(q, "rich_ast", None)
+    if not rich_ast_is_current(ast, q.text_html):
+        ast = build_rich_ast(q.text_html)
+        q.rich_ast = ast
+    return ast
+
+
+_CZ_DAYS = ["pondělí", "úterý", "středa", "čtvrtek", "pátek", "sobota", "neděle"]
+
+
+def format_exam_datetime(dt: datetime) -> str:
+    """Text pro <DatumČas>: „pondělí 01.01.2026 10:00“, čas zaokrouhlený na 10 minut (v rámci dne)."""
+    total_minutes = dt.hour * 60 + dt.minute
+    remainder = total_minutes % 10
+    total_minutes += (10 - remainder) if remainder >= 5 else -remainder
+    new_h = (total_minutes // 60) % 24
+    new_m = total_minutes % 60
+    return f"{_CZ_DAYS[dt.weekday()]} {dt.day:02d}.{dt.month:02d}.{dt.year} {new_h:02d}:{new_m:02d}"
+
+
+def version_output_path(base_output_path, index: int, is_multi: bool) -> Path:
+    """U hromadného exportu <název>_v<N>.docx, jinak přímo zvolený soubor."""
+    p = Path(base_output_path)
+    return p.parent / f"{p.stem}_v{index + 1}{p.suffix}" if is_multi else p
+
+
+# ---- Poskytovatelé placeholderů (počítají se jen pro klíče, které šablona obsahuje) ----
+
+@dataclass
+class PlaceholderContext:
+    """Vstupy jedné verze pro poskytovatele placeholderů."""
+    selection: Dict[str, object]          # {placeholder: otázka nebo None}
+    dt: datetime                          # datum a čas testu
+    index: int = 0                        # pořadí verze (od 0)
+    count: int = 1                        # počet verzí v balíku
+    prefix: str = ""                      # prefix <PoznamkaVerze>
+    k_hash: str = ""
+    extra: Dict[str, str] = field(default_factory=dict)   # další hodnoty (např. řádek seznamu studentů)
+    _memo: Dict[str, object] = field(default_factory=dict, repr=False)
+
+    def memo(self, key: str, compute):
+        """Mezivýsledek sdílený více poskytovateli téže verze (např. součty bonusů)."""
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+
+class PlaceholderRegistry:
+    """
+    Registr poskytovatelů hodnot prostých placeholderů. Poskytovatel = funkce(ctx) -> str,
+    registrovaná pod jedním či více názvy (varianty zápisu). per_version=False znamená,
+    že hodnota je pro celý balík stejná a spočítá se jen jednou.
+
+        @PLACEHOLDERS.register("Mistnost", "MISTNOST", per_version=False)
+        def _room(ctx): return ctx.extra.get("Mistnost", "")
+    """
+
+    def __init__(self) -> None:
+        self._providers: Dict[str, Tuple[object, bool]] = {}
+
+    def register(self, *names: str, per_version: bool = True):
+        def decorator(func):
+            for name in names:
+                self._providers[name] = (func, per_version)
+            return func
+        return decorator
+
+    def unregister(self, *names: str) -> None:
+        for name in names:
+            self._providers.pop(name, None)
+
+    def known(self, key: str) -> bool:
+        return key in self._providers
+
+    def names(self) -> List[str]:
+        return sorted(self._providers)
+
+    def plan(self, used_keys) -> "PlaceholderPlan":
+        return PlaceholderPlan(self, used_keys)
+
+
+class PlaceholderPlan:
+    """
+    Poskytovatelé vybraní pro konkrétní šablonu (used_keys = CompiledTemplate.placeholder_keys()).
+    Poskytovatel se volá jednou za verzi bez ohledu na počet variant názvu,
+    hodnoty per_version=False jen jednou za celý export. Klíče bez poskytovatele
+    se doplní z ctx.extra, pokud tam jsou.
+    """
+
+    def __init__(self, registry: PlaceholderRegistry, used_keys) -> None:
+        self.used_keys = set(used_keys)
+        groups: Dict[int, Tuple[object, bool, List[str]]] = {}
+        self.unresolved: List[str] = []
+        for key in sorted(self.used_keys):
+            entry = registry._providers.get(key)
+            if entry is None:
+                self.unresolved.append(key)
+                continue
+            func, per_version = entry
+            groups.setdefault(id(func), (func, per_version, []))[2].append(key)
+        self._groups = list(groups.values())
+        self._static: Dict[str, str] = {}
+        self._static_done = False
+
+    def values(self, ctx: PlaceholderContext) -> Dict[str, str]:
+        out: Dict[str, str] = {}
+        for key in self.unresolved:
+            if key in ctx.extra:
+                out[key] = str(ctx.extra[key])
+        if not self._static_done:
+            for func, per_version, keys in self._groups:
+                if not per_version:
+                    value = str(func(ctx))
+                    self._static.update((k, value) for k in keys)
+            self._static_done = True
+        out.update(self._static)
+        for func, per_version, keys in self._groups:
+            if per_version:
+                value = str(func(ctx))
+                out.update((k, value) for k in keys)
+        return out
+
+    def replacements(self, ctx: PlaceholderContext,
+                     ast_for=ensure_rich_ast) -> Tuple[Dict[str, str], Dict[str, object]]:
+        """Náhrady jedné verze: (prosté placeholdery, rich mapa {placeholder: (html, obrázek, š, v, ast)})."""
+        rich_map: Dict[str, object] = {}
+        for ph, q in ctx.selection.items():
+            if q is not None:
+                rich_map[ph] = (q.text_html, getattr(q, "image_path", None),
+                                float(getattr(q, "image_width_cm", 0.0) or 0.0),
+                                float(getattr(q, "image_height_cm", 0.0) or 0.0),
+                                ast_for(q))
+            else:
+                rich_map[ph] = ("", None)
+        return self.values(ctx), rich_map
+
+
+PLACEHOLDERS = PlaceholderRegistry()
+
+
+def version_label(ctx: PlaceholderContext) -> str:
+    """Text <PoznamkaVerze>: prefix, u hromadného exportu -<N>, a datum testu."""
+    suffix = f"-{ctx.index + 1}" if ctx.count > 1 else ""
+    return f"{ctx.prefix}{suffix} {ctx.dt:%Y-%m-%d}"
+
+
+def _bonus_totals(ctx: PlaceholderContext) -> Tuple[float, float]:
+    """(součet bodů za správné bonusy, součet bodů za špatné bonusy) vybraných otázek."""
+    def compute():
+        total_bonus = min_loss = 0.0
+        for q in ctx.selection.values():
+            if q is not None and q.type == 'bonus':
+                total_bonus += float(q.bonus_correct)
+                min_loss += float(q.bonus_wrong)
+        return total_bonus, min_loss
+    return ctx.memo("bonus_totals", compute)
+
+
+# Základ bodů verze bez klasických otázek (dřívější pevná hodnota <MaxBody>)
+DEFAULT_BASE_POINTS = 10.0
+
+
+def base_points(selection: Dict[str, object]) -> float:
+    """Součet `points` vybraných klasických otázek; bez klasických otázek DEFAULT_BASE_POINTS."""
+    classic = [q for q in selection.values() if q is not None and getattr(q, "type", "classic") != "bonus"]
+    if not classic:
+        return DEFAULT_BASE_POINTS
+    return float(sum(int(getattr(q, "points", 1) or 0) for q in classic))
+
+
+@PLACEHOLDERS.register("DatumČas", "DatumCas", "DATUMCAS", per_version=False)
+def _ph_datetime(ctx: PlaceholderContext) -> str:
+    return format_exam_datetime(ctx.dt)
+
+
+@PLACEHOLDERS.register("PoznamkaVerze", "POZNAMKAVERZE")
+def _ph_version(ctx: PlaceholderContext) -> str:
+    return version_label(ctx)
+
+
+@PLACEHOLDERS.register("KontrolniHash", "KONTROLNIHASH")
+def _ph_hash(ctx: PlaceholderContext) -> str:
+    return ctx.k_hash
+
+
+@PLACEHOLDERS.register("MaxBody", "MAXBODY")
+def _ph_max_points(ctx: PlaceholderContext) -> str:
+    # ZMĚNA: základ je součet bodů klasických otázek verze (dřív pevně 10)
+    return f"{base_points(ctx.selection) + _bonus_totals(ctx)[0]:.2f}"
+
+
+@PLACEHOLDERS.register("MinBody", "MINBODY")
+def _ph_min_points(ctx: PlaceholderContext) -> str:
+    return f"{_bonus_totals(ctx)[1]:.2f}"
+
+
+@PLACEHOLDERS.register("CisloVerze", "CISLOVERZE")
+def _ph_version_number(ctx: PlaceholderContext) -> str:
+    return str(ctx.index + 1)
+
+
+@PLACEHOLDERS.register("Student", "STUDENT", "JmenoStudenta")
+def _ph_student(ctx: PlaceholderContext) -> str:
+    return ctx.extra.get("Student", "")
+
+
+@PLACEHOLDERS.register("StudentID", "STUDENTID", "IDStudenta")
+def _ph_student_id(ctx: PlaceholderContext) -> str:
+    return ctx.extra.get("StudentID", "")
+
+
+# ---- Klíč správných odpovědí ----
+
+ANSWER_KEY_MODES = ("none", "per_version", "combined")
+
+
+def _placeholder_order(ph: str) -> tuple:
+    """Klasické otázky před bonusovými, uvnitř podle čísla placeholderu."""
+    m = re.search(r"\d+", ph)
+    return (1 if _TEMPLATE_B_RE.match(ph) else 0, int(m.group(0)) if m else 0, ph)
+
+
+def answer_key_entries(selection: Dict[str, object], ast_for=ensure_rich_ast) -> List[Tuple[str, str, str, str]]:
+    """
+    Řádky klíče pro jednu verzi: [(pozice, otázka, správná odpověď, body)].
+    Text otázky se bere z téhož rich AST jako při renderu testu (žádný další parse HTML).
+    """
+    rows = []
+    n_classic = n_bonus = 0
+    for ph in sorted(selection, key=_placeholder_order):
+        q = selection[ph]
+        if q is None:
+            continue
+        if q.type == "bonus":
+            n_bonus += 1
+            label = f"Bonus {n_bonus}"
+            points = f"+{float(q.bonus_correct):.2f} / {float(q.bonus_wrong):.2f}"
+        else:
+            n_classic += 1
+            label = f"{n_classic}."
+            points = str(getattr(q, "points", 1))
+        text = rich_ast_plain_text(ast_for(q)).strip().replace("\n", " ")
+        if len(text) > 120:
+            text = text[:117] + "..."
+        title = (getattr(q, "title", "") or "").strip()
+        question = f"{title}: {text}" if title and text else (title or text)
+        answer = (getattr(q, "correct_answer", "") or "").strip() or "—"
+        rows.append((label, question, answer, points))
+    return rows
+
+
+def answer_key_path(base_output_path, index: Optional[int] = None, is_multi: bool = False) -> Path:
+    """<výstup>_klic.docx (společný klíč) nebo <výstup>_v<N>_klic.docx (klíč verze)."""
+    p = version_output_path(base_output_path, index, is_multi) if index is not None else Path(base_output_path)
+    return p.with_name(f"{p.stem}_klic.docx")
+
+
+_KEY_COL_TWIPS = (900, 4200, 3100, 1150)  # šířky sloupců klíče (1 cm = 567 twipů)
+_KEY_HEADER = ("Pozice", "Otázka", "Správná odpověď", "Body")
+
+
+def _answer_key_body(versions: List[Tuple[str, List[tuple]]], k_hash: str) -> str:
+    """Tělo klíče jako WordprocessingML – tabulky se skládají přímo (python-docx add_row je O(n²))."""
+    def cell(text: str, width: int, bold: bool = False) -> str:
+        rpr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+        return (f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr>'
+                f"<w:p><w:r>{rpr}{_run_content_xml(text)}</w:r></w:p></w:tc>")
+
+    grid = "".join(f'<w:gridCol w:w="{w}"/>' for w in _KEY_COL_TWIPS)
+    header = "<w:tr>" + "".join(cell(t, w, True) for t, w in zip(_KEY_HEADER, _KEY_COL_TWIPS)) + "</w:tr>"
+    out: List[str] = []
+    for v_idx, (label, rows) in enumerate(versions):
+        if v_idx > 0:
+            out.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        out.append('<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr>'
+                   f"<w:r>{_run_content_xml(f'Klíč správných odpovědí – {label}')}</w:r></w:p>")
+        if k_hash:
+            out.append('<w:p><w:r><w:rPr><w:color w:val="666666"/><w:sz w:val="16"/></w:rPr>'
+                       f"{_run_content_xml(f'Kontrolní hash: {k_hash}')}</w:r></w:p>")
+        out.append('<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:w="0" w:type="auto"/></w:tblPr>'
+                   f"<w:tblGrid>{grid}</w:tblGrid>{header}")
+        for row in rows:
+            out.append("<w:tr>" + "".join(cell(str(t), w) for t, w in zip(row, _KEY_COL_TWIPS)) + "</w:tr>")
+        out.append("</w:tbl><w:p/>")
+    return "".join(out)
+
+
+def write_answer_key(output_path, versions: List[Tuple[str, List[tuple]]], k_hash: str = "") -> Path:
+    """
+    Zapíše klíč odpovědí jako DOCX (výchozí šablona python-docx): pro každou verzi
+    (popisek, řádky z answer_key_entries) nadpis a tabulku, verze oddělené novou stránkou.
+    """
+    buf = io.BytesIO()
+    docx.Document().save(buf)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(buf) as src, zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            data = src.read(info)
+            if info.filename == "word/document.xml":
+                xml = data.decode("utf-8")
+                m = _BODY_RE.search(xml)
+                sect = _FINAL_SECTPR_RE.search(m.group(2))
+                body = _answer_key_body(versions, k_hash) + (sect.group(1) if sect else "")
+                data = (xml[:m.end(1)] + body + xml[m.start(3):]).encode("utf-8")
+            dst.writestr(info, data)
+    return output_path
+
+
+def answer_key_jobs(mode: str, base_output_path, versions: List[Tuple[str, List[tuple]]],
+                    is_multi: bool, k_hash: str = "") -> List[tuple]:
+    """
+    Rozdělí klíče verzí do výstupních souborů podle režimu ('per_version' / 'combined').
+    Vrací argumenty pro write_answer_key: [(cesta, verze, hash)].
+    """
+    if mode == "combined" or (mode == "per_version" and not is_multi):
+        return [(answer_key_path(base_output_path), versions, k_hash)]
+    if mode == "per_version":
+        return [(answer_key_path(base_output_path, i, True), [v], k_hash) for i, v in enumerate(versions)]
+    return []
+
+
+def append_export_history(history_file, filename: str, k_hash: str) -> None:
+    """Přidá záznam do historie exportů (data/history.json); chyba zápisu se propaguje volajícímu."""
+    append_export_history_batch(history_file, [(filename, k_hash)])
+
+
+def append_export_history_batch(history_file, records: List[Tuple[str, str]]) -> None:
+    """Přidá více záznamů (soubor, hash) jedním zápisem – např. testy všech studentů."""
+    history_file = Path(history_file)
+    history = []
+    if history_file.exists():
+        try:
+            with open(history_file, "r", encoding="utf-8") as f:
+                history = json.load(f)
+        except Exception:
+            pass  # Ignorujeme chyby čtení, vytvoříme nový seznam
+    now = datetime.now().isoformat()
+    history.extend({"filename": filename, "hash": k_hash, "date": now} for filename, k_hash in records)
+    with open(history_file, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=2, ensure_ascii=False)
+
+
+def new_control_hash() -> str:
+    """Kontrolní hash exportu (SHA3-256 z časové značky a náhodné soli)."""
+    data_to_hash = f"{datetime.now().timestamp()}{secrets.token_hex(16)}"
+    return hashlib.sha3_256(data_to_hash.encode("utf-8")).hexdigest()
+
+
+# ---- Kontrola před exportem (preflight) ----
+
+_TEMPLATE_Q_RE = re.compile(r"^Otázka\d+$")
+_TEMPLATE_B_RE = re.compile(r"^BONUS\d+$")
+
+
+def unknown_placeholders(keys, extra_keys=()) -> List[str]:
+    """Klíče šablony, které nejsou otázka/bonus, registrovaný poskytovatel ani dodatečný klíč (sloupec CSV)."""
+    extra = set(extra_keys)
+    return sorted(k for k in keys if not _TEMPLATE_Q_RE.match(k) and not _TEMPLATE_B_RE.match(k)
+                  and not PLACEHOLDERS.known(k) and k not in extra)
+
+
+def roster_columns(path) -> List[str]:
+    """Názvy sloupců CSV se studenty (+ Student a StudentID doplňované v iter_roster)."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        names = [k.strip() for k in (_roster_reader(f).fieldnames or []) if k and k.strip()]
+    return names + [k for k in ("Student", "StudentID") if k not in names]
+
+
+@dataclass
+class PreflightIssue:
+    level: str    # "error" (export se nespustí) / "warning"
+    message: str
+
+
+@dataclass
+class PreflightReport:
+    """Všechny nalezené problémy dávky najednou (viz preflight_export)."""
+    issues: List[PreflightIssue] = field(default_factory=list)
+    versions: int = 0
+    images: int = 0
+    elapsed: float = 0.0
+
+    def error(self, message: str) -> None:
+        self.issues.append(PreflightIssue("error", message))
+
+    def warning(self, message: str) -> None:
+        self.issues.append(PreflightIssue("warning", message))
+
+    @property
+    def errors(self) -> List[str]:
+        return [i.message for i in self.issues if i.level == "error"]
+
+    @property
+    def warnings(self) -> List[str]:
+        return [i.message for i in self.issues if i.level == "warning"]
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def text(self) -> str:
+        """Čitelný souhrn pro dialog / výpis."""
+        lines = []
+        if self.errors:
+            lines.append(f"Chyby ({len(self.errors)}):")
+            lines.extend(f" • {m}" for m in self.errors)
+        if self.warnings:
+            if lines:
+                lines.append("")
+            lines.append(f"Upozornění ({len(self.warnings)}):")
+            lines.extend(f" • {m}" for m in self.warnings)
+        return "\n".join(lines)
+
+
+def _version_list(indexes: List[int], limit: int = 8) -> str:
+    shown = ", ".join(str(i + 1) for i in indexes[:limit])
+    return shown + (f" … ({len(indexes)}×)" if len(indexes) > limit else "")
+
+
+def preflight_export(compiled: Optional["CompiledTemplate"], selections: List[Dict[str, Optional[str]]],
+                     lookup, *, template_error: str = "",
+                     pool_sizes: Optional[Dict[str, Tuple[int, int]]] = None,
+                     extra_keys=(), output_path=None, pdf: bool = False,
+                     stat_cache: Optional[Dict[str, bool]] = None,
+                     page_balance: Optional["PageBalance"] = None,
+                     assembly: Optional["AssemblyReport"] = None) -> PreflightReport:
+    """
+    Zkontroluje celou dávku dřív, než se zapíše první DOCX (jen indexy a stat, žádný render):
+     - šablona jde načíst (compiled=None + template_error),
+     - pool_sizes {"popis": (dostupné, sloty)} – prázdný nebo menší pool než počet placeholderů,
+     - každý placeholder otázky/bonusu má v každé verzi přiřazenou existující otázku,
+     - neznámé placeholdery (zůstaly by v testu beze změny; extra_keys = sloupce CSV apod.),
+     - obrázky otázek existují (stat_cache: cesta -> existuje, sdílená mezi verzemi),
+     - výstupní složka je zapisovatelná a pro PDF je k dispozici LibreOffice,
+     - verze, které ani po vyrovnání (rebalance_pages) nejspíš nevejdou do limitu stran,
+     - omezení výběru (assemble_versions), která nešla splnit.
+    selections: verze jako {placeholder: id otázky}, lookup(id) -> otázka nebo None.
+    """
+    t0 = time.perf_counter()
+    report = PreflightReport(versions=len(selections))
+    stat_cache = {} if stat_cache is None else stat_cache
+
+    if compiled is None:
+        report.error(f"Šablonu nelze načíst: {template_error or 'neznámá chyba'}")
+        keys = set()
+    else:
+        keys = compiled.placeholder_keys()
+
+    for label, (available, slots) in (pool_sizes or {}).items():
+        if slots and not available:
+            report.error(f"Pool {label} je prázdný (placeholderů v šabloně: {slots}).")
+        elif available < slots:
+            report.warning(f"Pool {label}: dostupných {available}, placeholderů {slots} – "
+                           f"otázky se budou v jedné verzi opakovat.")
+
+    unknown = unknown_placeholders(keys, extra_keys)
+    if unknown:
+        report.warning("Placeholdery bez poskytovatele (zůstanou v testu beze změny): "
+                       + ", ".join(f"<{k}>" for k in unknown))
+
+    question_keys = sorted(k for k in keys if _TEMPLATE_Q_RE.match(k) or _TEMPLATE_B_RE.match(k))
+    unassigned: Dict[str, List[int]] = {}
+    missing_q: Dict[str, List[int]] = {}
+    missing_img: Dict[str, List[str]] = {}
+    questions: Dict[str, object] = {}
+    for i, selection in enumerate(selections):
+        for ph in question_keys:
+            qid = selection.get(ph)
+            if not qid:
+                unassigned.setdefault(ph, []).append(i)
+                continue
+            if qid not in questions:
+                questions[qid] = lookup(qid)
+            q = questions[qid]
+            if q is None:
+                missing_q.setdefault(qid, []).append(i)
+                continue
+            image = getattr(q, "image_path", "") or ""
+            if not image:
+                continue
+            exists = stat_cache.get(image)
+            if exists is None:
+                try:
+                    exists = os.path.isfile(image) and os.stat(image).st_size > 0
+                except OSError:
+                    exists = False
+                stat_cache[image] = exists
+            if not exists:
+                titles = missing_img.setdefault(image, [])
+                title = getattr(q, "title", "") or qid
+                if title not in titles:
+                    titles.append(title)
+    report.images = sum(1 for q in questions.values() if q is not None and getattr(q, "image_path", ""))
+
+    for ph, idx in unassigned.items():
+        report.error(f"<{ph}> nemá přiřazenou otázku (verze {_version_list(idx)}).")
+    for qid, idx in missing_q.items():
+        report.error(f"Otázka {qid} v bance neexistuje (verze {_version_list(idx)}).")
+    for image, titles in missing_img.items():
+        report.error(f"Obrázek neexistuje: {image} (otázka: {', '.join(titles[:3])})")
+
+    if output_path is not None:
+        folder = Path(output_path).parent
+        while not folder.exists() and folder != folder.parent:
+            folder = folder.parent
+        if not os.access(folder, os.W_OK):
+            report.error(f"Do výstupní složky nelze zapisovat: {folder}")
+    if pdf and find_libreoffice() is None:
+        report.warning("LibreOffice nebyl nalezen – PDF nevznikne, zůstanou jen DOCX.")
+    if page_balance is not None and page_balance.too_long:
+        over = page_balance.too_long
+        report.warning(f"Podle odhadu přesáhne limit {page_balance.max_pages} stran {len(over)} verzí "
+                       f"(verze {_version_list(over)}) – kratší otázky v poolu nejsou.")
+    if assembly is not None:
+        for msg in assembly.impossible:
+            report.warning(f"Omezení výběru: {msg}.")
+        for label, n in assembly.violations.items():
+            report.warning(f"Omezení výběru „{label}“ nesplněno u {n} verzí.")
+
+    report.elapsed = time.perf_counter() - t0
+    return report
+
+
+# ---- Headless export (příkazová řádka) ----
+
+
+def _emit(event: str, **data) -> None:
+    """Jeden řádek JSON na stdout (strojově čitelný průběh pro cron/CI)."""
+    print(json.dumps({"event": event, **data}, ensure_ascii=False, default=str), flush=True)
+
+
+def _resolve_sources(groups: List[BankNode], names: List[str]) -> Tuple[List[str], List[str]]:
+    """Zdroje zadané id nebo názvem skupiny/podskupiny -> (id uzlů, nenalezené)."""
+    by_key: Dict[str, List[str]] = {}
+    stack = list(groups)
+    while stack:
+        node = stack.pop()
+        by_key.setdefault(node.id, []).append(node.id)
+        by_key.setdefault(node.name, []).append(node.id)
+        stack.extend(node.subgroups)
+    ids: List[str] = []
+    missing: List[str] = []
+    for name in names:
+        if name in by_key:
+            ids.extend(by_key[name])
+        else:
+            missing.append(name)
+    return ids, missing
+
+
+def _cli_roster_export(args, compiled: CompiledTemplate, plan: PlaceholderPlan, selections: List[Dict[str, str]],
+                       questions: Dict[str, BankQuestion], dt: datetime, seed, data_path: Path, sample_q) -> int:
+    """Větev cli_main pro --roster: test pro každého studenta, vlastní hash, zip archiv + jedno PDF."""
+    count = len(selections)
+
+    def entries():
+        for i, row in enumerate(iter_roster(args.roster)):
+            if i >= count:
+                break
+            sel = selections[i]
+            selection = {ph: questions.get(qid) for ph, qid in sel.items()}
+            s_hash = new_control_hash()
+            ctx = PlaceholderContext(selection, dt, i, count, args.prefix, s_hash, extra=row)
+            repl_plain, rich_map = plan.replacements(ctx)
+            yield (roster_file_stem(i, row), repl_plain, rich_map,
+                   {"index": i + 1, "student": row["Student"], "student_id": row["StudentID"],
+                    "hash": s_hash, "selection": sel})
+
+    archive, pdf = roster_output_paths(args.output, (Path(args.pdf_dir) if args.pdf_dir else data_path.parent / "Tisk"))
+    _emit("start", versions=count, roster=str(args.roster), seed=seed,
+          selection=sample_q.summary() if sample_q else "")
+    mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    result = run_roster_export(
+        compiled, entries(), count, archive,
+        pdf_path=pdf if args.pdf else None,
+        image_cache=compiled.image_cache,
+        render_cache=None if args.no_cache else RenderCache(data_path.parent / ".cache" / "render"),
+        mp_context=mp_context, parallel=mp_context is not None,
+        manifest={"seed": seed, "prefix": args.prefix, "date": f"{dt:%Y-%m-%d %H:%M}", "roster": str(args.roster)},
+        progress=lambda stage, done, total, text: _emit("progress", stage=stage, done=done, total=total),
+        file_ready=lambda kind, path: _emit("file", kind=kind, path=path),
+    )
+    for i, err in sorted(result.failed.items()):
+        _emit("error", version=i + 1, message=err)
+    for err in dict.fromkeys(result.pdf_errors):
+        _emit("error", stage="pdf", message=err)
+    if result.merge_failed:
+        _emit("error", stage="merge", message="Nepodařilo se sloučit PDF (PyPDF2 / Ghostscript).")
+    if result.history and not args.no_history:
+        try:
+            append_export_history_batch(data_path.parent / "history.json",
+                                        [(f"{archive.name}/{name}", h) for name, h in result.history])
+        except Exception as e:
+            _emit("warning", message=f"Nepodařilo se uložit historii exportu: {e}")
+    _emit("done", docx=result.rendered, failed=len(result.failed), archive=str(result.archive or ""),
+          pdf=str(result.final_pdf or ""), cancelled=result.cancelled)
+    ok = result.rendered == count and not result.pdf_errors and not result.merge_failed
+    return 0 if ok else 1
+
+
+def cli_main(argv: Optional[List[str]] = None) -> int:
+    """
+    Headless export bez GUI: python main.py export ... (nebo python export_engine.py export ...).
+    Průběh se vypisuje jako JSON řádky (event: preflight/start/progress/file/warning/error/done);
+    stdout obsahuje jen JSON, diagnostika jádra ([WARN]/[ERROR], LibreOffice, slučování PDF) jde na stderr.
+    Návratový kód: 0 = vše hotovo, 1 = část verzí/PDF selhala, 2 = chybné zadání.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py export", description="Headless export testů z banky otázek.")
+    parser.add_argument("--data", required=True, help="cesta k questions.json")
+    parser.add_argument("--template", required=True, help="DOCX šablona s placeholdery")
+    parser.add_argument("--output", required=True, help="výstupní DOCX (u více verzí se přidá _v<N>)")
+    parser.add_argument("--groups", nargs="*", default=[], help="zdroje klasických otázek (id nebo název; výchozí = vše)")
+    parser.add_argument("--bonus-groups", nargs="*", default=[], help="zdroje bonusových otázek (výchozí = vše)")
+    parser.add_argument("--versions", type=int, default=1, help="počet verzí (výchozí 1)")
+    parser.add_argument("--seed", type=int, default=None, help="seed výběru otázek (reprodukovatelnost)")
+    parser.add_argument("--max-overlap", type=int, default=None, help="max. společných otázek dvou verzí")
+    parser.add_argument("--prefix", default="MůjTest", help="prefix textu <PoznamkaVerze>")
+    parser.add_argument("--date", default=None, help="datum testu 'YYYY-MM-DD HH:MM' (výchozí teď)")
+    parser.add_argument("--pdf", action="store_true", help="převést na PDF (LibreOffice), u více verzí sloučit")
+    parser.add_argument("--pdf-dir", default=None, help="složka pro PDF (výchozí <data>/Tisk)")
+    parser.add_argument("--print-dpi", type=int, default=DEFAULT_PRINT_DPI, help="DPI obrázků (0 = originál)")
+    parser.add_argument("--no-history", action="store_true", help="nezapisovat do history.json")
+    parser.add_argument("--manifest", default=None,
+                        help="znovu použít výběr, seed a hash z manifestu předchozího exportu")
+    parser.add_argument("--no-cache", action="store_true", help="nepoužít cache vyrenderovaných verzí")
+    parser.add_argument("--combined", action="store_true",
+                        help="všechny verze do jednoho DOCX (verze = sekce), jedna konverze do PDF")
+    parser.add_argument("--answer-keys", choices=["none", "per-version", "combined"], default="none",
+                        help="klíč správných odpovědí: pro každou verzi zvlášť, nebo jeden společný")
+    parser.add_argument("--keep-docx", action="store_true",
+                        help="s --pdf ponechat i DOCX (jinak jsou DOCX jen rychlý mezivýstup pro PDF)")
+    parser.add_argument("--roster", default=None,
+                        help="CSV se seznamem studentů: jeden test na studenta do <výstup>_studenti.zip")
+    parser.add_argument("--one-per-subgroup", action="store_true",
+                        help="každá otázka verze z jiné podskupiny")
+    parser.add_argument("--target-points", type=int, default=0,
+                        help="součet bodů (points) klasických otázek každé verze (0 = libovolný)")
+    parser.add_argument("--equal-bonus", action="store_true",
+                        help="stejná hodnota bonusových otázek ve všech verzích")
+    parser.add_argument("--max-pages", type=int, default=0,
+                        help="max. stran na verzi podle odhadu; delší verze se zkrátí výměnou otázek (0 = bez limitu)")
+    parser.add_argument("--check", action="store_true",
+                        help="jen kontrola dávky (šablona, pooly, placeholdery, obrázky), nic se nevygeneruje")
+    args = parser.parse_args(argv)
+
+    data_path = Path(args.data)
+    manifest = None
+    if args.manifest:
+        manifest = read_manifest(args.manifest)
+        if manifest is None:
+            _emit("error", message=f"Manifest nelze načíst: {args.manifest}")
+            return 2
+    count = len(manifest["versions"]) if manifest else max(1, args.versions)
+    if args.roster:
+        if manifest:
+            _emit("error", message="--roster a --manifest nelze kombinovat.")
+            return 2
+        try:
+            count = count_roster(args.roster)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            _emit("error", message=f"Seznam studentů nelze načíst: {e}")
+            return 2
+        if not count:
+            _emit("error", message="Seznam studentů je prázdný.")
+            return 2
+    is_multi = count > 1
+    try:
+        dt = datetime.strptime(args.date, "%Y-%m-%d %H:%M") if args.date else datetime.now()
+        groups = load_question_bank(data_path)
+    except Exception as e:
+        _emit("error", message=str(e))
+        return 2
+    # Chyba šablony se hlásí až v preflight reportu spolu s ostatními problémy dávky
+    compiled, template_error = None, ""
+    try:
+        compiled = CompiledTemplate(args.template, image_cache=ImageCache(
+            data_path.parent / ".cache" / "images", args.print_dpi))
+    except Exception as e:
+        template_error = str(e)
+
+    pools = QuestionPools(groups)
+    sources, missing = _resolve_sources(groups, args.groups) if args.groups else ([g.id for g in groups], [])
+    bonus_sources, missing_b = (_resolve_sources(groups, args.bonus_groups) if args.bonus_groups
+                                else ([g.id for g in groups], []))
+    for name in missing + missing_b:
+        _emit("warning", message=f"Zdroj nenalezen: {name}")
+
+    keys = compiled.placeholder_keys() if compiled is not None else set()
+    by_number = lambda k: int(re.findall(r"\d+", k)[0])
+    placeholders_q = sorted((k for k in keys if _TEMPLATE_Q_RE.match(k)), key=by_number)
+    placeholders_b = sorted((k for k in keys if _TEMPLATE_B_RE.match(k)), key=by_number)
+
+    questions: Dict[str, BankQuestion] = pools.questions
+
+    sample_q = None
+    pool_sizes: Dict[str, Tuple[int, int]] = {}
+    page_pools: Dict[str, List[str]] = {}
+    assembly, group_key = None, None
+    if manifest:
+        if compiled is not None and manifest.get("template_hash") != compiled.template_hash:
+            _emit("warning", message="Šablona se od uloženého manifestu změnila.")
+        selections = [dict(v.get("selection") or {}) for v in manifest["versions"]]
+        seed = manifest.get("seed")
+        k_hash = manifest.get("k_hash") or new_control_hash()
+    else:
+        question_pool = sorted(pools.union(sources, "classic"))
+        bonus_pool = sorted(pools.union(bonus_sources, "bonus"))
+        pool_sizes = {"klasických otázek": (len(question_pool), len(placeholders_q)),
+                      "bonusových otázek": (len(bonus_pool), len(placeholders_b))}
+        constraints = AssemblyConstraints(args.one_per_subgroup, max(0, args.target_points), args.equal_bonus)
+        if constraints.classic or constraints.equal_bonus:
+            sample_q, sample_b, assembly = assemble_versions(
+                question_pool, bonus_pool, len(placeholders_q), len(placeholders_b), count, questions.get,
+                pools.topics, constraints, seed=args.seed, max_overlap=args.max_overlap)
+            group_key = constraint_key(constraints, questions.get, pools.topics)
+        else:
+            sample_q = sample_versions(question_pool, len(placeholders_q), count,
+                                       seed=args.seed, max_overlap=args.max_overlap)
+            sample_b = sample_versions(bonus_pool, len(placeholders_b), count, seed=sample_q.seed + 1)
+        page_pools = {ph: question_pool for ph in placeholders_q}
+        page_pools.update((ph, bonus_pool) for ph in placeholders_b)
+        selections = []
+        for i in range(count):
+            sel = dict(zip(placeholders_q, sample_q.rows[i]))
+            sel.update(zip(placeholders_b, sample_b.rows[i]))
+            selections.append(sel)
+        seed = sample_q.seed
+        k_hash = new_control_hash()
+
+    # NOVÉ: odhad stran (bez LibreOffice); s --max-pages se delší verze zkrátí výměnou otázek
+    balance = None
+    if compiled is not None:
+        balance = rebalance_pages(selections, PageEstimator(compiled), questions.get, page_pools,
+                                  max(0, args.max_pages) if page_pools else 0, group_key)
+
+    # NOVÉ: celá dávka se zkontroluje najednou, ještě než vznikne první DOCX
+    extra_keys = ()
+    if args.roster:
+        try:
+            extra_keys = roster_columns(args.roster)
+        except (OSError, UnicodeDecodeError, csv.Error):
+            pass
+    report = preflight_export(compiled, selections, questions.get, template_error=template_error,
+                              pool_sizes=pool_sizes, extra_keys=extra_keys, output_path=args.output,
+                              pdf=args.pdf, page_balance=balance, assembly=assembly)
+    for msg in report.warnings:
+        _emit("warning", stage="preflight", message=msg)
+    for msg in report.errors:
+        _emit("error", stage="preflight", message=msg)
+    if args.check or not report.ok:
+        _emit("preflight", ok=report.ok, errors=len(report.errors), warnings=len(report.warnings),
+              versions=report.versions, images=report.images, ms=round(report.elapsed * 1000, 1),
+              pages=balance.summary() if balance else "", constraints=assembly.summary() if assembly else "")
+        return 0 if report.ok else 2
+
+    plan = PLACEHOLDERS.plan(keys)
+    if args.roster:
+        return _cli_roster_export(args, compiled, plan, selections, questions, dt, seed, data_path, sample_q)
+    combined = args.combined and is_multi
+    # S --pdf bez --keep-docx jsou DOCX jen mezivýstup: RAM složka + nejrychlejší komprese
+    fast = args.pdf and not args.keep_docx
+    work_dir = intermediate_dir("ceg_versions_") if (combined or fast) else None
+    if fast:
+        compiled.compresslevel = INTERMEDIATE_COMPRESSLEVEL
+    key_mode = args.answer_keys.replace("-", "_")
+    jobs: List[tuple] = []
+    key_versions: List[tuple] = []
+    for i, sel in enumerate(selections):
+        selection = {ph: questions.get(qid) for ph, qid in sel.items()}
+        ctx = PlaceholderContext(selection, dt, i, count, args.prefix, k_hash)
+        repl_plain, rich_map = plan.replacements(ctx)
+        target = version_output_path(args.output, i, is_multi)
+        jobs.append((i, work_dir / target.name if work_dir is not None else target, repl_plain, rich_map))
+        if key_mode != "none":
+            key_versions.append((version_label(ctx), answer_key_entries(selection)))
+
+    _emit("start", versions=count, placeholders=len(placeholders_q), bonus_placeholders=len(placeholders_b),
+          seed=seed, selection=sample_q.summary() if sample_q else "z manifestu", hash=k_hash,
+          pages=balance.summary() if balance else "", constraints=assembly.summary() if assembly else "")
+
+    # Pracovní procesy jen přes fork – spawn by znovu importoval main.py (a s ním PySide6)
+    mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    base_output = Path(args.output)
+    key_base = work_dir / base_output.name if fast else base_output
+    result = run_export(
+        compiled, jobs,
+        parallel=is_multi and mp_context is not None,
+        mp_context=mp_context,
+        image_cache=compiled.image_cache,
+        pdf_dir=(Path(args.pdf_dir) if args.pdf_dir else data_path.parent / "Tisk") if args.pdf else None,
+        merged_pdf_name=f"{base_output.stem}_merged.pdf" if is_multi else None,
+        render_cache=None if args.no_cache else RenderCache(data_path.parent / ".cache" / "render"),
+        combined_output=(key_base if fast else base_output) if combined else None,
+        answer_keys=answer_key_jobs(key_mode, key_base, key_versions, is_multi, k_hash),
+        progress=lambda stage, done, total, text: _emit("progress", stage=stage, done=done, total=total),
+        file_ready=lambda kind, path: _emit("file", kind=kind, path=path),
+    )
+
+    if fast:
+        if finalize_intermediates(result, work_dir, base_output.parent):
+            _emit("warning", message="PDF nevzniklo u všech souborů – DOCX bez PDF ponechány ve výstupní složce.")
+    elif work_dir is not None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if result.error:
+        _emit("error", message=result.error)
+    for i, err in sorted(result.failed.items()):
+        _emit("error", version=i + 1, message=err)
+    for err in dict.fromkeys(result.pdf_errors):
+        _emit("error", stage="pdf", message=err)
+    for err in result.key_errors:
+        _emit("error", stage="keys", message=err)
+    if result.merge_failed:
+        _emit("error", stage="merge", message="Nepodařilo se sloučit PDF (PyPDF2 / Ghostscript).")
+
+    produced = result.docx_files
+    if produced:
+        try:
+            write_manifest(base_output, compiled, selections, result, seed=seed, k_hash=k_hash,
+                           prefix=args.prefix, date=f"{dt:%Y-%m-%d %H:%M}", combined=combined)
+        except OSError as e:
+            _emit("warning", message=f"Nepodařilo se uložit manifest: {e}")
+    if produced and not args.no_history:
+        record = f"Balík {count} verzí: {base_output.name}" if is_multi else base_output.name
+        if combined:
+            record = f"Balík {count} verzí (1 DOCX): {base_output.name}"
+        try:
+            append_export_history(data_path.parent / "history.json", record, k_hash)
+        except Exception as e:
+            _emit("warning", message=f"Nepodařilo se uložit historii exportu: {e}")
+
+    _emit("done", docx=len(produced), failed=len(result.failed), pdf=str(result.final_pdf or ""),
+          keys=len(result.key_files),
+          docx_kept=not result.docx_discarded,
+          cached=result.cache_hits,
+          max_overlap=sample_q.max_overlap if sample_q else None,
+          mean_overlap=round(sample_q.mean_overlap, 3) if sample_q else None)
+    ok = (not result.failed and not result.pdf_errors and not result.merge_failed and not result.error
+          and not result.key_errors and bool(produced))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    _argv = sys.argv[1:]
+    if _argv[:1] == ["export"]:
+        _argv = _argv[1:]
+    sys.exit(cli_main(_argv))
@@ -13,31 +13,51 @@ Pozn.: Word numbering (numbering.xml) je mapováno pouze na výsledné vizuáln
 """
 from __future__ import annotations
 
+import bisect
+import csv
 import hashlib
-import secrets
-
-import subprocess
-
 import json
+import multiprocessing
+import mmap
+import shutil
+import struct
 import sys
+import threading
 import uuid as _uuid
 import re
 import os
 import html as _html
 import zipfile
+import zlib
 from xml.etree import ElementTree as ET
+from array import array
 from dataclasses import dataclass, asdict, field
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 import docx
-from docx.shared import Pt, RGBColor, Cm
-from docx.enum.text import WD_ALIGN_PARAGRAPH
 
-from html.parser import HTMLParser
+from export_engine import (
+    DEFAULT_PRINT_DPI, INTERMEDIATE_COMPRESSLEVEL, PLACEHOLDERS, AssemblyConstraints, AssemblyReport,
+    CompiledTemplate, ExportError, ExportResult, HTMLToDocxParser, ImageCache, PageBalance, PageEstimator,
+    PlaceholderContext, QuestionPools, RenderCache, RosterResult, answer_key_entries, answer_key_jobs,
+    append_export_history, append_export_history_batch, assemble_versions, base_points, cli_main,
+    constraint_key, convert_docx_to_pdf, count_roster, ensure_rich_ast, finalize_intermediates, intermediate_dir,
+    iter_roster, manifest_path, merge_pdfs, new_control_hash, preflight_export, read_manifest, rebalance_pages,
+    rich_ast_is_current, rich_ast_plain_text, roster_columns, roster_file_stem, roster_output_paths, run_export,
+    run_roster_export, sample_versions, unknown_placeholders, version_label, version_output_path, write_manifest,
+)
 
-from PySide6.QtCore import Qt, QSize, QSaveFile, QByteArray, QTimer, QDateTime, QPoint, QRect, QTime, QSettings
+# NOVÉ: headless export bez GUI (cron/CI) – rozhodne se ještě před importem PySide6
+if __name__ == "__main__" and sys.argv[1:2] == ["export"]:
+    multiprocessing.freeze_support()
+    sys.exit(cli_main(sys.argv[2:]))
+
+from PySide6.QtCore import (
+    Qt, QSize, QSaveFile, QByteArray, QTimer, QDateTime, QPoint, QRect, QTime, QSettings,
+    QObject, QThread, Signal, Slot,
+)
 from PySide6.QtGui import (
     QAction,
     QActionGroup,
@@ -90,7 +110,7 @@ from PySide6.QtWidgets import (
     QTreeWidget, QTreeWidgetItem, QSizePolicy
 )
 
-APP_VERSION = "8.4.7"
+APP_VERSION = "8.5.24"
 APP_NAME = f"Správce zkouškových testů (v{APP_VERSION})"
 
 # ---------------------------------------------------------------------------
@@ -192,6 +212,8 @@ class Question:
     image_width_cm: float = 0.0  # cílová šířka vloženého obrázku v DOCX (cm), 0 = default
     image_height_cm: float = 0.0  # cílová výška vloženého obrázku v DOCX (cm), 0 = default/auto
     image_keep_aspect: bool = True  # pokud True, UI udržuje poměr stran (šířka/výška) při editaci rozměrů
+    # NOVÉ: předparsovaný rich-text AST (export_engine.build_rich_ast) – verzovaný a vázaný na hash text_html
+    rich_ast: Dict[str, Any] = field(default_factory=dict)
 
     @staticmethod
     def new_default(q_type: str = "classic") -> "Question":
@@ -239,6 +261,802 @@ class Group:
 class RootData:
     groups: List[Group]
 
+# --------------------------- Dotazovací jazyk (filtr) ---------------------------
+#
+# Filtr stromu i výběr zdrojů v exportu používají stejný jednoduchý jazyk:
+#   type:bonus points>=2 has:image funny>0 group:"Symetrické" -podskupina:test RSA
+# Podmínky "pole:hodnota" / "pole>=číslo" se vyhodnocují nad sloupcovými indexy
+# (QuestionIndex), volná slova se hledají v názvu a čistém textu otázky.
+
+_QUERY_TOKEN_RE = re.compile(
+    r'(?P<neg>-)?'
+    r'(?:(?P<field>[^\W\d_][\w]*)(?P<op>>=|<=|!=|:|>|<|=)(?P<value>"[^"]*"?|[^\s"]+)'
+    r'|(?P<word>"[^"]*"?|[^\s"]+))'
+)
+
+# Aliasy polí (CZ i EN) -> interní název sloupce
+_QUERY_FIELDS = {
+    "type": "type", "typ": "type",
+    "points": "points", "body": "points", "pts": "points",
+    "bonus": "bonus_correct", "bonus_correct": "bonus_correct",
+    "bonus_wrong": "bonus_wrong", "malus": "bonus_wrong",
+    "funny": "funny", "vtipne": "funny", "vtipné": "funny",
+    "created": "created_at", "created_at": "created_at", "datum": "created_at",
+    "has": "has", "ma": "has", "má": "has",
+    "group": "group", "skupina": "group",
+    "subgroup": "subgroup", "podskupina": "subgroup",
+    "title": "title", "nazev": "title", "název": "title",
+    "text": "text",
+}
+
+_QUERY_TYPE_ALIASES = {
+    "classic": "classic", "klasicka": "classic", "klasická": "classic", "k": "classic",
+    "bonus": "bonus", "b": "bonus",
+}
+
+_QUERY_HAS_ALIASES = {
+    "image": "image", "img": "image", "obrazek": "image", "obrázek": "image",
+    "funny": "funny", "vtipne": "funny", "vtipné": "funny",
+    "answer": "answer", "odpoved": "answer", "odpověď": "answer",
+}
+
+_NUMERIC_QUERY_FIELDS = ("points", "bonus_correct", "bonus_wrong", "funny")
+
+QUERY_HELP_TEXT = (
+    "Volná slova hledají v názvu a textu otázky (\"více slov\" = fráze).\n"
+    "Podmínky (lze kombinovat, platí všechny současně):\n"
+    "  type:bonus | type:classic\n"
+    "  points>=2, points:1..3, bonus>0.5, malus<0, funny>0\n"
+    "  has:image | has:funny | has:answer\n"
+    "  group:\"Symetrické\", subgroup:AES\n"
+    "  created>=2025-01-01, created:2025-03\n"
+    "  title:…, text:…\n"
+    "Znak '-' před podmínkou ji neguje (např. -has:image)."
+)
+
+
+@dataclass
+class QueryTerm:
+    field: str          # interní název sloupce, "" = volné slovo
+    op: str             # ":", "=", "!=", ">", ">=", "<", "<="
+    value: str
+    negate: bool = False
+
+
+def parse_query(text: str) -> List[QueryTerm]:
+    """Rozloží text filtru na seznam podmínek. Neznámá pole se berou jako volný text."""
+    terms: List[QueryTerm] = []
+    for m in _QUERY_TOKEN_RE.finditer(text or ""):
+        negate = bool(m.group("neg"))
+        fld = m.group("field")
+        if fld is not None:
+            key = _QUERY_FIELDS.get(fld.lower())
+            value = m.group("value").strip('"')
+            if key is None:
+                # Např. "RSA:2048" – není to pole, hledáme doslova
+                terms.append(QueryTerm("", ":", f"{fld}{m.group('op')}{value}".lower(), negate))
+            else:
+                terms.append(QueryTerm(key, m.group("op"), value, negate))
+            continue
+        word = (m.group("word") or "").strip('"')
+        if word:
+            terms.append(QueryTerm("", ":", word.lower(), negate))
+    return terms
+
+
+def html_to_search_text(html_text: str) -> str:
+    """Převede HTML otázky na čistý text pro vyhledávání (bez <style>/<head>)."""
+    if not html_text:
+        return ""
+    s = re.sub(r'(?is)<(style|head)[^>]*>.*?</\1>', ' ', html_text)
+    s = re.sub(r'<[^>]+>', ' ', s)
+    return _html.unescape(s)
+
+
+def cached_search_plain(q: Any, cache: Dict[str, Tuple[str, str]]) -> str:
+    """Čistý text otázky (malými) s cache podle ID; přepočítá se jen při změně HTML."""
+    html_text = q.text_html or ""
+    hit = cache.get(q.id)
+    if hit is not None and (hit[0] is html_text or hit[0] == html_text):
+        return hit[1]
+    ast = getattr(q, "rich_ast", None)
+    if ast and rich_ast_is_current(ast, html_text):
+        plain = rich_ast_plain_text(ast).lower()
+    else:
+        plain = html_to_search_text(html_text).lower()
+    cache[q.id] = (html_text, plain)
+    return plain
+
+
+class QuestionIndex:
+    """
+    Sloupcový index otázek pro rychlé filtrování.
+
+    Každá otázka má číslo řádku; kategorická pole jsou invertované slovníky
+    (hodnota -> množina řádků), číselná pole a datum jsou seřazené sloupce,
+    nad kterými se rozsahy hledají půlením intervalu (bisect).
+    """
+
+    def __init__(self, groups: List[Any], plain_cache: Optional[Dict[str, Tuple[str, str]]] = None,
+                 search_index: Optional["PersistentSearchIndex"] = None) -> None:
+        # plain_cache: qid -> (text_html, čistý text malými) – sdílená cache mezi sestaveními
+        self._plain_cache = plain_cache if plain_cache is not None else {}
+        self.search_index = search_index
+        self.ids: List[str] = []
+        self.row_of: Dict[str, int] = {}
+        self.questions: List[Any] = []             # řádek -> objekt otázky
+        self.titles: List[str] = []
+        self.plain: List[str] = []
+        self.by_type: Dict[str, set] = {}
+        self.has: Dict[str, set] = {"image": set(), "funny": set(), "answer": set()}
+        self.group_names: Dict[str, set] = {}      # lower(name) -> řádky
+        self.subgroup_names: Dict[str, set] = {}   # lower(name) -> řádky (včetně vnořených)
+        self.node_rows: Dict[str, set] = {}        # id skupiny/podskupiny -> řádky pod ní
+        self._numeric_raw: Dict[str, List[Tuple[Any, int]]] = {f: [] for f in _NUMERIC_QUERY_FIELDS}
+        self._numeric_raw["created_at"] = []
+
+        for g in groups:
+            g_rows = self.node_rows.setdefault(g.id, set())
+            self.group_names.setdefault((g.name or "").lower(), set())
+            self._add_subgroups(g, g.subgroups, [g_rows], [])
+
+        # Seřazené sloupce: (hodnoty, řádky) ve stejném pořadí
+        self.sorted_cols: Dict[str, Tuple[List[Any], List[int]]] = {}
+        for fld, pairs in self._numeric_raw.items():
+            pairs.sort(key=lambda p: p[0])
+            self.sorted_cols[fld] = ([p[0] for p in pairs], [p[1] for p in pairs])
+        del self._numeric_raw
+        self.all_rows = frozenset(range(len(self.ids)))
+
+    def _add_subgroups(self, g: Any, subgroups: List[Any], ancestor_sets: List[set], sg_names: List[str]) -> None:
+        for sg in subgroups:
+            sg_rows = self.node_rows.setdefault(sg.id, set())
+            path_sets = ancestor_sets + [sg_rows]
+            names = sg_names + [(sg.name or "").lower()]
+            for q in sg.questions:
+                row = len(self.ids)
+                self.ids.append(q.id)
+                self.row_of[q.id] = row
+                self.questions.append(q)
+                self.titles.append((q.title or "").lower())
+                self.plain.append(cached_search_plain(q, self._plain_cache))
+                self.by_type.setdefault(q.type or "classic", set()).add(row)
+                img = getattr(q, "image_path", "") or ""
+                if img and os.path.exists(img):
+                    self.has["image"].add(row)
+                funny_count = len(getattr(q, "funny_answers", None) or [])
+                if funny_count:
+                    self.has["funny"].add(row)
+                if (getattr(q, "correct_answer", "") or "").strip():
+                    self.has["answer"].add(row)
+                for s in path_sets:
+                    s.add(row)
+                self.group_names[(g.name or "").lower()].add(row)
+                for n in names:
+                    self.subgroup_names.setdefault(n, set()).add(row)
+                self._numeric_raw["points"].append((float(q.points or 0), row))
+                self._numeric_raw["bonus_correct"].append((float(q.bonus_correct or 0.0), row))
+                self._numeric_raw["bonus_wrong"].append((float(q.bonus_wrong or 0.0), row))
+                self._numeric_raw["funny"].append((float(funny_count), row))
+                self._numeric_raw["created_at"].append((str(q.created_at or ""), row))
+            self._add_subgroups(g, sg.subgroups, path_sets, names)
+
+    # ---- vyhodnocení jednotlivých podmínek ----
+
+    def _range(self, fld: str, op: str, value: Any) -> set:
+        values, rows = self.sorted_cols[fld]
+        if op in (":", "="):
+            lo, hi = bisect.bisect_left(values, value), bisect.bisect_right(values, value)
+        elif op == ">":
+            lo, hi = bisect.bisect_right(values, value), len(values)
+        elif op == ">=":
+            lo, hi = bisect.bisect_left(values, value), len(values)
+        elif op == "<":
+            lo, hi = 0, bisect.bisect_left(values, value)
+        elif op == "<=":
+            lo, hi = 0, bisect.bisect_right(values, value)
+        elif op == "!=":
+            return set(self.all_rows) - self._range(fld, "=", value)
+        else:
+            return set()
+        return set(rows[lo:hi])
+
+    def _names_rows(self, names: Dict[str, set], value: str, op: str) -> set:
+        v = value.lower()
+        res: set = set()
+        for name, rows in names.items():
+            if (name == v) if op == "=" else (v in name):
+                res |= rows
+        return res
+
+    def doc_texts(self) -> Dict[str, str]:
+        """Texty dokumentů pro fulltextový index (název + čistý text, malými)."""
+        return {qid: f"{self.titles[r]}\n{self.plain[r]}" for r, qid in enumerate(self.ids)}
+
+    def _text_rows(self, word: str, field: str = "") -> set:
+        rows: Any = range(len(self.ids))
+        if self.search_index is not None:
+            cand = self.search_index.candidates(word)
+            if cand is not None:
+                # Index vrací kandidáty, shodu ověříme podřetězcem
+                rows = [self.row_of[qid] for qid in cand if qid in self.row_of]
+        if field == "title":
+            return {r for r in rows if word in self.titles[r]}
+        if field == "text":
+            return {r for r in rows if word in self.plain[r]}
+        return {r for r in rows if word in self.titles[r] or word in self.plain[r]}
+
+    def _term_rows(self, t: QueryTerm) -> set:
+        if not t.field:
+            return self._text_rows(t.value)
+        if t.field == "type":
+            return set(self.by_type.get(_QUERY_TYPE_ALIASES.get(t.value.lower(), t.value.lower()), set()))
+        if t.field == "has":
+            return set(self.has.get(_QUERY_HAS_ALIASES.get(t.value.lower(), t.value.lower()), set()))
+        if t.field == "group":
+            return self._names_rows(self.group_names, t.value, t.op)
+        if t.field == "subgroup":
+            return self._names_rows(self.subgroup_names, t.value, t.op)
+        if t.field in ("title", "text"):
+            return self._text_rows(t.value.lower(), t.field)
+        if t.field == "created_at":
+            v = t.value
+            if t.op in (":", "="):
+                # Prefixové porovnání: created:2025-01 = vše z ledna 2025
+                values, rows = self.sorted_cols["created_at"]
+                return {rows[i] for i, val in enumerate(values) if val.startswith(v)}
+            return self._range("created_at", t.op, v)
+        if t.field in _NUMERIC_QUERY_FIELDS:
+            raw = t.value.replace(",", ".")
+            if ".." in raw:
+                lo_s, hi_s = raw.split("..", 1)
+                try:
+                    res = self._range(t.field, ">=", float(lo_s)) if lo_s else set(self.all_rows)
+                    if hi_s:
+                        res &= self._range(t.field, "<=", float(hi_s))
+                    return res
+                except ValueError:
+                    return set()
+            try:
+                return self._range(t.field, t.op, float(raw))
+            except ValueError:
+                return set()
+        return set()
+
+    def match_rows(self, terms: List[QueryTerm]) -> set:
+        """Vrátí množinu řádků vyhovujících všem podmínkám (AND)."""
+        positive = [t for t in terms if not t.negate]
+        negative = [t for t in terms if t.negate]
+        # Nejprve levné kategorické podmínky, volný text nakonec
+        positive.sort(key=lambda t: (t.field == "" or t.field in ("title", "text")))
+        result: Optional[set] = None
+        for t in positive:
+            rows = self._term_rows(t)
+            result = rows if result is None else (result & rows)
+            if not result:
+                return set()
+        if result is None:
+            result = set(self.all_rows)
+        for t in negative:
+            result -= self._term_rows(t)
+        return result
+
+    def match_ids(self, query: str) -> set:
+        """Vrátí množinu ID otázek vyhovujících dotazu (prázdný dotaz = vše)."""
+        rows = self.match_rows(parse_query(query))
+        return {self.ids[r] for r in rows}
+
+    def ids_of_type(self, q_type: str) -> set:
+        """ID všech otázek daného typu."""
+        return {self.ids[r] for r in self.by_type.get(q_type, set())}
+
+    def ids_under(self, node_id: str, q_type: Optional[str] = None) -> set:
+        """ID otázek pod skupinou/podskupinou (rekurzivně), volitelně jen daného typu."""
+        rows = self.node_rows.get(node_id, set())
+        if q_type is not None:
+            rows = rows & self.by_type.get(q_type, set())
+        return {self.ids[r] for r in rows}
+
+
+_HTML_TAG_SPLIT_RE = re.compile(r'(<[^>]+>)')
+
+
+def replace_in_html_text(html_text: str, rx: "re.Pattern", repl: Any) -> Tuple[str, int]:
+    """
+    Nahradí shody regexu jen v textových uzlech HTML (ne v tazích, atributech ani <style>).
+    Text se porovnává bez entit (&amp; -> &) a změněné úseky se znovu escapují.
+    Vrací (nové_html, počet_nahrazení).
+    """
+    if not html_text:
+        return html_text, 0
+    parts = _HTML_TAG_SPLIT_RE.split(html_text)
+    total = 0
+    skip = False
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            low = part[:7].lower()
+            if low.startswith("<style") or low.startswith("<head"):
+                skip = True
+            elif low.startswith("</style") or low.startswith("</head"):
+                skip = False
+            continue
+        if skip or not part:
+            continue
+        text = _html.unescape(part)
+        new_text, n = rx.subn(repl, text)
+        if n:
+            parts[i] = _html.escape(new_text, quote=False)
+            total += n
+    return ("".join(parts) if total else html_text), total
+
+
+def compile_find_pattern(find: str, use_regex: bool, case_sensitive: bool) -> "re.Pattern":
+    """Zkompiluje hledaný výraz (doslovný text nebo regex). Chybný regex vyhodí re.error."""
+    flags = 0 if case_sensitive else re.IGNORECASE
+    return re.compile(find if use_regex else re.escape(find), flags)
+
+
+# --------------------------- Perzistentní fulltextový index ---------------------------
+
+SEARCH_INDEX_MAGIC = b"CEGTRI01"
+# magic, sha256 otisk questions.json, počet dokumentů, počet termů, offsety sekcí
+_SEARCH_HEADER = struct.Struct("<8s32sIIQQQ")
+_SEARCH_TERM = struct.Struct("<12sII")   # trigram (UTF-32-BE), offset postingů, počet
+_SEARCH_DOC = struct.Struct("<IH")       # crc32 textu, délka ID v bajtech
+SEARCH_DELTA_REBUILD_LIMIT = 200         # nad tento počet změněných dokumentů se index přestaví
+
+
+def _trigram_key(gram: str) -> bytes:
+    return gram.encode("utf-32-be").ljust(12, b"\0")
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PersistentSearchIndex:
+    """
+    Trigramový index otázek uložený v data/.cache/search_index.bin.
+
+    Soubor je svázán s otiskem (sha256) questions.json a čte se přes mmap:
+    tabulka termů je seřazená, takže se hledá půlením intervalu přímo v mapě.
+    Změny od posledního sestavení drží delta (dokumenty změněné / smazané),
+    která se ukládá vedle indexu při každém save_data. Když je index zastaralý
+    nebo delta příliš velká, přestaví se ve vlákně na pozadí.
+
+    Index vrací pouze kandidáty (nadmnožinu), shoda se vždy ověřuje podřetězcem.
+    """
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.path = self.cache_dir / "search_index.bin"
+        self.delta_path = self.cache_dir / "search_index.delta.json"
+        self._lock = threading.Lock()
+        self._file = None
+        self._mm = None
+        self.base_fingerprint = ""
+        self.doc_ids: List[str] = []
+        self.doc_crc: Dict[str, int] = {}
+        self._n_terms = 0
+        self._term_off = 0
+        self.delta: Dict[str, str] = {}      # qid -> text (nové / změněné od sestavení)
+        self.deleted: set = set()            # qid smazané od sestavení
+        self.fingerprint = ""                # otisk stavu, který index (base + delta) popisuje
+        self._rebuild_thread: Optional[threading.Thread] = None
+
+    # ---- načtení / zápis ----
+
+    def open(self, fingerprint: str) -> bool:
+        """Načte index z disku. Vrací True, pokud odpovídá otisku (případně s deltou)."""
+        with self._lock:
+            self._close_map()
+            self.delta, self.deleted = {}, set()
+            if not self._open_map():
+                return False
+            if self.base_fingerprint == fingerprint:
+                self.fingerprint = fingerprint
+                return True
+            try:
+                with open(self.delta_path, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+                if raw.get("base") == self.base_fingerprint and raw.get("fingerprint") == fingerprint:
+                    self.delta = dict(raw.get("docs", {}))
+                    self.deleted = set(raw.get("deleted", []))
+                    self.fingerprint = fingerprint
+                    return True
+            except Exception:
+                pass
+            return False
+
+    def _open_map(self) -> bool:
+        try:
+            self._file = open(self.path, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, fp, n_docs, n_terms, doc_off, term_off, _post_off = _SEARCH_HEADER.unpack_from(self._mm, 0)
+            if magic != SEARCH_INDEX_MAGIC:
+                raise ValueError("neplatný formát indexu")
+            ids: List[str] = []
+            crcs: Dict[str, int] = {}
+            pos = doc_off
+            for _ in range(n_docs):
+                crc, ln = _SEARCH_DOC.unpack_from(self._mm, pos)
+                pos += _SEARCH_DOC.size
+                qid = self._mm[pos:pos + ln].decode("utf-8")
+                pos += ln
+                ids.append(qid)
+                crcs[qid] = crc
+            self.base_fingerprint = fp.hex()
+            self.doc_ids, self.doc_crc = ids, crcs
+            self._n_terms, self._term_off = n_terms, term_off
+            return True
+        except Exception:
+            self._close_map()
+            return False
+
+    def _close_map(self) -> None:
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except Exception:
+                pass
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+        self._mm = self._file = None
+        self.base_fingerprint = ""
+        self.doc_ids, self.doc_crc = [], {}
+        self._n_terms = self._term_off = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_map()
+
+    @staticmethod
+    def build_bytes(texts: Dict[str, str], fingerprint: str) -> bytes:
+        """Sestaví binární podobu indexu z {qid: text}."""
+        ids = list(texts.keys())
+        postings: Dict[str, List[int]] = {}
+        for n, qid in enumerate(ids):
+            for gram in _trigrams(texts[qid]):
+                postings.setdefault(gram, []).append(n)
+
+        doc_blob = bytearray()
+        for qid in ids:
+            raw = qid.encode("utf-8")
+            doc_blob += _SEARCH_DOC.pack(zlib.crc32(texts[qid].encode("utf-8")), len(raw)) + raw
+
+        terms = sorted((_trigram_key(g), lst) for g, lst in postings.items())
+        term_blob = bytearray()
+        post_blob = bytearray()
+        for key, lst in terms:
+            term_blob += _SEARCH_TERM.pack(key, len(post_blob), len(lst))
+            post_blob += array("I", lst).tobytes()
+
+        doc_off = _SEARCH_HEADER.size
+        term_off = doc_off + len(doc_blob)
+        post_off = term_off + len(term_blob)
+        header = _SEARCH_HEADER.pack(SEARCH_INDEX_MAGIC, bytes.fromhex(fingerprint), len(ids),
+                                     len(terms), doc_off, term_off, post_off)
+        return header + bytes(doc_blob) + bytes(term_blob) + bytes(post_blob)
+
+    def _write_delta(self) -> None:
+        payload = {"base": self.base_fingerprint, "fingerprint": self.fingerprint,
+                   "docs": self.delta, "deleted": sorted(self.deleted)}
+        tmp = self.delta_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp, self.delta_path)
+
+    # ---- aktualizace ----
+
+    def sync(self, texts: Dict[str, str], fingerprint: Optional[str] = None) -> int:
+        """
+        Porovná aktuální texty s indexem (crc32) a promítne rozdíly do delty.
+        S otiskem (volá se po uložení) deltu i zapíše na disk. Vrací velikost delty.
+        """
+        with self._lock:
+            base_crc = self.doc_crc
+            delta: Dict[str, str] = {}
+            for qid, text in texts.items():
+                if base_crc.get(qid) != zlib.crc32(text.encode("utf-8")):
+                    delta[qid] = text
+            deleted = {qid for qid in base_crc if qid not in texts}
+            changed = (delta != self.delta) or (deleted != self.deleted)
+            self.delta, self.deleted = delta, deleted
+            if fingerprint is not None and (changed or fingerprint != self.fingerprint):
+                self.fingerprint = fingerprint
+                if self._mm is not None:
+                    try:
+                        self.cache_dir.mkdir(parents=True, exist_ok=True)
+                        self._write_delta()
+                    except Exception as e:
+                        print(f"Search index: nelze uložit deltu: {e}")
+            return len(self.delta) + len(self.deleted)
+
+    def needs_rebuild(self) -> bool:
+        with self._lock:
+            if self._mm is None:
+                return True
+            return (len(self.delta) + len(self.deleted)) > SEARCH_DELTA_REBUILD_LIMIT
+
+    def rebuild_async(self, texts: Dict[str, str], fingerprint: str) -> None:
+        """Přestaví index ve vlákně na pozadí (texts je snímek, vlákno nečte model)."""
+        if self._rebuild_thread is not None and self._rebuild_thread.is_alive():
+            return
+        snapshot = dict(texts)
+
+        def worker() -> None:
+            try:
+                data = self.build_bytes(snapshot, fingerprint)
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix(".tmp")
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                with self._lock:
+                    # Delta drží nejnovější texty – po výměně ponecháme jen to, co se od snímku liší
+                    latest = {qid: t for qid, t in snapshot.items() if qid not in self.deleted}
+                    latest.update(self.delta)
+                    self._close_map()
+                    os.replace(tmp, self.path)
+                    self._open_map()
+                    self.delta = {qid: t for qid, t in latest.items()
+                                  if self.doc_crc.get(qid) != zlib.crc32(t.encode("utf-8"))}
+                    self.deleted = {qid for qid in self.doc_crc if qid not in latest}
+                    if not self.fingerprint:
+                        self.fingerprint = fingerprint
+                    if self.fingerprint != self.base_fingerprint:
+                        self._write_delta()
+                    elif self.delta_path.exists():
+                        self.delta_path.unlink()
+            except Exception as e:
+                print(f"Search index: přestavba selhala: {e}")
+
+        self._rebuild_thread = threading.Thread(target=worker, name="search-index-rebuild", daemon=True)
+        self._rebuild_thread.start()
+
+    # ---- dotazy ----
+
+    def _postings(self, gram: str) -> Optional[array]:
+        key = _trigram_key(gram)
+        mm, lo, hi = self._mm, 0, self._n_terms
+        size = _SEARCH_TERM.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off = self._term_off + mid * size
+            k = mm[off:off + 12]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                _k, p_off, count = _SEARCH_TERM.unpack_from(mm, off)
+                post_off = _SEARCH_HEADER.unpack_from(mm, 0)[6]
+                arr = array("I")
+                arr.frombytes(mm[post_off + p_off:post_off + p_off + 4 * count])
+                return arr
+        return None
+
+    def candidates(self, word: str) -> Optional[set]:
+        """
+        Vrátí množinu ID otázek, které mohou obsahovat `word` (malými písmeny),
+        nebo None, pokud index nelze použít (krátké slovo, index nenačtený).
+        """
+        if len(word) < 3:
+            return None
+        with self._lock:
+            if self._mm is None:
+                return None
+            lists = []
+            for gram in _trigrams(word):
+                arr = self._postings(gram)
+                if arr is None:
+                    lists = []
+                    break
+                lists.append(arr)
+            result: set = set()
+            if lists:
+                lists.sort(key=len)
+                rows = set(lists[0])
+                for arr in lists[1:]:
+                    rows.intersection_update(arr)
+                    if not rows:
+                        break
+                ids = self.doc_ids
+                result = {ids[r] for r in rows}
+            result -= self.deleted
+            result -= self.delta.keys()
+            result.update(qid for qid, t in self.delta.items() if word in t)
+            return result
+
+
+# --------------------------- Agregované statistiky banky ---------------------------
+
+@dataclass
+class NodeStats:
+    """Součty za uzel (skupina / podskupina včetně vnořených, "" = celá banka)."""
+    classic: int = 0
+    bonus: int = 0
+    images: int = 0
+    with_funny: int = 0
+    funny_answers: int = 0
+    bonus_points: float = 0.0
+    points_hist: Dict[int, int] = field(default_factory=dict)  # body klasických otázek -> počet
+
+    @property
+    def total(self) -> int:
+        return self.classic + self.bonus
+
+
+class BankStats:
+    """
+    Agregace per uzel stromu s mapou rodičů.
+
+    Změna jedné otázky se promítne jen do jejího uzlu a jeho předků (O(hloubka)),
+    strukturální změny (přesuny, importy, mazání) se řeší přestavbou při obnově stromu.
+    """
+    ROOT = ""
+
+    def __init__(self, groups: List[Any]) -> None:
+        self.nodes: Dict[str, NodeStats] = {self.ROOT: NodeStats()}
+        self.parent: Dict[str, str] = {}
+        self.q_node: Dict[str, str] = {}
+        self.q_contrib: Dict[str, Tuple[bool, bool, int, int, float]] = {}
+        for g in groups:
+            self.nodes[g.id] = NodeStats()
+            self.parent[g.id] = self.ROOT
+            self._add_subgroups(g.id, g.subgroups)
+
+    def _add_subgroups(self, parent_id: str, subgroups: List[Any]) -> None:
+        for sg in subgroups:
+            self.nodes[sg.id] = NodeStats()
+            self.parent[sg.id] = parent_id
+            for q in sg.questions:
+                self.set_question(q, sg.id)
+            self._add_subgroups(sg.id, sg.subgroups)
+
+    @staticmethod
+    def contribution(q: Any) -> Tuple[bool, bool, int, int, float]:
+        img = getattr(q, "image_path", "") or ""
+        is_bonus = q.type == "bonus"
+        return (
+            is_bonus,
+            bool(img and os.path.exists(img)),
+            len(getattr(q, "funny_answers", None) or []),
+            0 if is_bonus else int(q.points or 0),
+            float(q.bonus_correct or 0.0) if is_bonus else 0.0,
+        )
+
+    def _apply(self, node_id: str, c: Tuple[bool, bool, int, int, float], sign: int) -> None:
+        is_bonus, has_img, funny, points, bonus_pts = c
+        nid: Optional[str] = node_id
+        while nid is not None:
+            st = self.nodes.get(nid)
+            if st is None:
+                st = self.nodes[nid] = NodeStats()
+            if is_bonus:
+                st.bonus += sign
+                st.bonus_points = round(st.bonus_points + sign * bonus_pts, 2)
+            else:
+                st.classic += sign
+                cnt = st.points_hist.get(points, 0) + sign
+                if cnt:
+                    st.points_hist[points] = cnt
+                else:
+                    st.points_hist.pop(points, None)
+            st.images += sign * int(has_img)
+            st.with_funny += sign * int(funny > 0)
+            st.funny_answers += sign * funny
+            nid = self.parent.get(nid) if nid != self.ROOT else None
+
+    def set_question(self, q: Any, node_id: str) -> None:
+        """Přidá / aktualizuje otázku v uzlu node_id (delta jen po cestě ke kořeni)."""
+        new = self.contribution(q)
+        old = self.q_contrib.get(q.id)
+        old_node = self.q_node.get(q.id)
+        if old is not None and old == new and old_node == node_id:
+            return
+        if old is not None:
+            self._apply(old_node, old, -1)
+        self._apply(node_id, new, +1)
+        self.q_contrib[q.id] = new
+        self.q_node[q.id] = node_id
+
+    def remove_question(self, qid: str) -> None:
+        old = self.q_contrib.pop(qid, None)
+        node = self.q_node.pop(qid, None)
+        if old is not None:
+            self._apply(node, old, -1)
+
+    def get(self, node_id: str = "") -> NodeStats:
+        return self.nodes.get(node_id) or NodeStats()
+
+
+# --------------------------- Téměř duplicitní otázky (MinHash / LSH) ---------------------------
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16          # 16 pásem × 4 řádky -> práh kandidáta cca J ≈ 0.5
+MINHASH_SHINGLE = 5         # délka znakového shinglu
+
+def question_shingles(plain_text: str, k: int = MINHASH_SHINGLE) -> set:
+    """Množina 32bit hashů znakových k-shinglů normalizovaného textu (malá písmena, jedna mezera)."""
+    norm = " ".join((plain_text or "").lower().split())
+    if not norm:
+        return set()
+    if len(norm) <= k:
+        return {zlib.crc32(norm.encode("utf-8"))}
+    return {zlib.crc32(norm[i:i + k].encode("utf-8")) for i in range(len(norm) - k + 1)}
+
+
+def minhash_signature(shingles: set) -> Tuple[int, ...]:
+    """
+    MinHash podpis metodou "one permutation hashing": každý shingle se jedním
+    průchodem zařadí do jednoho z MINHASH_PERMUTATIONS košů a v koši se drží minimum.
+    Prázdné koše (krátké texty) se doplní rotací z následujícího neprázdného koše.
+    Cena je O(počet shinglů) místo O(počet shinglů × počet permutací).
+    """
+    n = MINHASH_PERMUTATIONS
+    sig: List[Optional[int]] = [None] * n
+    for h in shingles:
+        h = (h * 0x9E3779B1) & 0xFFFFFFFF   # promíchání bitů crc32
+        b = h % n
+        v = h // n
+        cur = sig[b]
+        if cur is None or v < cur:
+            sig[b] = v
+    if None in sig:
+        filled = [i for i in range(n) if sig[i] is not None]
+        offset = (0xFFFFFFFF // n) + 1
+        for i in range(n):
+            if sig[i] is None:
+                # nejbližší neprázdný koš vpravo (cyklicky)
+                j = filled[bisect.bisect_left(filled, i) % len(filled)]
+                sig[i] = sig[j] + ((j - i) % n) * offset
+    return tuple(sig)
+
+
+def find_near_duplicates(texts: Dict[str, str], threshold: float = 0.8) -> List[Tuple[str, str, float]]:
+    """
+    Najde dvojice textů s Jaccardovou podobností shinglů >= threshold.
+
+    Kandidáti se hledají přes LSH (podpis rozdělený do pásem, shoda v libovolném
+    pásmu = kandidát), takže se neporovnává každý s každým. Kandidáti se ověří
+    přesnou Jaccardovou podobností. Vrací [(id_a, id_b, podobnost)] seřazené sestupně.
+    """
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    shingle_map: Dict[str, set] = {}
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[str]] = {}
+
+    for qid, text in texts.items():
+        sh = question_shingles(text)
+        if not sh:
+            continue
+        shingle_map[qid] = sh
+        sig = minhash_signature(sh)
+        for b in range(MINHASH_BANDS):
+            buckets.setdefault((b, sig[b * rows:(b + 1) * rows]), []).append(qid)
+
+    candidates: set = set()
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        for i in range(len(members)):
+            for j in range(i + 1, len(members)):
+                a, b = members[i], members[j]
+                candidates.add((a, b) if a < b else (b, a))
+
+    result: List[Tuple[str, str, float]] = []
+    for a, b in candidates:
+        sa, sb = shingle_map[a], shingle_map[b]
+        inter = len(sa & sb)
+        sim = inter / float(len(sa) + len(sb) - inter)
+        if sim >= threshold:
+            result.append((a, b, sim))
+    result.sort(key=lambda t: (-t[2], t[0], t[1]))
+    return result
+
+
 # --------------------------- Utility: Dark theme ---------------------------
 
 def apply_dark_theme(app: QApplication) -> None:
@@ -261,7 +1079,7 @@ def apply_dark_theme(app: QApplication) -> None:
 
 class MultiSourceDialog(QDialog):
     """Dialog se stromem a checkboxy pro výběr více zdrojů s počítadlem otázek."""
-    def __init__(self, owner: "MainWindow", selected_data: list) -> None:
+    def __init__(self, owner: "MainWindow", selected_data: list, query: str = "") -> None:
         super().__init__(owner)
         self.setWindowTitle("Vyberte zdroje otázek")
         self.resize(600, 700)
@@ -270,11 +1088,22 @@ class MultiSourceDialog(QDialog):
         # Ukládáme si vybraná ID
         self.selected_ids = {item['id'] for item in selected_data} if selected_data else set()
         
+        # NOVÉ: Dotaz (stejný jazyk jako filtr stromu) omezující otázky ve zdrojích
+        self.index = owner._get_question_index()
+        self.allowed_ids: Optional[set] = None
+        
         layout = QVBoxLayout(self)
         layout.setContentsMargins(8, 8, 8, 8)
         
         layout.addWidget(QLabel("Zaškrtněte skupiny nebo podskupiny, ze kterých se mají náhodně vybírat otázky.\n(Výběr skupiny automaticky zahrne všechny její podskupiny)"))
         
+        self.le_query = QLineEdit()
+        self.le_query.setPlaceholderText("Dotaz (volitelné): např. points>=2 has:image -subgroup:test")
+        self.le_query.setToolTip(QUERY_HELP_TEXT)
+        self.le_query.setText(query or "")
+        self._set_query(query or "")
+        layout.addWidget(self.le_query)
+        
         self.tree = QTreeWidget()
         self.tree.setHeaderLabels(["Název zdroje"])
         self.tree.header().hide()
@@ -306,16 +1135,35 @@ class MultiSourceDialog(QDialog):
         
         # Prvotní přepočet
         self._recalculate_total()
+        
+        self.le_query.textChanged.connect(self._on_query_changed)
+
+    def _set_query(self, text: str) -> None:
+        text = (text or "").strip()
+        self.allowed_ids = self.index.match_ids(text) if text else None
+
+    def _on_query_changed(self, text: str) -> None:
+        """Přepočítá počty ve stromu podle dotazu; zaškrtnutí zůstává zachováno."""
+        self.selected_ids = {item["id"] for item in self.get_selected_items()}
+        self._set_query(text)
+        self._is_populating = True
+        self.tree.clear()
+        self._populate_tree(self.owner.root.groups)
+        self._is_populating = False
+        self._recalculate_total()
+
+    def get_query(self) -> str:
+        return self.le_query.text().strip()
 
     def _get_classic_count(self, node):
-        """Rekurzivně spočítá klasické otázky v uzlu."""
-        count = 0
-        if hasattr(node, "questions"):
-            count += len([q for q in node.questions if q.type == "classic"])
-        if hasattr(node, "subgroups") and node.subgroups:
-            for sub in node.subgroups:
-                count += self._get_classic_count(sub)
-        return count
+        """Počet klasických otázek v uzlu (včetně vnořených), případně omezený dotazem."""
+        if self.allowed_ids is None:
+            # Bez dotazu stačí předpočítané agregace
+            return self.owner._get_bank_stats().get(node.id).classic
+        ids = self.index.ids_under(node.id, "classic")
+        if self.allowed_ids is not None:
+            ids &= self.allowed_ids
+        return len(ids)
 
     def _populate_tree(self, groups):
         def add_sub_recursive(parent_item, subs):
@@ -798,12 +1646,13 @@ class BonusQuestionSelectorDialog(QDialog):
         self._recalculate_total()
 
     def _populate_tree(self):
+        stats = self.owner._get_bank_stats()
         for g in self.owner.root.groups:
-            bonus_questions_in_group = self._collect_bonus_questions(g)
-            if not bonus_questions_in_group:
+            n_bonus = stats.get(g.id).bonus
+            if not n_bonus:
                 continue
 
-            g_item = QTreeWidgetItem([g.name])
+            g_item = QTreeWidgetItem([f"{g.name} ({n_bonus})"])
             g_item.setFlags(g_item.flags() | Qt.ItemIsUserCheckable)
             g_item.setFlags(g_item.flags() & ~Qt.ItemIsAutoTristate)
             g_item.setCheckState(0, Qt.Unchecked)
@@ -815,12 +1664,15 @@ class BonusQuestionSelectorDialog(QDialog):
             g_item.setExpanded(True)
 
     def _add_subgroups_recursive(self, parent_item, subgroups):
+        stats = self.owner._get_bank_stats()
         for sg in subgroups:
-            bonus_questions_in_subgroup = self._collect_bonus_questions(sg)
-            if not bonus_questions_in_subgroup:
+            n_bonus = stats.get(sg.id).bonus
+            if not n_bonus:
                 continue
+            # Přímo v podskupině; vnořené přidá rekurze (dříve se zobrazovaly dvakrát)
+            bonus_questions_in_subgroup = [q for q in sg.questions if q.type == "bonus"]
 
-            sg_item = QTreeWidgetItem([sg.name])
+            sg_item = QTreeWidgetItem([f"{sg.name} ({n_bonus})"])
             sg_item.setFlags(sg_item.flags() | Qt.ItemIsUserCheckable)
             sg_item.setFlags(sg_item.flags() & ~Qt.ItemIsAutoTristate)
             sg_item.setCheckState(0, Qt.Unchecked)
@@ -842,15 +1694,6 @@ class BonusQuestionSelectorDialog(QDialog):
 
             sg_item.setExpanded(True)
 
-    def _collect_bonus_questions(self, node) -> list:
-        questions = []
-        if hasattr(node, "questions"):
-            questions.extend([q for q in node.questions if q.type == "bonus"])
-        if hasattr(node, "subgroups"):
-            for sub in node.subgroups:
-                questions.extend(self._collect_bonus_questions(sub))
-        return questions
-
     def _on_item_changed(self, item, column):
         if self._is_populating: return
         state = item.checkState(0)
@@ -972,6 +1815,16 @@ class MoveTargetDialog(QDialog):
         return "", None
 
 
+PDF_MERGE_HELP = (
+    "Nepodařilo se sloučit PDF soubory.\n"
+    "Chybí potřebné nástroje.\n\n"
+    "Řešení (vyberte jedno):\n"
+    "1. Nainstalujte python knihovnu:  pip install PyPDF2\n"
+    "2. Nainstalujte Ghostscript:      brew install ghostscript\n\n"
+    "Jednotlivé PDF soubory byly ponechány ve složce."
+)
+
+
 # --------------------------- Export Wizard ---------------------------
 
 def cz_day_of_week(dt: datetime) -> str:
@@ -984,231 +1837,45 @@ def round_dt_to_10m(dt: QDateTime) -> QDateTime:
     return QDateTime(dt.date(), dt.time().addSecs((rounded - m) * 60))
 
 
-# ---- HTML -> jednoduché mezireprezentace pro DOCX ----
+# --------------------------- Export Wizard ---------------------------
 
-class HTMLToDocxParser(HTMLParser):
+class ExportJob(QObject):
     """
-    Převádí HTML na seznam odstavců pro DOCX.
-    Podporuje vnořené styly, seznamy a odsazení (indentation).
+    Běh exportu na pracovním vlákně (QThread) – obal nad export_engine.run_export.
+    Průběh a hotové soubory hlásí signály, zrušení se projeví mezi verzemi a mezi konverzemi.
     """
-    def __init__(self) -> None:
-        super().__init__()
-        self.paragraphs: List[dict] = []
-        self._stack: List[dict] = [] 
-        self._list_stack: List[dict] = [] 
-        self._current_runs: List[dict] = []
-        self._current_align: str = "left"
-        self._current_indent: int = 0
-        self._in_body = False
-        self._has_body_tag = False
-        self._ignore_content = False
-
-    def _start_paragraph(self, prefix: str = "", indent: int = 0) -> None:
-        if self._current_runs:
-            self._end_paragraph()
-        self._current_runs = []
-        self._current_align = "left"
-        self._current_indent = indent
-        for item in reversed(self._stack):
-            if item['tag'] in ('p', 'div', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
-                if item['styles'].get('align'):
-                    self._current_align = item['styles']['align']
-                break
-        self._current_prefix = prefix
-
-    def _end_paragraph(self) -> None:
-        if not self._current_runs and not hasattr(self, '_current_prefix'): return
-        merged = []
-        for r in self._current_runs:
-            if r['text'] == "": continue
-            if merged and all(merged[-1][k] == r[k] for k in ('b','i','u','color')):
-                merged[-1]['text'] += r['text']
-            else:
-                merged.append(r)
-        prefix = getattr(self, '_current_prefix', '')
-        if merged or prefix:
-            self.paragraphs.append({
-                'align': self._current_align,
-                'runs': merged,
-                'prefix': prefix,
-                'indent': self._current_indent
-            })
-        self._current_runs = []
-        if hasattr(self, '_current_prefix'): del self._current_prefix
-
-    def _append_text(self, text: str):
-        b = any(item['styles'].get('b') for item in self._stack)
-        i = any(item['styles'].get('i') for item in self._stack)
-        u = any(item['styles'].get('u') for item in self._stack)
-        color = None
-        for item in reversed(self._stack):
-            if item['styles'].get('color'):
-                color = item['styles']['color']
-                break
-        self._current_runs.append({'text': text, 'b': b, 'i': i, 'u': u, 'color': color})
+    progress = Signal(str, int, int, str)   # fáze ('docx'/'combine'/'pdf'/'merge'), hotovo, celkem, text
+    file_ready = Signal(str, str)           # druh ('docx'/'pdf'), cesta
+    finished = Signal(object)               # ExportResult
 
-    def feed(self, data: str) -> None:
-        if "<body" in data.lower():
-            self._has_body_tag = True; self._in_body = False
-        else:
-            self._has_body_tag = False; self._in_body = True
-        super().feed(data)
-
-    def handle_starttag(self, tag, attrs):
-        tag = tag.lower()
-        attrs_d = dict(attrs)
-        if tag == 'body': self._in_body = True; return
-        if tag in ('head', 'style', 'script', 'meta', 'title', 'html', '!doctype'): self._ignore_content = True; return
-        if not self._in_body or self._ignore_content: return
-
-        styles = self._parse_style(attrs_d.get('style', ''))
-        if attrs_d.get('align'): styles['align'] = attrs_d['align'].lower()
-        if tag in ('b', 'strong'): styles['b'] = True
-        if tag in ('i', 'em'): styles['i'] = True
-        if tag == 'u': styles['u'] = True
-        
-        # Explicitní margin - ZVÝŠENÁ CITLIVOST (20px = 1 level)
-        margin_left = styles.get('margin-left', '0px')
-        explicit_indent_val = 0
-        if 'px' in margin_left:
-            try:
-                px = float(margin_left.replace('px', '').strip())
-                explicit_indent_val = int(px / 20) # Changed from 30 to 20
-            except: pass
+    def __init__(self, compiled: CompiledTemplate, jobs, runner=run_export, **options) -> None:
+        super().__init__()
+        self.compiled = compiled
+        self.jobs = jobs
+        self.runner = runner  # run_export, nebo run_roster_export pro seznam studentů
+        self.options = options
+        self._cancel = threading.Event()
 
-        parent_style = self._stack[-1]['styles'] if self._stack else {}
-        merged_styles = parent_style.copy()
-        merged_styles.update(styles)
-        self._stack.append({'tag': tag, 'attrs': attrs_d, 'styles': merged_styles})
-
-        list_nesting = len(self._list_stack)
-        base_indent = max(0, list_nesting - 1) if tag == 'li' else max(0, list_nesting)
-        final_indent = base_indent + explicit_indent_val
-
-        if tag in ('p', 'div'):
-            self._start_paragraph(indent=final_indent)
-        elif tag == 'br':
-            self._append_text("\n")
-        elif tag in ('ul', 'ol'):
-            t = attrs_d.get('type', '1')
-            self._list_stack.append({'tag': tag, 'type': t, 'count': 0})
-        elif tag == 'li':
-            prefix = self._get_list_prefix()
-            self._start_paragraph(prefix=prefix, indent=final_indent)
-
-    def handle_endtag(self, tag):
-        tag = tag.lower()
-        if tag == 'body': self._in_body = False; return
-        if tag in ('head', 'style', 'script', 'meta', 'title', 'html'): self._ignore_content = False; return
-        if not self._in_body or self._ignore_content: return
-        if tag in ('p', 'div', 'li'): self._end_paragraph()
-        if tag in ('ul', 'ol'):
-            if self._list_stack: self._list_stack.pop()
-        for i in range(len(self._stack) - 1, -1, -1):
-            if self._stack[i]['tag'] == tag:
-                del self._stack[i:]
-                break
+    def cancel(self) -> None:
+        self._cancel.set()
 
-    def handle_data(self, data):
-        if not self._in_body or self._ignore_content: return
-        if not data: return
-        in_block = False
-        current_indent = 0
-        list_nesting = len(self._list_stack)
-        current_indent = max(0, list_nesting)
-        for item in reversed(self._stack):
-            if item['tag'] in ('p', 'div', 'li'):
-                in_block = True
-                break
-        if not in_block:
-            if not data.strip(): return
-            self._start_paragraph(indent=current_indent)
-        self._append_text(data)
-
-    def _parse_style(self, style_str: str) -> dict:
-        res = {}
-        if not style_str: return res
-        for part in style_str.split(';'):
-            if ':' in part:
-                k,v = part.split(':', 1)
-                k=k.strip().lower(); v=v.strip().lower()
-                if k=='color':
-                    m = re.search(r'#?([0-9a-f]{6})', v)
-                    if m: res['color']=m.group(1)
-                    else:
-                         m2 = re.search(r'rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)', v)
-                         if m2: r,g,b=[int(x) for x in m2.groups()]; res['color']=f"{r:02X}{g:02X}{b:02X}"
-                elif k=='text-align': res['align']=v
-                elif k=='margin-left': res['margin-left']=v
-                elif k=='font-weight':
-                    if 'bold' in v or (re.search(r'\d+',v) and int(re.search(r'\d+',v).group(0))>=600): res['b']=True
-                elif k=='font-style' and 'italic' in v: res['i']=True
-                elif k=='text-decoration' and 'underline' in v: res['u']=True
-        return res
+    def is_cancelled(self) -> bool:
+        return self._cancel.is_set()
 
-    def _get_list_prefix(self) -> str:
-        if not self._list_stack: return ""
-        L = self._list_stack[-1]
-        if L['tag'] == 'ul': return "•\t"
-        elif L['tag'] == 'ol':
-            L['count'] += 1; n = L['count']; t = L.get('type', '1')
-            val = f"{n}."
-            if t == 'a': val = f"{self._to_alpha(n, False)}."
-            elif t == 'A': val = f"{self._to_alpha(n, True)}."
-            elif t == 'i': val = f"{self._to_roman(n, False)}."
-            elif t == 'I': val = f"{self._to_roman(n, True)}."
-            return f"{val}\t"
-        return ""
-    def _to_alpha(self, n, upper):
-        s=""; n-=1
-        while n>=0: s=chr(97+n%26)+s; n=n//26-1
-        return s.upper() if upper else s
-    def _to_roman(self, n, upper):
-        val=[(50,'L'),(40,'XL'),(10,'X'),(9,'IX'),(5,'V'),(4,'IV'),(1,'I')]; res=""
-        for v,r in val:
-            while n>=v: res+=r; n-=v
-        return res if upper else res.lower()
-
-# ---- Tvorba WordprocessingML prvků (w:p, w:r) ----
-
-W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-NSMAP = {'w': W_NS}
-
-def w_tag(name: str) -> str:
-    return f"{{{W_NS}}}{name}"
-
-def make_w_run(text: str, b: bool=False, i: bool=False, u: bool=False, color: Optional[str]=None) -> ET.Element:
-    r = ET.Element(w_tag("r"))
-    rpr = ET.SubElement(r, w_tag("rPr"))
-    if b:
-        ET.SubElement(rpr, w_tag("b"))
-    if i:
-        ET.SubElement(rpr, w_tag("i"))
-    if u:
-        uel = ET.SubElement(rpr, w_tag("u"))
-        uel.set(w_tag("val"), "single")
-    if color:
-        cel = ET.SubElement(rpr, w_tag("color"))
-        cel.set(w_tag("val"), color.upper())
-    t = ET.SubElement(r, w_tag("t"))
-    t.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-    t.text = text or ""
-    return r
-
-def make_w_paragraph(align: str, runs: List[dict], prefix: str="") -> ET.Element:
-    p = ET.Element(w_tag("p"))
-    ppr = ET.SubElement(p, w_tag("pPr"))
-    jc = ET.SubElement(ppr, w_tag("jc"))
-    jc.set(w_tag("val"), {"left":"left","center":"center","right":"right","justify":"both"}.get(align, "left"))
-    if prefix:
-        p.append(make_w_run(prefix))
-    for r in runs:
-        p.append(make_w_run(r.get('text',''), r.get('b'), r.get('i'), r.get('u'), r.get('color')))
-    return p
+    @Slot()
+    def run(self) -> None:
+        try:
+            result = self.runner(self.compiled, self.jobs,
+                                progress=self.progress.emit,
+                                file_ready=self.file_ready.emit,
+                                should_cancel=self._cancel.is_set,
+                                **self.options)
+        except Exception as e:
+            import traceback; traceback.print_exc()
+            result = ExportResult(error=str(e))
+        self.finished.emit(result)
 
 
-# --------------------------- Export Wizard ---------------------------
-
 class ExportWizard(QWizard):
     def __init__(self, owner: "MainWindow") -> None:
         super().__init__(owner)
@@ -1245,6 +1912,10 @@ class ExportWizard(QWizard):
         self.multi_selected_sources = []
         # NOVÉ: Ukládáme seznam ID vybraných bonusových otázek
         self.multi_selected_bonus_ids = set()
+        # NOVÉ: Dotaz omezující klasické otázky ve vybraných zdrojích (viz parse_query)
+        self.multi_source_query = ""
+        # NOVÉ: Seznam studentů (CSV) – jeden test na studenta
+        self.roster_path: Optional[Path] = None
 
         # Načtení uložených cest
         self.settings_file = self.owner.project_root / "data" / "export_settings.json"
@@ -1307,7 +1978,11 @@ class ExportWizard(QWizard):
             "templates_dir": str(self.templates_dir),
             "output_dir": str(self.output_dir),
             "print_dir": str(self.print_dir),
-            "last_template": self.le_template.text()
+            "last_template": self.le_template.text(),
+            "print_dpi": self.spin_print_dpi.value() if hasattr(self, "spin_print_dpi") else self.stored_settings.get("print_dpi", DEFAULT_PRINT_DPI),
+            "combined_docx": self.chk_combined_docx.isChecked() if hasattr(self, "chk_combined_docx") else self.stored_settings.get("combined_docx", False),
+            "keep_docx": self.chk_keep_docx.isChecked() if hasattr(self, "chk_keep_docx") else self.stored_settings.get("keep_docx", False),
+            "answer_keys": self.cmb_answer_keys.currentData() if hasattr(self, "cmb_answer_keys") else self.stored_settings.get("answer_keys", "none"),
         }
         try:
             with open(self.settings_file, "w", encoding="utf-8") as f:
@@ -1471,7 +2146,7 @@ class ExportWizard(QWizard):
         
         l_multi.addWidget(QLabel("Počet kopií:"), 0, 0)
         self.spin_multi_count = QSpinBox()
-        self.spin_multi_count.setRange(2, 50)
+        self.spin_multi_count.setRange(2, 5000)
         self.spin_multi_count.setValue(2)
         self.spin_multi_count.setStyleSheet("padding: 4px;")
         l_multi.addWidget(self.spin_multi_count, 0, 1)
@@ -1507,6 +2182,73 @@ class ExportWizard(QWizard):
         bonus_container = QWidget(); bonus_layout = QHBoxLayout(bonus_container); bonus_layout.setContentsMargins(0,0,0,0)
         bonus_layout.addWidget(self.btn_select_bonus); bonus_layout.addWidget(self.lbl_selected_bonus, 1)
         l_multi.addWidget(bonus_container, 2, 1)
+
+        # NOVÉ: Omezení výběru (překryv verzí, seed)
+        l_multi.addWidget(QLabel("Max. společných otázek dvou verzí:"), 3, 0)
+        self.spin_max_overlap = QSpinBox()
+        self.spin_max_overlap.setRange(-1, 99)
+        self.spin_max_overlap.setValue(-1)
+        self.spin_max_overlap.setSpecialValueText("bez omezení")
+        self.spin_max_overlap.setToolTip("Žádné dvě verze nebudou mít víc společných otázek (pokud to pool dovolí).\n"
+                                         "Dosažený překryv se ukáže po exportu.")
+        self.le_multi_seed = QLineEdit()
+        self.le_multi_seed.setPlaceholderText("Seed (prázdné = náhodný)")
+        self.le_multi_seed.setToolTip("Stejný seed a stejné zdroje otázek = stejné rozložení otázek do verzí.")
+        # NOVÉ: Limit stran verze podle odhadu sazby (bez LibreOffice); delší verze se zkrátí výměnou otázek
+        self.spin_max_pages = QSpinBox()
+        self.spin_max_pages.setRange(0, 99)
+        self.spin_max_pages.setValue(0)
+        self.spin_max_pages.setPrefix("Max. stran: ")
+        self.spin_max_pages.setSpecialValueText("Max. stran: bez limitu")
+        self.spin_max_pages.setToolTip("Počet stran se odhaduje z délky textu, velikosti písma a výšky obrázků vůči stránce šablony.\n"
+                                       "Verze nad limitem dostane místo nejdelší otázky kratší ze stejného poolu.")
+        limits_container = QWidget(); limits_layout = QHBoxLayout(limits_container); limits_layout.setContentsMargins(0,0,0,0)
+        limits_layout.addWidget(self.spin_max_overlap); limits_layout.addWidget(self.spin_max_pages)
+        limits_layout.addWidget(self.le_multi_seed, 1)
+        l_multi.addWidget(limits_container, 3, 1)
+
+        # NOVÉ: Opakování balíku podle manifestu předchozího exportu
+        self.chk_reuse_manifest = QCheckBox("Znovu použít výběr z manifestu výstupu (stejné otázky, seed i hash)")
+        self.chk_reuse_manifest.setToolTip("Manifest <výstup>.manifest.json se ukládá při každém exportu.\n"
+                                           "Nezměněné verze se pak jen zkopírují z cache, nerenderují se znovu.")
+        l_multi.addWidget(self.chk_reuse_manifest, 4, 0, 1, 2)
+
+        # NOVÉ: Testy pro seznam studentů (CSV) – počet verzí = počet studentů
+        l_multi.addWidget(QLabel("Seznam studentů (CSV):"), 5, 0)
+        self.btn_select_roster = QPushButton("Vybrat CSV...")
+        self.btn_select_roster.setCursor(Qt.PointingHandCursor)
+        self.btn_select_roster.clicked.connect(self._on_select_roster_clicked)
+        self.btn_clear_roster = QPushButton("Zrušit")
+        self.btn_clear_roster.clicked.connect(lambda: self._set_roster(None))
+        self.lbl_roster = QLabel("Nepoužito (verze bez jmen)")
+        self.lbl_roster.setStyleSheet("color: #aaa; font-style: italic; margin-left: 8px;")
+        self.lbl_roster.setToolTip("Sloupce CSV jsou dostupné jako placeholdery <NázevSloupce>, navíc <Student> a <StudentID>.\n"
+                                   "Každý student dostane vlastní test i kontrolní hash; výstupem je <výstup>_studenti.zip\n"
+                                   "a při exportu do PDF jedno sloučené PDF pro tisk.")
+        roster_container = QWidget(); roster_layout = QHBoxLayout(roster_container); roster_layout.setContentsMargins(0,0,0,0)
+        roster_layout.addWidget(self.btn_select_roster); roster_layout.addWidget(self.btn_clear_roster)
+        roster_layout.addWidget(self.lbl_roster, 1)
+        l_multi.addWidget(roster_container, 5, 1)
+
+        # NOVÉ: Skládání verzí podle omezení (témata, součet bodů, hodnota bonusů)
+        l_multi.addWidget(QLabel("Skládání verzí:"), 6, 0)
+        self.chk_one_per_subgroup = QCheckBox("Každá otázka z jiné podskupiny")
+        self.chk_one_per_subgroup.setToolTip("V jedné verzi nebudou dvě otázky ze stejné podskupiny;\n"
+                                             "podskupiny se mezi verzemi střídají rovnoměrně.")
+        self.spin_target_points = QSpinBox()
+        self.spin_target_points.setRange(0, 999)
+        self.spin_target_points.setValue(0)
+        self.spin_target_points.setPrefix("Součet bodů: ")
+        self.spin_target_points.setSpecialValueText("Součet bodů: libovolný")
+        self.spin_target_points.setToolTip("Součet bodů (points) klasických otázek v každé verzi.\n"
+                                           "Nejde-li složit, použije se nejbližší možný součet.")
+        self.chk_equal_bonus = QCheckBox("Stejná hodnota bonusů")
+        self.chk_equal_bonus.setToolTip("Všechny verze dostanou bonusy se stejným součtem bodů za správnou i špatnou odpověď,\n"
+                                        "takže Max. a Min. bodů vyjdou ve všech verzích stejně.")
+        assembly_container = QWidget(); assembly_layout = QHBoxLayout(assembly_container); assembly_layout.setContentsMargins(0,0,0,0)
+        assembly_layout.addWidget(self.chk_one_per_subgroup); assembly_layout.addWidget(self.spin_target_points)
+        assembly_layout.addWidget(self.chk_equal_bonus); assembly_layout.addStretch()
+        l_multi.addWidget(assembly_container, 6, 1)
         main_layout.addWidget(self.widget_multi_options)
 
         # 4. Hlavní obsah (Dva sloupce: Strom | Sloty)
@@ -1568,24 +2310,36 @@ class ExportWizard(QWizard):
         # Zjistíme počet potřebných otázek ze šablony
         needed_count = len(self.placeholders_q)
         
-        dlg = MultiSourceDialog(self.owner, self.multi_selected_sources)
+        dlg = MultiSourceDialog(self.owner, self.multi_selected_sources, self.multi_source_query)
         if dlg.exec():
             self.multi_selected_sources = dlg.get_selected_items()
+            self.multi_source_query = dlg.get_query()
             total_available = dlg.get_total_selected_count() # Počet unikátních dostupných otázek
             
             names = [item['name'].split(" (")[0] for item in self.multi_selected_sources]
             count_sources = len(self.multi_selected_sources)
             
-            if count_sources == 0:
-                # Pokud nic nevybral -> bere se "všechno".
-                # Zde bychom mohli spočítat celkový počet v DB pro přesnost,
-                # ale pro jednoduchost napíšeme:
-                self.lbl_selected_sources.setText("Nevybráno (použijí se všechny otázky)")
-                self.lbl_selected_sources.setStyleSheet("color: #aaa; font-style: italic; margin-left: 5px;")
+            if count_sources == 0 and self.multi_source_query:
+                # Bez zaškrtnutých zdrojů, ale s dotazem -> celá DB omezená dotazem
+                index = self.owner._get_question_index()
+                total_available = len(index.match_ids(self.multi_source_query) & index.ids_of_type("classic"))
+                style = "color: #81c784; font-weight: bold; margin-left: 5px;" if total_available >= needed_count else "color: #ff5252; font-weight: bold; margin-left: 5px;"
+                self.lbl_selected_sources.setText(f"<b>{total_available} otázek</b> (Potřeba: {needed_count}) pro dotaz: {_html.escape(self.multi_source_query)}")
+                self.lbl_selected_sources.setStyleSheet(style)
+            elif count_sources == 0:
+                # Pokud nic nevybral -> bere se "všechno" (počet z agregací banky)
+                total_all = self.owner._get_bank_stats().get().classic
+                self.lbl_selected_sources.setText(f"Nevybráno (použijí se všechny otázky: {total_all}, potřeba {needed_count})")
+                if total_all < needed_count:
+                    self.lbl_selected_sources.setStyleSheet("color: #ff5252; font-weight: bold; margin-left: 5px;")
+                else:
+                    self.lbl_selected_sources.setStyleSheet("color: #aaa; font-style: italic; margin-left: 5px;")
             else:
                 short_list = ", ".join(names[:2])
                 if len(names) > 2:
                     short_list += f" a {len(names)-2} dalších"
+                if self.multi_source_query:
+                    short_list += f" [dotaz: {_html.escape(self.multi_source_query)}]"
                 
                 # -- KONTROLA DOSTATKU OTÁZEK --
                 if total_available < needed_count:
@@ -1604,6 +2358,30 @@ class ExportWizard(QWizard):
                 self.lbl_selected_sources.setText(text)
                 self.lbl_selected_sources.setStyleSheet(style)
 
+    def _on_select_roster_clicked(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Vybrat seznam studentů", str(self.owner.project_root), "CSV (*.csv)")
+        if path:
+            self._set_roster(Path(path))
+
+    def _set_roster(self, path: Optional[Path]) -> None:
+        if path is not None:
+            try:
+                n = count_roster(path)
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                QMessageBox.warning(self, "Seznam studentů", f"CSV nelze načíst:\n{e}")
+                return
+            if not n:
+                QMessageBox.warning(self, "Seznam studentů", "V souboru nejsou žádní studenti.")
+                return
+            self.roster_path = path
+            self.lbl_roster.setText(f"<b>{n} studentů</b> z {path.name}")
+            self.lbl_roster.setStyleSheet("color: #81c784; margin-left: 8px;")
+        else:
+            self.roster_path = None
+            self.lbl_roster.setText("Nepoužito (verze bez jmen)")
+            self.lbl_roster.setStyleSheet("color: #aaa; font-style: italic; margin-left: 8px;")
+        self.spin_multi_count.setEnabled(self.roster_path is None)
+
     def _on_select_bonus_clicked(self):
         dlg = BonusQuestionSelectorDialog(self.owner, self.multi_selected_bonus_ids)
         if dlg.exec() == QDialog.Accepted:
@@ -1734,6 +2512,55 @@ class ExportWizard(QWizard):
         self.chk_export_pdf.setChecked(True)
         self.chk_export_pdf.setToolTip("DOCX se automaticky převede na PDF. V hromadném režimu budou všechny varianty spojeny do jednoho PDF.")
         l_opts.addWidget(self.chk_export_pdf)
+
+        # NOVÉ: Při exportu do PDF jsou DOCX jen rychlý mezivýstup (RAM, nízká komprese), pokud je nechceme ponechat
+        self.chk_keep_docx = QCheckBox("Ponechat i DOCX soubory")
+        self.chk_keep_docx.setChecked(bool(self.stored_settings.get("keep_docx", False)))
+        self.chk_keep_docx.setToolTip("Bez zaškrtnutí se DOCX vytvoří jen dočasně (v RAM, s rychlou kompresí) pro převod do PDF\n"
+                                      "a po exportu se smažou. Když PDF nevznikne, DOCX se uloží do výstupní složky.")
+        self.chk_keep_docx.setEnabled(self.chk_export_pdf.isChecked())
+        self.chk_export_pdf.toggled.connect(self.chk_keep_docx.setEnabled)
+        l_opts.addWidget(self.chk_keep_docx)
+
+        # NOVÉ: Hromadný export do jednoho DOCX (verze = sekce s vlastním záhlavím/zápatím)
+        self.chk_combined_docx = QCheckBox("Hromadný export do jednoho DOCX (každá verze = nová sekce)")
+        self.chk_combined_docx.setChecked(bool(self.stored_settings.get("combined_docx", False)))
+        self.chk_combined_docx.setToolTip("Všechny verze v jednom dokumentu: každá začíná novou stránkou, má vlastní záhlaví/zápatí\n"
+                                          "(PoznamkaVerze) a číslování stránek. Do PDF stačí jediná konverze, nic se neslučuje.")
+        l_opts.addWidget(self.chk_combined_docx)
+
+        # NOVÉ: Klíč správných odpovědí (vzniká ve stejném běhu jako testy)
+        keys_row = QHBoxLayout()
+        keys_row.addWidget(QLabel("Klíč odpovědí:"))
+        self.cmb_answer_keys = QComboBox()
+        self.cmb_answer_keys.addItem("Negenerovat", "none")
+        self.cmb_answer_keys.addItem("Pro každou verzi zvlášť", "per_version")
+        self.cmb_answer_keys.addItem("Jeden společný pro celý balík", "combined")
+        idx = self.cmb_answer_keys.findData(self.stored_settings.get("answer_keys", "none"))
+        self.cmb_answer_keys.setCurrentIndex(max(0, idx))
+        self.cmb_answer_keys.setToolTip("Tabulka pozice → otázka → správná odpověď → body pro každou verzi (<výstup>_klic.docx).\n"
+                                        "Při exportu do PDF se převede také, ale se zadáními se neslučuje.")
+        keys_row.addWidget(self.cmb_answer_keys)
+        keys_row.addStretch()
+        l_opts.addLayout(keys_row)
+
+        # NOVÉ: Tisková DPI obrázků (zmenšené obrázky se drží v data/.cache/images)
+        dpi_row = QHBoxLayout()
+        dpi_row.addWidget(QLabel("Rozlišení obrázků pro tisk:"))
+        self.spin_print_dpi = QSpinBox()
+        self.spin_print_dpi.setRange(0, 1200)
+        self.spin_print_dpi.setSingleStep(50)
+        self.spin_print_dpi.setSuffix(" DPI")
+        self.spin_print_dpi.setSpecialValueText("originál (bez zmenšení)")
+        try:
+            self.spin_print_dpi.setValue(int(self.stored_settings.get("print_dpi", DEFAULT_PRINT_DPI)))
+        except (TypeError, ValueError):
+            self.spin_print_dpi.setValue(DEFAULT_PRINT_DPI)
+        self.spin_print_dpi.setToolTip("Obrázky větší než je potřeba pro tisk v dané velikosti se zmenší (HEIC se převede na JPEG).\n"
+                                       "Výsledky se ukládají do cache, opakovaný export je použije znovu.")
+        dpi_row.addWidget(self.spin_print_dpi)
+        dpi_row.addStretch()
+        l_opts.addLayout(dpi_row)
         
         main_layout.addWidget(self.options_box)
 
@@ -1897,6 +2724,10 @@ class ExportWizard(QWizard):
             
             msg = f"Nalezeno: {len(self.placeholders_q)}x Otázka, {len(self.placeholders_b)}x BONUS."
             if self.has_minmax[0]: msg += " (S body)."
+            # NOVÉ: placeholdery, pro které není registrovaný poskytovatel (zůstanou v testu beze změny)
+            unknown = unknown_placeholders(placeholders)
+            if unknown:
+                msg += f" Neznámé: {', '.join(unknown)}."
             self.lbl_scan_info.setText(msg)
             
         except Exception as e:
@@ -2786,10 +3617,7 @@ class ExportWizard(QWizard):
     def _init_page3(self):
         try:
             # 1. Generování hashe
-            ts = str(datetime.now().timestamp())
-            salt = secrets.token_hex(16)
-            data_to_hash = f"{ts}{salt}"
-            self._cached_hash = hashlib.sha3_256(data_to_hash.encode("utf-8")).hexdigest()
+            self._cached_hash = new_control_hash()
             
             if hasattr(self, "lbl_hash_preview"):
                 self.lbl_hash_preview.setText(f"SHA3-256 Hash:\n{self._cached_hash}")
@@ -2801,6 +3629,7 @@ class ExportWizard(QWizard):
 
             total_bonus_points = 0.0
             min_loss = 0.0
+            selected_classic: Dict[str, Question] = {}
             
             bg_color = "#252526"; text_color = "#e0e0e0"; border_color = "#555555"
             sec_q_bg = "#2d3845"; sec_b_bg = "#453d2d"; sec_s_bg = "#2d452d"
@@ -2810,11 +3639,14 @@ class ExportWizard(QWizard):
             verze_preview = f"{prefix} {today}" 
             
             is_multi = (self.mode_group.checkedId() == 1)
+            self.chk_combined_docx.setEnabled(is_multi)
             
             multi_info = ""
             if is_multi:
                 multi_count = self.spin_multi_count.value()
                 multi_info = f"<tr><td colspan='2' style='color: #ffcc00; font-weight: bold;'>⚡ Hromadný export: {multi_count} verzí (stejný hash)</td></tr>"
+                if self.multi_source_query:
+                    multi_info += f"<tr><td colspan='2' style='color: #81c784;'>Dotaz pro zdroje: <code>{_html.escape(self.multi_source_query)}</code></td></tr>"
 
             html = f"""
             <html>
@@ -2844,6 +3676,7 @@ class ExportWizard(QWizard):
                     if qid:
                         q = self.owner._find_question_by_id(qid)
                         if q:
+                            selected_classic[ph] = q
                             title_clean = re.sub(r'<[^>]+>', '', q.title)
                             html += f"<tr><td width='100' style='color:#888;'>{ph}:</td><td><b>{title_clean}</b></td><td align='right'>({q.points} b)</td></tr>"
                     else:
@@ -2880,7 +3713,9 @@ class ExportWizard(QWizard):
                 Hodnoty Max. bodů a Min. bodů (a tím i intervaly známek) se budou lišit pro každou variantu.<br>
                 Tabulka níže je pouze orientační pro základ (10 bodů).</p>
                 """
-                max_txt = "10 + (bonus)"
+                # ZMĚNA: základ Max. bodů je součet bodů klasických otázek verze (pevný jen s cílovým součtem)
+                target = self.spin_target_points.value()
+                max_txt = f"{target} + (bonus)" if target else "součet bodů otázek + (bonus)"
                 min_txt = "(variabilní)"
                 val_A_top = "Max"
                 val_F_bot = "Min"
@@ -2888,8 +3723,9 @@ class ExportWizard(QWizard):
                 max_body_val = 10.0 
             else:
                 # REŽIM SINGLE: Standardní výpočet
-                max_body_val = 10.0 + total_bonus_points
-                max_txt = f"{max_body_val:.2f} (10 + {total_bonus_points:.2f})"
+                base = base_points(selected_classic)
+                max_body_val = base + total_bonus_points
+                max_txt = f"{max_body_val:.2f} ({base:g} + {total_bonus_points:.2f})"
                 min_txt = f"{min_loss:.2f}"
                 val_A_top = f"{max_body_val:.2f}"
                 val_F_bot = f"{min_loss:.2f}"
@@ -2948,6 +3784,255 @@ class ExportWizard(QWizard):
         new_time = QTime(new_h, new_m)
         return QDateTime(dt.date(), new_time)
 
+    def _start_roster_export(self, roster: Path, compiled: CompiledTemplate, image_cache: ImageCache,
+                             rows: List[Dict[str, str]], seed, sample_summary: str, do_pdf_export: bool) -> None:
+        """
+        Jeden test na studenta. Náhrady se skládají až na pracovním vlákně po dávkách (run_roster_export),
+        takže v paměti není víc než jedna dávka. Otázky i jejich rich AST se připraví tady na hlavním vlákně.
+        """
+        count = len(rows)
+        plan = PLACEHOLDERS.plan(compiled.placeholder_keys())
+        exam_dt = self.dt_edit.dateTime().toPython()
+        prefix = self.le_prefix.text().strip()
+        questions: Dict[str, Any] = {}
+        index = self.owner._get_question_pools().questions
+        for row in rows:
+            for qid in row.values():
+                if qid and qid not in questions:
+                    q = index.get(qid)
+                    if q is not None:
+                        ensure_rich_ast(q)
+                    questions[qid] = q
+
+        def entries():
+            for i, student in enumerate(iter_roster(roster)):
+                if i >= count:
+                    break
+                sel = {ph: qid for ph, qid in rows[i].items() if qid}
+                selection = {ph: questions.get(qid) for ph, qid in rows[i].items()}
+                s_hash = new_control_hash()
+                ctx = PlaceholderContext(selection, exam_dt, i, count, prefix, s_hash, extra=student)
+                repl_plain, rich_map = plan.replacements(ctx)
+                yield (roster_file_stem(i, student), repl_plain, rich_map,
+                       {"index": i + 1, "student": student["Student"], "student_id": student["StudentID"],
+                        "hash": s_hash, "selection": sel})
+
+        archive, pdf = roster_output_paths(self.output_path, self.print_dir)
+        if do_pdf_export:
+            self.print_dir.mkdir(parents=True, exist_ok=True)
+        self._export_ctx = {"roster": roster, "count": count, "sample_summary": sample_summary}
+        job = ExportJob(compiled, entries(), runner=run_roster_export,
+                        total=count, archive_path=archive,
+                        pdf_path=pdf if do_pdf_export else None,
+                        image_cache=image_cache,
+                        render_cache=self.owner._export_render_cache(),
+                        manifest={"seed": seed, "prefix": prefix, "roster": str(roster),
+                                  "date": self.dt_edit.dateTime().toString("yyyy-MM-dd HH:mm")})
+        self._start_export_job(job)
+
+    def _on_roster_finished(self, result) -> None:
+        """Dokončení exportu pro seznam studentů: historie (hash každého studenta) a hlášení."""
+        ctx = self._export_ctx
+        count = ctx["count"]
+        if hasattr(self, "progress_bar"):
+            self.progress_bar.setVisible(False)
+            self.lbl_status_final.setText("Zrušeno." if result.cancelled else "Hotovo.")
+        if result.error:
+            QMessageBox.critical(self, "Kritická chyba", f"Neočekávaná chyba:\n{result.error}")
+        if not isinstance(result, RosterResult) or result.error:
+            self.button(QWizard.FinishButton).setEnabled(True)
+            self.button(QWizard.BackButton).setEnabled(True)
+            return
+
+        if result.history:
+            archive_name = result.archive.name if result.archive else ""
+            self.owner.register_exports([(f"{archive_name}/{name}", h) for name, h in result.history])
+        if result.failed:
+            lines = "\n".join(f"Student {i+1}: {err}" for i, err in sorted(result.failed.items())[:20])
+            QMessageBox.critical(self, "Export", f"Některé testy se nepodařilo vygenerovat:\n{lines}")
+        for err in dict.fromkeys(result.pdf_errors):
+            QMessageBox.warning(self, "PDF Export", f"Chyba při exportu PDF:\n{err}")
+        if result.merge_failed:
+            QMessageBox.warning(self, "Chyba slučování PDF", PDF_MERGE_HELP)
+
+        if result.cancelled or not result.rendered:
+            if result.cancelled:
+                QMessageBox.information(self, "Export", f"Export byl zrušen.\nHotové testy ({result.rendered}/{count}) jsou v:\n{result.archive}")
+            self.button(QWizard.FinishButton).setEnabled(True)
+            self.button(QWizard.BackButton).setEnabled(True)
+            return
+
+        pdf_msg = f"\n\nPDF pro tisk uloženo do:\n{result.final_pdf}" if result.final_pdf else ""
+        QMessageBox.information(self, "Export", f"Testy pro seznam studentů dokončeny.\n"
+                                f"{result.rendered} testů uloženo do archivu:\n{result.archive}{pdf_msg}{ctx['sample_summary']}")
+        super().accept()
+
+    def _start_export_job(self, job: "ExportJob") -> None:
+        """Spustí ExportJob na pracovním vlákně a napojí jeho signály na UI průvodce."""
+        self._export_job = job
+        self._export_files: List[Tuple[str, str]] = []
+        self._export_thread = QThread(self)
+        job.moveToThread(self._export_thread)
+        self._export_thread.started.connect(job.run)
+        job.progress.connect(self._on_export_progress)
+        job.file_ready.connect(self._on_export_file_ready)
+        job.finished.connect(self._on_export_finished)
+        self._export_thread.start()
+
+    def _on_export_progress(self, stage: str, done: int, total: int, text: str) -> None:
+        if hasattr(self, "progress_bar"):
+            self.progress_bar.setRange(0, total)  # total 0 = neurčitý průběh (slučování)
+            self.progress_bar.setValue(done)
+            if not (getattr(self, "_export_job", None) and self._export_job.is_cancelled()):
+                self.lbl_status_final.setText(text)
+
+    def _on_export_file_ready(self, kind: str, path: str) -> None:
+        self._export_files.append((kind, path))
+        print(f"[INFO] Export ({kind}): {path}")
+
+    def reject(self) -> None:
+        # NOVÉ: během exportu tlačítko Zrušit export přeruší (mezi verzemi / konverzemi),
+        # průvodce se zavře až potom a hotové soubory zůstanou zapsané v historii.
+        job = getattr(self, "_export_job", None)
+        if job is not None:
+            job.cancel()
+            self.button(QWizard.CancelButton).setEnabled(False)
+            if hasattr(self, "lbl_status_final"):
+                self.lbl_status_final.setText("Ruším export – dokončuji rozpracovaný soubor...")
+            return
+        super().reject()
+
+    def _preflight_export(self, compiled: Optional[CompiledTemplate], template_error: str,
+                          rows: List[Dict[str, str]], lookup, question_pool: List[str],
+                          question_pool_bonus: List[str], check_pools: bool,
+                          roster: Optional[Path], do_pdf_export: bool,
+                          page_balance: Optional[PageBalance] = None,
+                          assembly: Optional[AssemblyReport] = None) -> bool:
+        """Kontrola dávky před exportem (viz export_engine.preflight_export). True = pokračovat."""
+        extra_keys = ()
+        if roster is not None:
+            try:
+                extra_keys = roster_columns(roster)
+            except (OSError, UnicodeDecodeError, csv.Error):
+                pass
+        pool_sizes = {}
+        if check_pools:
+            pool_sizes = {"klasických otázek": (len(question_pool), len(self.placeholders_q)),
+                          "bonusových otázek": (len(question_pool_bonus), len(self.placeholders_b))}
+        report = preflight_export(compiled, rows, lookup, template_error=template_error,
+                                  pool_sizes=pool_sizes, extra_keys=extra_keys,
+                                  output_path=self.output_path, pdf=do_pdf_export, page_balance=page_balance,
+                                  assembly=assembly)
+        print(f"[INFO] Preflight: {report.versions} verzí, {len(report.errors)} chyb, "
+              f"{len(report.warnings)} upozornění ({report.elapsed * 1000:.1f} ms)")
+        if not report.ok:
+            QMessageBox.critical(self, "Kontrola před exportem",
+                                 f"Export nelze spustit:\n\n{report.text()}")
+            return False
+        if report.warnings:
+            reply = QMessageBox.question(self, "Kontrola před exportem",
+                                         f"{report.text()}\n\nPokračovat v exportu?")
+            return reply == QMessageBox.Yes
+        return True
+
+    def _on_export_finished(self, result: ExportResult) -> None:
+        """Dokončení ExportJob (hlavní vlákno): historie, hlášení výsledku, zavření průvodce."""
+        self._export_thread.quit()
+        self._export_thread.wait()
+        self._export_job.deleteLater()
+        self._export_job = None
+        self.button(QWizard.CancelButton).setEnabled(True)
+
+        ctx = self._export_ctx
+        if "roster" in ctx:
+            self._on_roster_finished(result)
+            return
+        is_multi, count = ctx["is_multi"], ctx["count"]
+        base_output_path = ctx["base_output_path"]
+        rescued = False
+        if ctx["fast"]:
+            # DOCX byly jen mezivýstup pro PDF; bez PDF je přesuneme do výstupní složky
+            rescued = finalize_intermediates(result, ctx["work_dir"], base_output_path.parent)
+        elif ctx["work_dir"] is not None:
+            shutil.rmtree(ctx["work_dir"], ignore_errors=True)
+        produced = result.docx_files
+
+        # NOVÉ: Manifest výběru vedle výstupu (pro opakovaný export stejného balíku)
+        if produced:
+            try:
+                write_manifest(base_output_path, ctx["compiled"], ctx["selections"], result,
+                               combined=ctx["combined"], seed=ctx["seed"], k_hash=ctx["k_hash"],
+                               prefix=self.le_prefix.text().strip(),
+                               date=self.dt_edit.dateTime().toString("yyyy-MM-dd HH:mm"))
+            except OSError as e:
+                print(f"[WARN] Nepodařilo se uložit manifest exportu: {e}")
+
+        # Historie – jen pro soubory, které opravdu vznikly
+        if produced:
+            if not is_multi:
+                self.owner.register_export(base_output_path.name, ctx["k_hash"])
+            elif ctx["combined"]:
+                self.owner.register_export(f"Balík {count} verzí (1 DOCX): {base_output_path.name}", ctx["k_hash"])
+            elif result.cancelled:
+                self.owner.register_export(f"Balík {len(produced)}/{count} verzí (zrušeno): {base_output_path.name}", ctx["k_hash"])
+            else:
+                self.owner.register_export(f"Balík {count} verzí: {base_output_path.name}", ctx["k_hash"])
+
+        if hasattr(self, "progress_bar"):
+            self.progress_bar.setVisible(False)
+            self.lbl_status_final.setText("Zrušeno." if result.cancelled else "Hotovo.")
+
+        if result.error:
+            QMessageBox.critical(self, "Kritická chyba", f"Neočekávaná chyba:\n{result.error}")
+        if result.failed:
+            if not is_multi:
+                QMessageBox.critical(self, "Export", f"Chyba při exportu verze 1:\n{result.failed[0]}")
+            else:
+                lines = "\n".join(f"Verze {i+1}: {err}" for i, err in sorted(result.failed.items()))
+                QMessageBox.critical(self, "Export", f"Některé verze se nepodařilo vygenerovat:\n{lines}")
+        for err in dict.fromkeys(result.pdf_errors):
+            QMessageBox.warning(self, "PDF Export", f"Chyba při exportu PDF:\n{err}")
+        if result.merge_failed:
+            QMessageBox.warning(self, "Chyba slučování PDF", PDF_MERGE_HELP)
+        if result.key_errors:
+            QMessageBox.warning(self, "Klíč odpovědí", "Klíč odpovědí se nepodařilo vytvořit:\n" + "\n".join(result.key_errors))
+
+        if result.error or not produced or result.cancelled:
+            if result.cancelled:
+                names = "\n".join(Path(p).name for kind, p in self._export_files) or "-"
+                QMessageBox.information(self, "Export", f"Export byl zrušen.\nHotové soubory ({len(produced)}/{count} DOCX):\n{names}")
+            # Povolit tlačítka zpět
+            self.button(QWizard.FinishButton).setEnabled(True)
+            self.button(QWizard.BackButton).setEnabled(True)
+            return
+
+        pdf_success_msg = ""
+        if result.merged:
+            pdf_success_msg = f"\n\nPDF pro tisk (sloučené) uloženo do:\n{result.final_pdf}"
+        elif result.merge_failed:
+            pdf_success_msg = f"\n\nPOZOR: Slučování selhalo. Jednotlivá PDF jsou v:\n{self.print_dir}"
+        elif result.final_pdf:
+            pdf_success_msg = f"\n\nPDF pro tisk uloženo do:\n{result.final_pdf}"
+
+        cache_msg = f"\nZ cache převzato beze změny: {result.cache_hits}" if result.cache_hits else ""
+        if rescued:
+            cache_msg += "\nPOZOR: PDF nevzniklo u všech souborů, DOCX bez PDF byly uloženy do výstupní složky."
+        if result.key_files:
+            key_names = ", ".join(p.name for p in result.key_files[:3]) + (" ..." if len(result.key_files) > 3 else "")
+            cache_msg += f"\nKlíč odpovědí: {key_names}"
+        if result.docx_discarded:
+            msg = (f"{'Hromadný export' if is_multi else 'Export'} dokončen (jen PDF, DOCX nebyly ponechány).\n"
+                   f"Verzí: {count}{cache_msg}{pdf_success_msg}{ctx['sample_summary'] if is_multi else ''}")
+        elif ctx["combined"]:
+            msg = (f"Hromadný export dokončen.\n{count} verzí uloženo do jednoho DOCX:\n{base_output_path}"
+                   f"{cache_msg}{pdf_success_msg}{ctx['sample_summary']}")
+        elif is_multi:
+            msg = f"Hromadný export dokončen.\nVygenerováno {len(produced)} souborů DOCX.{cache_msg}{pdf_success_msg}{ctx['sample_summary']}"
+        else:
+            msg = f"Export dokončen.\nSoubor uložen:\n{base_output_path}{pdf_success_msg}"
+        QMessageBox.information(self, "Export", msg)
+        super().accept()
+
     def _cz_day_of_week(self, dt: QDateTime) -> str:
         # dt.date().dayOfWeek() vrací 1 (Mon) až 7 (Sun)
         days = ["pondělí", "úterý", "středa", "čtvrtek", "pátek", "sobota", "neděle"]
@@ -2961,77 +4046,56 @@ class ExportWizard(QWizard):
             return
 
         # Kontrolní Hash
-        k_hash = getattr(self, "_cached_hash", "")
-        if not k_hash:
-            ts = str(datetime.now().timestamp())
-            salt = secrets.token_hex(16)
-            data_to_hash = f"{ts}{salt}"
-            k_hash = hashlib.sha3_256(data_to_hash.encode("utf-8")).hexdigest()
+        k_hash = getattr(self, "_cached_hash", "") or new_control_hash()
 
         is_multi = (self.mode_group.checkedId() == 1)
         count = self.spin_multi_count.value() if is_multi else 1
         do_pdf_export = self.chk_export_pdf.isChecked()
+        # NOVÉ: se seznamem studentů je verzí tolik, kolik je studentů
+        roster = self.roster_path if is_multi else None
+        if roster is not None:
+            try:
+                count = count_roster(roster)
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                QMessageBox.critical(self, "Seznam studentů", f"CSV nelze načíst:\n{e}")
+                return
+            if not count:
+                QMessageBox.warning(self, "Seznam studentů", "V seznamu nejsou žádní studenti.")
+                return
+        combined = is_multi and roster is None and self.chk_combined_docx.isChecked()
+        key_mode = self.cmb_answer_keys.currentData() or "none"
         
         # --- PŘÍPRAVA POOLU OTÁZEK ---
         question_pool = []
         # --- NOVÉ: Pool pro bonusové otázky ---
         question_pool_bonus = []
         
+        # ZMĚNA: pooly se skládají sjednocením předpočítaných množin per uzel a typ;
+        # NOVÉ: z téhož indexu se berou i otázky verzí (id -> otázka, bez průchodu stromem)
+        pools = self.owner._get_question_pools()
         if is_multi:
-            def collect_questions(group_id, is_subgroup, target_type="classic"):
-                qs = []
-                nodes_to_visit = list(self.owner.root.groups)
-                target_node = None
-                while nodes_to_visit:
-                    curr = nodes_to_visit.pop(0)
-                    if curr.id == group_id:
-                        target_node = curr
-                        break
-                    if hasattr(curr, "subgroups") and curr.subgroups:
-                        nodes_to_visit.extend(curr.subgroups)
-                
-                if target_node:
-                    def extract_q(node):
-                        valid_qs = []
-                        if hasattr(node, "questions"):
-                            valid_qs.extend([q.id for q in node.questions if q.type == target_type])
-                        if hasattr(node, "subgroups") and node.subgroups:
-                            for sub in node.subgroups:
-                                valid_qs.extend(extract_q(sub))
-                        return valid_qs
-                    qs = extract_q(target_node)
-                return qs
 
             # 1. Zdroje pro KLASICKÉ otázky
             sources_to_process = self.multi_selected_sources
             if not sources_to_process:
                 sources_to_process = [{"id": g.id, "type": "group"} for g in self.owner.root.groups]
-
-            for source in sources_to_process:
-                sid = source["id"]
-                stype = source["type"]
-                is_sub = (stype == "subgroup")
-                pool_ids = collect_questions(sid, is_sub, "classic")
-                question_pool.extend(pool_ids)
+            # seřazeno kvůli reprodukovatelnosti se seedem
+            question_pool = sorted(pools.union((source["id"] for source in sources_to_process), "classic"))
             
-            question_pool = list(set(question_pool))
+            # NOVÉ: Omezení klasických otázek dotazem ze stejného enginu jako filtr stromu
+            if self.multi_source_query:
+                allowed = self.owner._get_question_index().match_ids(self.multi_source_query)
+                question_pool = [qid for qid in question_pool if qid in allowed]
             
             # 2. Zdroje pro BONUSOVÉ otázky
             # Pokud uživatel vybral konkrétní, použijeme ty. Jinak sebereme VŠECHNY dostupné bonusy.
             if self.multi_selected_bonus_ids:
-                question_pool_bonus = list(self.multi_selected_bonus_ids)
+                question_pool_bonus = sorted(set(self.multi_selected_bonus_ids))
             else:
                 # Pokud není vybráno, vezmeme bonusy ze všech skupin
-                all_groups = [{"id": g.id, "type": "group"} for g in self.owner.root.groups]
-                for g_src in all_groups:
-                    b_ids = collect_questions(g_src["id"], False, "bonus")
-                    question_pool_bonus.extend(b_ids)
-                question_pool_bonus = list(set(question_pool_bonus))
+                question_pool_bonus = sorted(pools.union((g.id for g in self.owner.root.groups), "bonus"))
 
         base_output_path = self.output_path
-        success_count = 0
-        generated_docx_files = []
-        generated_pdf_files = []
 
         print_folder = self.print_dir
         if do_pdf_export:
@@ -3049,216 +4113,510 @@ class ExportWizard(QWizard):
             self.lbl_status_final.setText("Generuji DOCX soubory...")
             QApplication.processEvents()
 
+        # NOVÉ: šablona se načte a zanalyzuje jen jednou pro všechny verze
+        image_cache = self.owner._export_image_cache(self.spin_print_dpi.value())
+        # NOVÉ: chyba šablony se neohlásí hned, ale v preflight reportu spolu s ostatními problémy
+        compiled_template, template_error = None, ""
+        try:
+            compiled_template = CompiledTemplate(self.template_path, image_cache=image_cache)
+        except Exception as e:
+            template_error = str(e)
+            print(f"[ERROR] Nelze otevřít DOCX: {e}")
+
+        # --- NOVÉ: Výběr z manifestu předchozího exportu ---
+        manifest = None
+        if is_multi and roster is None and self.chk_reuse_manifest.isChecked():
+            manifest = read_manifest(manifest_path(base_output_path))
+            if manifest is None:
+                QMessageBox.warning(self, "Manifest", f"Manifest nelze načíst:\n{manifest_path(base_output_path)}\n\nOtázky se vylosují znovu.")
+            else:
+                if compiled_template is not None and manifest.get("template_hash") != compiled_template.template_hash:
+                    QMessageBox.warning(self, "Manifest", "Šablona se od uloženého manifestu změnila – všechny verze se vyrenderují znovu.")
+                count = len(manifest["versions"])
+                k_hash = manifest.get("k_hash") or k_hash
+                if hasattr(self, "progress_bar"):
+                    self.progress_bar.setRange(0, count)
+
+        # --- VÝBĚR OTÁZEK PRO VŠECHNY VERZE ---
+        # NOVÉ: celá matice verze × placeholdery se losuje najednou (rovnoměrné využití otázek,
+        # volitelný limit překryvu mezi verzemi, reprodukovatelný seed).
+        sample_summary = ""
+        seed = None
+        assembly, group_key = None, None
+        if manifest is not None:
+            seed = manifest.get("seed")
+            sample_summary = f"\n\nVýběr otázek: převzat z manifestu ({count} verzí, seed {seed})"
+        elif is_multi and question_pool:
+            seed_text = self.le_multi_seed.text().strip()
+            seed = int(seed_text) if seed_text.isdigit() else None
+            cap = self.spin_max_overlap.value()
+            # NOVÉ: s omezeními (podskupiny, součet bodů, hodnota bonusů) skládá verze solver
+            constraints = AssemblyConstraints(self.chk_one_per_subgroup.isChecked(),
+                                              self.spin_target_points.value(), self.chk_equal_bonus.isChecked())
+            if constraints.classic or constraints.equal_bonus:
+                sample_q, sample_b, assembly = assemble_versions(
+                    question_pool, question_pool_bonus, len(self.placeholders_q), len(self.placeholders_b), count,
+                    pools.questions.get, pools.topics, constraints, seed=seed, max_overlap=cap if cap >= 0 else None)
+                group_key = constraint_key(constraints, pools.questions.get, pools.topics)
+            else:
+                sample_q = sample_versions(question_pool, len(self.placeholders_q), count, seed=seed,
+                                           max_overlap=cap if cap >= 0 else None)
+                sample_b = sample_versions(question_pool_bonus, len(self.placeholders_b), count, seed=sample_q.seed + 1)
+            seed = sample_q.seed
+            sample_summary = f"\n\nVýběr otázek: {sample_q.summary()}"
+            if self.placeholders_b and question_pool_bonus:
+                sample_summary += f"\nBonusy: {sample_b.summary()}"
+            if assembly is not None and assembly.summary():
+                sample_summary += f"\nOmezení: {assembly.summary()}"
+
+        # Výběr (placeholder -> id otázky) pro všechny verze
+        if manifest is not None:
+            rows = [dict(v.get("selection") or {}) for v in manifest["versions"]]
+        elif is_multi and question_pool:
+            # Pro multi režim ignorujeme ruční výběr – řádek i předem vylosované matice
+            rows = [dict(zip(self.placeholders_q, sample_q.rows[i])) for i in range(count)]
+            for row, bonus_row in zip(rows, sample_b.rows):
+                row.update(zip(self.placeholders_b, bonus_row))
+        else:
+            rows = [self.selection_map.copy() for _ in range(count)]
+
+        # --- NOVÉ: Odhad stran verzí; nad limitem se verze zkrátí výměnou otázek ---
+        balance = None
+        if is_multi and compiled_template is not None:
+            page_pools = {}
+            if manifest is None and question_pool:
+                page_pools = {ph: question_pool for ph in self.placeholders_q}
+                page_pools.update((ph, question_pool_bonus) for ph in self.placeholders_b)
+            balance = rebalance_pages(rows, PageEstimator(compiled_template), pools.questions.get,
+                                      page_pools, self.spin_max_pages.value() if page_pools else 0, group_key)
+            if balance.pages:
+                sample_summary += f"\nStránky: {balance.summary()}"
+
+        # --- NOVÉ: PREFLIGHT – celá dávka se zkontroluje dřív, než vznikne první DOCX ---
+        if not self._preflight_export(compiled_template, template_error, rows, pools.questions.get,
+                                      question_pool, question_pool_bonus, is_multi and manifest is None,
+                                      roster, do_pdf_export, balance, assembly):
+            self.button(QWizard.FinishButton).setEnabled(True)
+            self.button(QWizard.BackButton).setEnabled(True)
+            if hasattr(self, "progress_bar"):
+                self.progress_bar.setVisible(False)
+            return
+
+        if roster is not None:
+            self._start_roster_export(roster, compiled_template, image_cache, rows, seed, sample_summary, do_pdf_export)
+            return
+
         # --- LOOP GENEROVÁNÍ ---
+        jobs: List[tuple] = []
+        selections: List[Dict[str, str]] = []
+        key_versions: List[tuple] = []
+        # Při složení do jednoho DOCX jsou soubory verzí jen mezivýstup v dočasné složce.
+        # NOVÉ: Při exportu do PDF bez "Ponechat i DOCX" jsou mezivýstupem všechny DOCX (RAM, komprese 1).
+        fast = do_pdf_export and not self.chk_keep_docx.isChecked()
+        work_dir = intermediate_dir("ceg_versions_") if (combined or fast) else None
+        compiled_template.compresslevel = INTERMEDIATE_COMPRESSLEVEL if fast else None
+        key_base = work_dir / base_output_path.name if fast else base_output_path
+        # NOVÉ: prosté placeholdery počítají registrovaní poskytovatelé, a jen ty, které šablona obsahuje
+        # (i v záhlaví/zápatí). ZMĚNA v 8.3.1: datum verze je datum zvolené v dt_edit, ne 'now'.
+        plan = PLACEHOLDERS.plan(compiled_template.placeholder_keys())
+        exam_dt = self.dt_edit.dateTime().toPython()
+        prefix = self.le_prefix.text().strip()
         try:
             for i in range(count):
-                current_selection = self.selection_map.copy()
-                
-                if is_multi and question_pool:
-                    import random
-                    # Pro multi režim ignorujeme ruční výběr
-                    current_selection = {} 
-                    
-                    # A. Klasické otázky
-                    targets = self.placeholders_q
-                    needed = len(targets)
-                    
-                    if len(question_pool) >= needed:
-                        picked = random.sample(question_pool, needed)
-                        for idx, ph in enumerate(targets):
-                            current_selection[ph] = picked[idx]
-                    else:
-                        if len(question_pool) > 0:
-                            for ph in targets:
-                                current_selection[ph] = random.choice(question_pool)
-                    
-                    # B. Bonusové otázky
-                    targets_b = self.placeholders_b
-                    needed_b = len(targets_b)
-                    
-                    if len(question_pool_bonus) >= needed_b:
-                        picked_b = random.sample(question_pool_bonus, needed_b)
-                        for idx, ph in enumerate(targets_b):
-                            current_selection[ph] = picked_b[idx]
-                    else:
-                        if len(question_pool_bonus) > 0:
-                             for idx, ph in enumerate(targets_b):
-                                 # Pokud nemáme dost unikátních, musíme opakovat, nebo vzít co je
-                                 # Zde fallback: pokud dojdou, bereme random s opakováním
-                                 current_selection[ph] = random.choice(question_pool_bonus)
+                current_selection = rows[i]
+                selection = {ph: pools.questions.get(qid) for ph, qid in current_selection.items()}
+                ctx = PlaceholderContext(selection, exam_dt, i, count, prefix, k_hash)
+                repl_plain, rich_map = plan.replacements(ctx)
+                target_path = version_output_path(base_output_path, i, is_multi)
+                if work_dir is not None:
+                    target_path = work_dir / target_path.name
+
+                jobs.append((i, target_path, repl_plain, rich_map))
+                selections.append({ph: qid for ph, qid in current_selection.items() if qid})
+                if key_mode != "none":
+                    key_versions.append((version_label(ctx), answer_key_entries(selection)))
+
+            # --- SPUŠTĚNÍ EXPORTU NA POZADÍ ---
+            # NOVÉ: render verzí (u hromadného exportu paralelně v procesech), PDF konverze i slučování
+            # běží v ExportJob na pracovním vlákně. UI zůstává živé a export jde zrušit tlačítkem Zrušit.
+            self._export_ctx = {"is_multi": is_multi, "count": count, "k_hash": k_hash,
+                                "base_output_path": base_output_path, "sample_summary": sample_summary,
+                                "compiled": compiled_template, "selections": selections, "seed": seed,
+                                "combined": combined, "work_dir": work_dir, "fast": fast}
+            job = ExportJob(compiled_template, jobs,
+                            parallel=is_multi,
+                            image_cache=image_cache,
+                            render_cache=self.owner._export_render_cache(),
+                            combined_output=(key_base if combined else None),
+                            answer_keys=answer_key_jobs(key_mode, key_base, key_versions, is_multi, k_hash),
+                            pdf_dir=print_folder if do_pdf_export else None,
+                            merged_pdf_name=f"{base_output_path.stem}_merged.pdf" if is_multi else None,
+                            stop_on_error=not is_multi)
+            self._start_export_job(job)
 
-                
-                repl_plain: Dict[str, str] = {}
-                
-                # --- Datum a Čas (Inline logika) ---
-                raw_dt = self.dt_edit.dateTime()
-                # Zaokrouhlení na 10 min
-                time = raw_dt.time()
-                total_minutes = time.hour() * 60 + time.minute()
-                remainder = total_minutes % 10
-                if remainder >= 5: total_minutes += (10 - remainder)
-                else: total_minutes -= remainder
-                new_h = (total_minutes // 60) % 24
-                new_m = total_minutes % 60
-                rounded_time = QTime(new_h, new_m)
-                rounded_dt = QDateTime(raw_dt.date(), rounded_time)
-                
-                # Den v týdnu
-                days_cz = ["pondělí", "úterý", "středa", "čtvrtek", "pátek", "sobota", "neděle"]
-                day_idx = rounded_dt.date().dayOfWeek() - 1
-                day_str = days_cz[day_idx]
-                
-                dt_str = f"{day_str} {rounded_dt.toString('dd.MM.yyyy HH:mm')}"
-                repl_plain["DatumČas"] = dt_str
-                repl_plain["DatumCas"] = dt_str
-                repl_plain["DATUMCAS"] = dt_str
-                
-                # --- Sestavení verze (Prefix + Datum testu) ---
-                prefix = self.le_prefix.text().strip()
-                # ZMĚNA v 8.3.1: Místo aktuálního data 'now' používáme datum zvolené v dt_edit
-                test_date_str = raw_dt.toString("yyyy-MM-dd")
-                version_suffix = f"-{i+1}" if is_multi else ""
-                verze_str = f"{prefix}{version_suffix} {test_date_str}"
-                
-                repl_plain["PoznamkaVerze"] = verze_str
-                repl_plain["POZNAMKAVERZE"] = verze_str
-                repl_plain["KontrolniHash"] = k_hash
-                repl_plain["KONTROLNIHASH"] = k_hash
-                
-                total_bonus = 0.0
-                min_loss = 0.0
-                for qid in current_selection.values():
-                    q = self.owner._find_question_by_id(qid)
-                    if not q: continue
-                    if q.type == 'bonus':
-                        total_bonus += float(q.bonus_correct)
-                        min_loss += float(q.bonus_wrong)
-                
-                # Base points - zde fixně 10, nebo spočítat z klasických
-                max_body = 10.0 + total_bonus
-                
-                repl_plain["MaxBody"] = f"{max_body:.2f}"
-                repl_plain["MAXBODY"] = f"{max_body:.2f}"
-                repl_plain["MinBody"] = f"{min_loss:.2f}"
-                repl_plain["MINBODY"] = f"{min_loss:.2f}"
-
-                # --- ÚPRAVA: Podpora obrázků (tuple) ---
-                rich_map: Dict[str, object] = {}
-                for ph, qid in current_selection.items():
-                    q = self.owner._find_question_by_id(qid)
-                    if q:
-                        img_path = getattr(q, "image_path", None)
-                        rich_map[ph] = (q.text_html, img_path, float(getattr(q, "image_width_cm", 0.0) or 0.0), float(getattr(q, "image_height_cm", 0.0) or 0.0))
-                    else:
-                        rich_map[ph] = ("", None)
-                # ----------------------------------------
+        except Exception as e:
+            # Pokud nastane chyba, odblokujeme tlačítka
+            self.button(QWizard.FinishButton).setEnabled(True)
+            self.button(QWizard.BackButton).setEnabled(True)
+            QMessageBox.critical(self, "Kritická chyba", f"Neočekávaná chyba:\n{e}")
+            
+# --------------------------- Hlavní okno (UI + logika) ---------------------------
 
-                if is_multi:
-                    p = Path(base_output_path)
-                    new_name = f"{p.stem}_v{i+1}{p.suffix}"
-                    target_path = p.parent / new_name
-                else:
-                    target_path = base_output_path
+class NearDuplicatesDialog(QDialog):
+    """Report téměř duplicitních otázek (MinHash/LSH) s možností sloučení nebo smazání do koše."""
+    def __init__(self, owner: "MainWindow") -> None:
+        super().__init__(owner)
+        self.setWindowTitle("Téměř duplicitní otázky")
+        self.resize(1100, 650)
+        self.owner = owner
+        self.pairs: List[Tuple[str, str, float]] = []
 
-                try:
-                    self.owner._generate_docx_from_template(self.template_path, target_path, repl_plain, rich_map)
-                    success_count += 1
-                    generated_docx_files.append(target_path)
-                except Exception as e:
-                    QMessageBox.critical(self, "Export", f"Chyba při exportu verze {i+1}:\n{e}")
-                    if not is_multi: 
-                        # Povolit tlačítka zpět
-                        self.button(QWizard.FinishButton).setEnabled(True)
-                        self.button(QWizard.BackButton).setEnabled(True)
-                        return
-                
-                # Update Progress
-                if hasattr(self, "progress_bar"):
-                    self.progress_bar.setValue(i + 1)
-                    self.lbl_status_final.setText(f"Generuji DOCX {i+1}/{count}...")
-                    QApplication.processEvents()
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(8, 8, 8, 8)
+        layout.setSpacing(8)
+
+        top = QHBoxLayout()
+        top.addWidget(QLabel("Práh podobnosti:"))
+        self.spin_threshold = QDoubleSpinBox()
+        self.spin_threshold.setRange(0.50, 1.00)
+        self.spin_threshold.setSingleStep(0.05)
+        self.spin_threshold.setDecimals(2)
+        self.spin_threshold.setValue(0.80)
+        top.addWidget(self.spin_threshold)
+        self.btn_search = QPushButton("Hledat")
+        self.btn_search.clicked.connect(self._run_search)
+        top.addWidget(self.btn_search)
+        self.lbl_info = QLabel("")
+        self.lbl_info.setStyleSheet("color: #aaa; margin-left: 10px;")
+        top.addWidget(self.lbl_info, 1)
+        layout.addLayout(top)
+
+        self.table = QTableWidget(0, 5)
+        self.table.setHorizontalHeaderLabels(["Podobnost", "Otázka A", "Umístění A", "Otázka B", "Umístění B"])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(1, QHeaderView.Stretch)
+        header.setSectionResizeMode(2, QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(3, QHeaderView.Stretch)
+        header.setSectionResizeMode(4, QHeaderView.ResizeToContents)
+        layout.addWidget(self.table, 1)
+
+        btns = QHBoxLayout()
+        self.btn_merge_a = QPushButton("Sloučit do A (B → koš)")
+        self.btn_merge_b = QPushButton("Sloučit do B (A → koš)")
+        self.btn_del_a = QPushButton("Smazat A do koše")
+        self.btn_del_b = QPushButton("Smazat B do koše")
+        self.btn_merge_a.setToolTip("Vtipné odpovědi, správná odpověď a obrázek z B se doplní do A, B se přesune do koše.")
+        self.btn_merge_b.setToolTip("Vtipné odpovědi, správná odpověď a obrázek z A se doplní do B, A se přesune do koše.")
+        self.btn_merge_a.clicked.connect(lambda: self._on_action("merge", 0))
+        self.btn_merge_b.clicked.connect(lambda: self._on_action("merge", 1))
+        self.btn_del_a.clicked.connect(lambda: self._on_action("delete", 0))
+        self.btn_del_b.clicked.connect(lambda: self._on_action("delete", 1))
+        for b in (self.btn_merge_a, self.btn_merge_b, self.btn_del_a, self.btn_del_b):
+            btns.addWidget(b)
+        btns.addStretch(1)
+        bb = QDialogButtonBox(QDialogButtonBox.Close)
+        bb.rejected.connect(self.reject)
+        btns.addWidget(bb)
+        layout.addLayout(btns)
+
+        self.table.itemSelectionChanged.connect(self._update_buttons)
+        self.table.itemDoubleClicked.connect(self._on_double_clicked)
+        self._update_buttons()
+        QTimer.singleShot(0, self._run_search)
+
+    def _question_locations(self) -> Dict[str, str]:
+        res: Dict[str, str] = {}
+        def walk(subs: List[Subgroup], path: List[str]) -> None:
+            for sg in subs:
+                p = path + [sg.name]
+                for q in sg.questions:
+                    res[q.id] = " / ".join(p)
+                walk(sg.subgroups, p)
+        for g in self.owner.root.groups:
+            walk(g.subgroups, [g.name])
+        return res
+
+    def _run_search(self) -> None:
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            index = self.owner._get_question_index()
+            texts = {qid: index.plain[r] for qid, r in index.row_of.items()}
+            self.pairs = find_near_duplicates(texts, float(self.spin_threshold.value()))
+        finally:
+            QApplication.restoreOverrideCursor()
+        self._fill_table()
+
+    def _fill_table(self) -> None:
+        locations = self._question_locations()
+        self.table.setRowCount(0)
+        for a, b, sim in self.pairs:
+            qa = self.owner._find_question_by_id(a)
+            qb = self.owner._find_question_by_id(b)
+            if not qa or not qb:
+                continue
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            it_sim = QTableWidgetItem(f"{sim * 100:.0f} %")
+            it_sim.setData(Qt.UserRole, (a, b))
+            it_sim.setTextAlignment(Qt.AlignCenter)
+            self.table.setItem(row, 0, it_sim)
+            for col, q in ((1, qa), (3, qb)):
+                it = QTableWidgetItem(q.title or "(bez názvu)")
+                plain = html_to_search_text(q.text_html).strip()
+                it.setToolTip(plain[:300] + ("..." if len(plain) > 300 else ""))
+                if q.type == "bonus":
+                    it.setForeground(QBrush(QColor("#ffea00")))
+                self.table.setItem(row, col, it)
+            self.table.setItem(row, 2, QTableWidgetItem(locations.get(a, "")))
+            self.table.setItem(row, 4, QTableWidgetItem(locations.get(b, "")))
+        self.lbl_info.setText(f"Nalezeno dvojic: {self.table.rowCount()}")
+        self._update_buttons()
+
+    def _selected_pair(self) -> Optional[Tuple[str, str]]:
+        rows = self.table.selectionModel().selectedRows() if self.table.selectionModel() else []
+        if not rows:
+            return None
+        it = self.table.item(rows[0].row(), 0)
+        return it.data(Qt.UserRole) if it else None
+
+    def _update_buttons(self) -> None:
+        has = self._selected_pair() is not None
+        for b in (self.btn_merge_a, self.btn_merge_b, self.btn_del_a, self.btn_del_b):
+            b.setEnabled(has)
+
+    def _on_double_clicked(self, item: QTableWidgetItem) -> None:
+        pair = self._selected_pair()
+        if not pair:
+            return
+        qid = pair[1] if item.column() >= 3 else pair[0]
+        self.owner._select_question(qid)
+
+    def _on_action(self, action: str, side: int) -> None:
+        pair = self._selected_pair()
+        if not pair:
+            return
+        keep_id, drop_id = (pair[0], pair[1]) if side == 0 else (pair[1], pair[0])
+        if action == "merge":
+            self.owner._merge_questions(keep_id, drop_id)
+            removed = drop_id
+        else:
+            removed = pair[side]
+            self.owner._trash_questions_by_ids([removed])
+        # Dvojice se smazanou otázkou už nejsou aktuální
+        self.pairs = [p for p in self.pairs if removed not in (p[0], p[1])]
+        self._fill_table()
+
+
+class FindReplaceDialog(QDialog):
+    """Hromadné hledání a nahrazení v celé bance otázek (jedna dávka, jedno uložení, lze vrátit)."""
+    FIELD_LABELS = {"text_html": "Text", "title": "Název", "correct_answer": "Správná odpověď"}
+
+    def __init__(self, owner: "MainWindow") -> None:
+        super().__init__(owner)
+        self.setWindowTitle("Najít a nahradit v celé bance")
+        self.resize(1100, 700)
+        self.owner = owner
+        self.changes: List[dict] = []
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(8, 8, 8, 8)
+        layout.setSpacing(8)
+
+        form = QFormLayout()
+        self.le_find = QLineEdit()
+        self.le_replace = QLineEdit()
+        form.addRow("Najít:", self.le_find)
+        form.addRow("Nahradit za:", self.le_replace)
+        layout.addLayout(form)
+
+        opts = QHBoxLayout()
+        self.chk_regex = QCheckBox("Regulární výraz")
+        self.chk_regex.setToolTip("Python regex; v náhradě lze použít \\1, \\g<jméno>.")
+        self.chk_case = QCheckBox("Rozlišovat velikost písmen")
+        self.chk_text = QCheckBox("Text otázky"); self.chk_text.setChecked(True)
+        self.chk_title = QCheckBox("Název"); self.chk_title.setChecked(True)
+        self.chk_answer = QCheckBox("Správná odpověď"); self.chk_answer.setChecked(True)
+        for w in (self.chk_regex, self.chk_case, self.chk_text, self.chk_title, self.chk_answer):
+            opts.addWidget(w)
+        opts.addStretch(1)
+        self.btn_preview = QPushButton("Náhled")
+        self.btn_preview.clicked.connect(self._run_preview)
+        opts.addWidget(self.btn_preview)
+        layout.addLayout(opts)
+
+        self.lbl_info = QLabel("")
+        self.lbl_info.setStyleSheet("color: #aaa;")
+        layout.addWidget(self.lbl_info)
+
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(["Otázka", "Pole", "Před", "Po"])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(2, QHeaderView.Stretch)
+        header.setSectionResizeMode(3, QHeaderView.Stretch)
+        self.table.itemDoubleClicked.connect(self._on_double_clicked)
+        layout.addWidget(self.table, 1)
+
+        btns = QHBoxLayout()
+        self.btn_apply = QPushButton("Nahradit vše")
+        self.btn_apply.setEnabled(False)
+        self.btn_apply.clicked.connect(self._apply)
+        self.btn_undo = QPushButton("Vrátit poslední hromadnou změnu")
+        self.btn_undo.clicked.connect(self._undo)
+        btns.addWidget(self.btn_apply)
+        btns.addWidget(self.btn_undo)
+        btns.addStretch(1)
+        bb = QDialogButtonBox(QDialogButtonBox.Close)
+        bb.rejected.connect(self.reject)
+        btns.addWidget(bb)
+        layout.addLayout(btns)
+
+        # Změna parametrů zneplatní náhled
+        for w in (self.le_find, self.le_replace):
+            w.textChanged.connect(self._invalidate_preview)
+        for w in (self.chk_regex, self.chk_case, self.chk_text, self.chk_title, self.chk_answer):
+            w.toggled.connect(self._invalidate_preview)
+        self._update_undo_button()
+
+    def _invalidate_preview(self, *_args) -> None:
+        self.changes = []
+        self.table.setRowCount(0)
+        self.btn_apply.setEnabled(False)
+        self.btn_apply.setText("Nahradit vše")
+        self.lbl_info.setText("")
+
+    def _update_undo_button(self) -> None:
+        stack = getattr(self.owner, "_bulk_edit_undo", [])
+        self.btn_undo.setEnabled(bool(stack))
+        if stack:
+            self.btn_undo.setToolTip(f"Vrátí dávku: {stack[-1]['label']}")
+
+    def _fields(self) -> List[str]:
+        res = []
+        if self.chk_text.isChecked(): res.append("text_html")
+        if self.chk_title.isChecked(): res.append("title")
+        if self.chk_answer.isChecked(): res.append("correct_answer")
+        return res
+
+    @staticmethod
+    def _snippet(text: str, start: int, end: int, width: int = 40) -> str:
+        a = max(0, start - width)
+        b = min(len(text), end + width)
+        return ("…" if a > 0 else "") + text[a:b].replace("\n", " ") + ("…" if b < len(text) else "")
+
+    def _run_preview(self) -> None:
+        find = self.le_find.text()
+        if not find:
+            self._invalidate_preview()
+            return
+        use_regex = self.chk_regex.isChecked()
+        try:
+            rx = compile_find_pattern(find, use_regex, self.chk_case.isChecked())
+        except re.error as e:
+            QMessageBox.warning(self, "Chybný výraz", f"Regulární výraz nelze zpracovat:\n{e}")
+            return
+        repl_text = self.le_replace.text()
+        repl = repl_text if use_regex else (lambda _m: repl_text)
+        fields = self._fields()
+
+        # Rozpracovaná editace musí být v modelu, jinak by ji dávka přepsala
+        self.owner._apply_editor_to_current_question(silent=True)
+        index = self.owner._get_question_index()
+
+        # Kandidáti z fulltextového indexu (jen doslovné hledání v textu/názvu)
+        candidate_ids: Optional[set] = None
+        if not use_regex and "correct_answer" not in fields and index.search_index is not None:
+            candidate_ids = index.search_index.candidates(find.lower())
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            self.changes = []
+            rows = range(len(index.ids)) if candidate_ids is None else \
+                [row for row, qid in enumerate(index.ids) if qid in candidate_ids]
+            for row in rows:
+                qid, q = index.ids[row], index.questions[row]
+                for fld in fields:
+                    old = getattr(q, fld, "") or ""
+                    if fld == "text_html":
+                        new, n = replace_in_html_text(old, rx, repl)
+                        probe = html_to_search_text(old).strip()
+                    else:
+                        new, n = rx.subn(repl, old)
+                        probe = old
+                    if not n or new == old:
+                        continue
+                    m = rx.search(probe)
+                    before = self._snippet(probe, m.start(), m.end()) if m else ""
+                    after_probe = html_to_search_text(new).strip() if fld == "text_html" else new
+                    if m:
+                        first_repl = m.expand(repl_text) if use_regex else repl_text
+                        after = self._snippet(after_probe, m.start(), m.start() + len(first_repl))
+                    else:
+                        after = ""
+                    self.changes.append({"qid": qid, "field": fld, "old": old, "new": new, "count": n,
+                                         "title": q.title or "(bez názvu)", "before": before, "after": after})
+        except re.error as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.warning(self, "Chybná náhrada", f"Náhradu nelze provést:\n{e}")
+            self._invalidate_preview()
+            return
+        QApplication.restoreOverrideCursor()
 
-            # Historie
-            if is_multi:
-                record_name = f"Balík {count} verzí: {base_output_path.name}"
-                self.owner.register_export(record_name, k_hash)
-            else:
-                self.owner.register_export(base_output_path.name, k_hash)
+        self.table.setRowCount(0)
+        total = 0
+        for ch in self.changes:
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            it = QTableWidgetItem(ch["title"])
+            it.setData(Qt.UserRole, ch["qid"])
+            self.table.setItem(row, 0, it)
+            self.table.setItem(row, 1, QTableWidgetItem(f"{self.FIELD_LABELS[ch['field']]} ({ch['count']}×)"))
+            self.table.setItem(row, 2, QTableWidgetItem(ch["before"]))
+            it_after = QTableWidgetItem(ch["after"])
+            it_after.setForeground(QBrush(QColor("#81c784")))
+            self.table.setItem(row, 3, it_after)
+            total += ch["count"]
+        n_q = len({ch["qid"] for ch in self.changes})
+        src = "přes fulltextový index" if candidate_ids is not None else "průchodem všech otázek"
+        self.lbl_info.setText(f"Nalezeno {total} výskytů v {n_q} otázkách ({src}).")
+        self.btn_apply.setEnabled(bool(self.changes))
+        self.btn_apply.setText(f"Nahradit vše ({total})" if self.changes else "Nahradit vše")
+
+    def _on_double_clicked(self, item: QTableWidgetItem) -> None:
+        it = self.table.item(item.row(), 0)
+        if it:
+            self.owner._select_question(it.data(Qt.UserRole))
+
+    def _apply(self) -> None:
+        if not self.changes:
+            return
+        label = f"„{self.le_find.text()}“ → „{self.le_replace.text()}“"
+        if QMessageBox.question(self, "Nahradit vše",
+                                f"Provést {len(self.changes)} změn ({label}) jako jednu dávku?") != QMessageBox.Yes:
+            return
+        applied = self.owner._apply_bulk_field_changes(self.changes, label)
+        self._invalidate_preview()
+        self.lbl_info.setText(f"Změněno polí: {applied}. Dávku lze vrátit tlačítkem níže.")
+        self._update_undo_button()
 
-            # PDF Export
-            pdf_success_msg = ""
-            if do_pdf_export and generated_docx_files:
-                # Reset progress bar
-                if hasattr(self, "progress_bar"):
-                    self.progress_bar.setRange(0, len(generated_docx_files))
-                    self.progress_bar.setValue(0)
-                    self.lbl_status_final.setText("Převádím DOCX na PDF...")
-                    QApplication.processEvents()
-                    
-                try:
-                    for idx, docx_file in enumerate(generated_docx_files):
-                        if hasattr(self, "lbl_status_final"):
-                            self.lbl_status_final.setText(f"PDF Konverze: {docx_file.name}")
-                            QApplication.processEvents()
-                            
-                        pdf_file = self.owner._convert_docx_to_pdf(docx_file)
-                        if pdf_file and pdf_file.exists():
-                            generated_pdf_files.append(pdf_file)
-                        
-                        if hasattr(self, "progress_bar"):
-                            self.progress_bar.setValue(idx + 1)
-
-                    if generated_pdf_files:
-                        if is_multi and len(generated_pdf_files) > 1:
-                            if hasattr(self, "lbl_status_final"):
-                                self.lbl_status_final.setText("Slučuji PDF soubory...")
-                                self.progress_bar.setRange(0, 0) 
-                                QApplication.processEvents()
-                                
-                            merged_name = f"{base_output_path.stem}_merged.pdf"
-                            final_pdf = print_folder / merged_name
-                            
-                            if self.owner._merge_pdfs(generated_pdf_files, final_pdf, cleanup=True):
-                                pdf_success_msg = f"\n\nPDF pro tisk (sloučené) uloženo do:\n{final_pdf}"
-                            else:
-                                pdf_success_msg = f"\n\nPOZOR: Slučování selhalo. Jednotlivá PDF jsou v:\n{print_folder}"
-                                import shutil
-                                for tmp_pdf in generated_pdf_files:
-                                    if tmp_pdf.exists():
-                                        try:
-                                            dest = print_folder / tmp_pdf.name
-                                            shutil.move(str(tmp_pdf), str(dest))
-                                        except: pass
-                        else:
-                            import shutil
-                            final_pdf = print_folder / generated_pdf_files[0].name
-                            shutil.move(str(generated_pdf_files[0]), str(final_pdf))
-                            pdf_success_msg = f"\n\nPDF pro tisk uloženo do:\n{final_pdf}"
-                                
-                except Exception as e:
-                    QMessageBox.warning(self, "PDF Export", f"Kritická chyba při exportu PDF:\n{e}")
-                    import traceback; traceback.print_exc()
-            
-            if hasattr(self, "progress_bar"):
-                self.progress_bar.setVisible(False)
-                self.lbl_status_final.setText("Hotovo.")
+    def _undo(self) -> None:
+        restored, skipped = self.owner._undo_bulk_field_changes()
+        self._invalidate_preview()
+        msg = f"Vráceno polí: {restored}."
+        if skipped:
+            msg += f" Přeskočeno {skipped} (mezitím znovu upraveno)."
+        self.lbl_info.setText(msg)
+        self._update_undo_button()
 
-            if is_multi:
-                msg = f"Hromadný export dokončen.\nVygenerováno {success_count} souborů DOCX.{pdf_success_msg}"
-                QMessageBox.information(self, "Export", msg)
-            else:
-                msg = f"Export dokončen.\nSoubor uložen:\n{base_output_path}{pdf_success_msg}"
-                QMessageBox.information(self, "Export", msg)
-                
-            super().accept()
-        
-        except Exception as e:
-            # Pokud nastane chyba, odblokujeme tlačítka
-            self.button(QWizard.FinishButton).setEnabled(True)
-            self.button(QWizard.BackButton).setEnabled(True)
-            QMessageBox.critical(self, "Kritická chyba", f"Neočekávaná chyba:\n{e}")
-            
-# --------------------------- Hlavní okno (UI + logika) ---------------------------
 
 class FunnyAnswerDialog(QDialog):
     """Dialog pro přidání nové vtipné odpovědi."""
@@ -3769,6 +5127,8 @@ class MainWindow(QMainWindow):
             self._save_tree_expansion_state_on_close()
         except Exception:
             pass
+        if getattr(self, "_search_index", None) is not None:
+            self._search_index.close()
         super().closeEvent(event)
         
     from PySide6.QtCore import QSettings, QTimer
@@ -4119,7 +5479,8 @@ class MainWindow(QMainWindow):
         filter_layout.setContentsMargins(0, 0, 0, 0)
         filter_layout.setSpacing(6)
         self.filter_edit = QLineEdit()
-        self.filter_edit.setPlaceholderText("Filtr: název / obsah otázky…")
+        self.filter_edit.setPlaceholderText("Filtr: text nebo dotaz (type:bonus points>=2 has:image …)")
+        self.filter_edit.setToolTip(QUERY_HELP_TEXT)
         self.btn_move_selected = QPushButton("Přesunout vybrané…")
         self.btn_delete_selected = QPushButton("Smazat vybrané")
         filter_layout.addWidget(self.filter_edit, 1)
@@ -4187,6 +5548,8 @@ class MainWindow(QMainWindow):
         self._init_trash_tab()
     
         self._init_funny_answers_tab()
+        # NOVÉ: Statistiky banky
+        self._init_stats_tab()
         left_container_layout.addWidget(self.left_tabs)
     
         # PRAVÝ PANEL
@@ -4506,6 +5869,23 @@ class MainWindow(QMainWindow):
         self.act_export_docx.setText("Export")
         self.act_export_docx.setIcon(self.style().standardIcon(QStyle.SP_ArrowUp))
     
+        # NOVÉ: Téměř duplicitní otázky
+        if not hasattr(self, "act_near_duplicates"):
+            self.act_near_duplicates = QAction("Duplicity", self)
+            self.act_near_duplicates.setToolTip("Najít téměř duplicitní otázky (MinHash/LSH)")
+            self.act_near_duplicates.triggered.connect(self._show_near_duplicates)
+        self.act_near_duplicates.setText("Duplicity")
+        self.act_near_duplicates.setIcon(get_gen_icon("≈", QColor("#ab47bc")))
+    
+        # NOVÉ: Hromadné Najít a nahradit
+        if not hasattr(self, "act_find_replace"):
+            self.act_find_replace = QAction("Nahradit", self)
+            self.act_find_replace.setShortcut("Ctrl+Shift+H")
+            self.act_find_replace.setToolTip("Najít a nahradit v celé bance otázek (Ctrl+Shift+H)")
+            self.act_find_replace.triggered.connect(self._show_find_replace)
+        self.act_find_replace.setText("Nahradit")
+        self.act_find_replace.setIcon(get_gen_icon("R", QColor("#26a69a")))
+    
         # --- ZMĚNA: NOVÉ JSON AKCE ---
         if not hasattr(self, "act_load_json"):
             self.act_load_json = QAction("Nahrát DB", self)
@@ -4527,6 +5907,8 @@ class MainWindow(QMainWindow):
         tb.addSeparator()
         tb.addAction(self.act_import_docx)
         tb.addAction(self.act_export_docx)
+        tb.addAction(self.act_near_duplicates)
+        tb.addAction(self.act_find_replace)
         tb.addSeparator()
     
         # ZMĚNA: Přidání JSON tlačítek do layoutu toolbaru
@@ -4671,6 +6053,8 @@ class MainWindow(QMainWindow):
         if hasattr(self, "tab_funny") and current_widget == self.tab_funny:
             if hasattr(self, "_refresh_funny_answers_tab"):
                 self._refresh_funny_answers_tab()
+        if hasattr(self, "tab_stats") and current_widget == self.tab_stats:
+            self._refresh_stats_tab()
 
     def _bulk_duplicate_selected_to_subgroup(self) -> None:
         """
@@ -5369,28 +6753,127 @@ class MainWindow(QMainWindow):
                 
                 q_item.addChild(child)
 
+    # -------------------- Statistiky --------------------
+
+    def _get_bank_stats(self) -> BankStats:
+        """Vrátí agregované statistiky banky (přestaví se lazy po strukturální změně)."""
+        stats = getattr(self, "_bank_stats", None)
+        if stats is None:
+            stats = BankStats(self.root.groups if self.root else [])
+            self._bank_stats = stats
+        return stats
+
+    def _bank_stats_question_changed(self, q: Question, subgroup_id: str) -> None:
+        """Delta po úpravě otázky v editoru – aktualizuje jen uzel a jeho předky."""
+        stats = getattr(self, "_bank_stats", None)
+        if stats is None:
+            return
+        stats.set_question(q, subgroup_id)
+        if hasattr(self, "tab_stats") and self.left_tabs.currentWidget() == self.tab_stats:
+            self._refresh_stats_tab()
+
+    def _init_stats_tab(self) -> None:
+        """Inicializuje záložku se statistikami banky otázek."""
+        self.tab_stats = QWidget()
+        layout = QVBoxLayout(self.tab_stats)
+        layout.setContentsMargins(4, 4, 4, 4)
+
+        self.lbl_stats_summary = QLabel("")
+        self.lbl_stats_summary.setTextFormat(Qt.RichText)
+        self.lbl_stats_summary.setWordWrap(True)
+        self.lbl_stats_summary.setStyleSheet("padding: 4px;")
+        layout.addWidget(self.lbl_stats_summary)
+
+        self.tree_stats = QTreeWidget()
+        self.tree_stats.setColumnCount(6)
+        self.tree_stats.setHeaderLabels(["Skupina / podskupina", "Klasické", "Bonusové", "S obrázkem", "Vtipné odp.", "Body (počet otázek)"])
+        self.tree_stats.setUniformRowHeights(True)
+        self.tree_stats.setSelectionMode(QAbstractItemView.NoSelection)
+        header = self.tree_stats.header()
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        for col in range(1, 6):
+            header.setSectionResizeMode(col, QHeaderView.ResizeToContents)
+        layout.addWidget(self.tree_stats, 1)
+
+        self.left_tabs.addTab(self.tab_stats, "Statistiky")
+
+    @staticmethod
+    def _format_points_hist(hist: Dict[int, int]) -> str:
+        return ", ".join(f"{pts} b: {cnt}" for pts, cnt in sorted(hist.items()))
+
+    def _refresh_stats_tab(self) -> None:
+        """Vykreslí statistiky z předpočítaných agregací (bez procházení otázek)."""
+        if not hasattr(self, "tree_stats"):
+            return
+        stats = self._get_bank_stats()
+        total = stats.get()
+        n = total.total
+        img_pct = (100.0 * total.images / n) if n else 0.0
+        hist_max = max(total.points_hist.values()) if total.points_hist else 0
+        bars = "".join(
+            f"<tr><td align='right'>{pts} b&nbsp;</td><td><span style='color:#42a5f5;'>{'█' * max(1, round(20 * cnt / hist_max))}</span> {cnt}</td></tr>"
+            for pts, cnt in sorted(total.points_hist.items())
+        )
+        self.lbl_stats_summary.setText(
+            f"<b>Otázek celkem:</b> {n} &nbsp;|&nbsp; <span style='color:#42a5f5;'>klasické {total.classic}</span>"
+            f" &nbsp;|&nbsp; <span style='color:#ffea00;'>bonusové {total.bonus} (Σ +{total.bonus_points:.2f} b)</span><br>"
+            f"<b>S obrázkem:</b> {total.images} ({img_pct:.0f} %) &nbsp;|&nbsp; "
+            f"<b>S vtipnou odpovědí:</b> {total.with_funny} otázek, {total.funny_answers} odpovědí"
+            + (f"<br><b>Rozložení bodů (klasické):</b><table>{bars}</table>" if bars else "")
+        )
+
+        expanded = set()
+        it = QTreeWidgetItemIterator(self.tree_stats)
+        while it.value():
+            if it.value().isExpanded():
+                expanded.add(it.value().data(0, Qt.UserRole))
+            it += 1
+        first_fill = self.tree_stats.topLevelItemCount() == 0
+
+        self.tree_stats.clear()
+        color_group = QBrush(QColor("#ff5252"))
+        color_subgroup = QBrush(QColor("#ff8a80"))
+
+        def make_item(node_id: str, name: str) -> QTreeWidgetItem:
+            st = stats.get(node_id)
+            pct = (100.0 * st.images / st.total) if st.total else 0.0
+            item = QTreeWidgetItem([name, str(st.classic), str(st.bonus), f"{st.images} ({pct:.0f} %)",
+                                    str(st.funny_answers), self._format_points_hist(st.points_hist)])
+            item.setData(0, Qt.UserRole, node_id)
+            for col in range(1, 5):
+                item.setTextAlignment(col, Qt.AlignRight | Qt.AlignVCenter)
+            return item
+
+        def add_subs(parent_item: QTreeWidgetItem, subs: List[Subgroup]) -> None:
+            for sg in sorted(subs, key=lambda s: s.name.lower()):
+                sg_item = make_item(sg.id, sg.name)
+                sg_item.setForeground(0, color_subgroup)
+                parent_item.addChild(sg_item)
+                add_subs(sg_item, sg.subgroups)
+                sg_item.setExpanded(sg.id in expanded)
+
+        for g in sorted(self.root.groups, key=lambda g: g.name.lower()):
+            g_item = make_item(g.id, g.name)
+            g_item.setForeground(0, color_group)
+            f = g_item.font(0); f.setBold(True); g_item.setFont(0, f)
+            self.tree_stats.addTopLevelItem(g_item)
+            add_subs(g_item, g.subgroups)
+            g_item.setExpanded(first_fill or g.id in expanded)
+
+    def register_exports(self, records: List[Tuple[str, str]]) -> None:
+        """Zaznamená více exportů najednou (např. test každého studenta s vlastním hashem)."""
+        history_file = self.project_root / "data" / "history.json"
+        try:
+            append_export_history_batch(history_file, records)
+        except Exception as e:
+            QMessageBox.warning(self, "Chyba historie", f"Nepodařilo se uložit historii exportu:\n{e}")
+        self._refresh_history_table()
+
     def register_export(self, filename: str, k_hash: str) -> None:
         """Zaznamená nový export a obnoví tabulku."""
         history_file = self.project_root / "data" / "history.json"
-        history = []
-        if history_file.exists():
-            try:
-                with open(history_file, "r", encoding="utf-8") as f:
-                    history = json.load(f)
-            except Exception:
-                pass # Ignorujeme chyby čtení, vytvoříme nový seznam
-        
-        # Přidání záznamu
-        history.append({
-            "filename": filename, 
-            "hash": k_hash, 
-            "date": datetime.now().isoformat()
-        })
-        
-        # Uložení
         try:
-            with open(history_file, "w", encoding="utf-8") as f:
-                json.dump(history, f, indent=2, ensure_ascii=False)
+            append_export_history(history_file, filename, k_hash)
         except Exception as e:
             QMessageBox.warning(self, "Chyba historie", f"Nepodařilo se uložit historii exportu:\n{e}")
             
@@ -5738,8 +7221,8 @@ class MainWindow(QMainWindow):
     def load_data(self) -> None:
         if self.data_path.exists():
             try:
-                with self.data_path.open("r", encoding="utf-8") as f:
-                    raw = json.load(f)
+                payload = self.data_path.read_bytes()
+                raw = json.loads(payload.decode("utf-8"))
     
                 groups: List[Group] = []
                 for g in raw.get("groups", []):
@@ -5757,6 +7240,9 @@ class MainWindow(QMainWindow):
                     self.root.trash = []
                 self.root.trash = trash_raw
     
+                # NOVÉ: Fulltextový index svázaný s otiskem načteného souboru
+                self._init_search_index(hashlib.sha256(payload).hexdigest())
+    
             except Exception as e:
                 QMessageBox.warning(
                     self,
@@ -5764,19 +7250,23 @@ class MainWindow(QMainWindow):
                     f"Soubor {self.data_path} nelze načíst: {e}\nVytvořen prázdný projekt."
                 )
                 self.root = self.default_root_obj()
+                self._init_search_index(hashlib.sha256(b"").hexdigest())
         else:
             self.root = self.default_root_obj()
+            self._init_search_index(hashlib.sha256(b"").hexdigest())
 
     def save_data(self) -> None:
         self._apply_editor_to_current_question(silent=True)
+        self._invalidate_question_index()
         self.data_path.parent.mkdir(parents=True, exist_ok=True)
         data = {"groups": [self._serialize_group(g) for g in self.root.groups], "trash": getattr(self.root, "trash", [])}
         try:
             sf = QSaveFile(str(self.data_path))
             sf.open(QSaveFile.WriteOnly)
-            payload = json.dumps(data, ensure_ascii=False, indent=2)
-            sf.write(QByteArray(payload.encode("utf-8")))
-            sf.commit()
+            payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+            sf.write(QByteArray(payload))
+            if sf.commit():
+                self._update_search_index_after_save(payload)
             self.statusBar().showMessage(f"Uloženo: {self.data_path}", 1500)
         except Exception as e:
             QMessageBox.critical(self, "Uložení selhalo", f"Chyba při ukládání do {self.data_path}:\n{e}")
@@ -5821,10 +7311,16 @@ class MainWindow(QMainWindow):
                     )
                 )
 
+        # NOVÉ: uložený AST převezmeme jen pokud sedí verze i hash HTML (jinak se přestaví při uložení/exportu)
+        text_html = q.get("text_html", "<p><br></p>")
+        rich_ast = q.get("rich_ast") or {}
+        if not rich_ast_is_current(rich_ast, text_html):
+            rich_ast = {}
+
         return Question(
             id=q.get("id", ""),
             type=q.get("type", "classic"),
-            text_html=q.get("text_html", "<p><br></p>"),
+            text_html=text_html,
             title=title,
             points=int(q.get("points", 1)),
             bonus_correct=bc,
@@ -5836,6 +7332,7 @@ class MainWindow(QMainWindow):
             image_width_cm=float(q.get("image_width_cm", 0.0) or 0.0),
             image_height_cm=float(q.get("image_height_cm", 0.0) or 0.0),
             image_keep_aspect=bool(q.get("image_keep_aspect", True)),
+            rich_ast=rich_ast,
         )
 
     def _serialize_group(self, g: Group) -> dict:
@@ -6115,6 +7612,9 @@ class MainWindow(QMainWindow):
     def _refresh_tree(self) -> None:
         """Obnoví strom otázek podle self.root."""
         self.tree.clear()
+        self._invalidate_question_index()
+        # Strukturální změna -> agregace se přestaví při příštím použití
+        self._bank_stats = None
         if not self.root:
             return
     
@@ -6143,6 +7643,8 @@ class MainWindow(QMainWindow):
         # DŮLEŽITÉ: Aktualizujeme také Hall of Shame, pokud existuje
         if hasattr(self, "_refresh_funny_answers_tab"):
             self._refresh_funny_answers_tab()
+        if hasattr(self, "tab_stats") and self.left_tabs.currentWidget() == self.tab_stats:
+            self._refresh_stats_tab()
 
     def _add_subgroups_to_item(self, parent_item: QTreeWidgetItem, group_id: str, subgroups: List[Subgroup]) -> None:
         color_subgroup = QBrush(QColor("#ff8a80"))
@@ -6565,6 +8067,173 @@ class MainWindow(QMainWindow):
                 # Rekurze do hloubky
                 self._clean_subgroups_recursive(sg.subgroups, delete_sg_ids, delete_q_ids)
 
+    def _trash_questions_by_ids(self, qids) -> int:
+        """Přesune otázky se zadanými ID do koše (bez dotazu), zachová stav stromu a uloží."""
+        qids = set(qids or [])
+        if not qids:
+            return 0
+        # Rozpracovanou editaci propíšeme do modelu dřív, než editor vyčistíme
+        self._apply_editor_to_current_question(silent=True)
+        if not hasattr(self.root, "trash") or not isinstance(getattr(self.root, "trash", None), list):
+            self.root.trash = []
+    
+        now_iso = datetime.now().isoformat(timespec="seconds")
+        removed = 0
+    
+        def walk(g: Group, subgroups: List[Subgroup], parent_names: List[str]) -> None:
+            nonlocal removed
+            for sg in subgroups:
+                sg_path = " / ".join(parent_names + [sg.name or ""])
+                keep: List[Question] = []
+                for q in sg.questions:
+                    if q.id in qids:
+                        self.root.trash.append({
+                            "question": asdict(q),
+                            "deleted_at": now_iso,
+                            "source_group_id": g.id or "",
+                            "source_group_name": g.name or "",
+                            "source_subgroup_id": sg.id or "",
+                            "source_subgroup_name": sg.name or "",
+                            "source_path": sg_path
+                        })
+                        removed += 1
+                    else:
+                        keep.append(q)
+                sg.questions = keep
+                walk(g, sg.subgroups, parent_names + [sg.name or ""])
+    
+        for g in self.root.groups:
+            walk(g, g.subgroups, [])
+    
+        if not removed:
+            return 0
+    
+        expanded_before = self._capture_tree_expansion_state()
+        self._suppress_auto_expand = True
+        try:
+            self._refresh_tree()
+        finally:
+            self._suppress_auto_expand = False
+        self._apply_tree_expansion_state(expanded_before)
+    
+        self._refresh_trash_table()
+        self._clear_editor()
+        self.save_data()
+        self.statusBar().showMessage(f"Přesunuto do koše: {removed} otázek.", 4000)
+        return removed
+
+    def _merge_questions(self, keep_id: str, drop_id: str) -> None:
+        """Sloučí dvě (téměř) duplicitní otázky: doplní data z drop do keep a drop přesune do koše."""
+        self._apply_editor_to_current_question(silent=True)
+        keep = self._find_question_by_id(keep_id)
+        drop = self._find_question_by_id(drop_id)
+        if not keep or not drop or keep is drop:
+            return
+    
+        # Vtipné odpovědi – sjednocení bez duplicit (text + autor)
+        seen = {(fa.text, fa.author) for fa in keep.funny_answers}
+        for fa in drop.funny_answers:
+            if (fa.text, fa.author) not in seen:
+                keep.funny_answers.append(fa)
+                seen.add((fa.text, fa.author))
+    
+        if not (keep.correct_answer or "").strip() and (drop.correct_answer or "").strip():
+            keep.correct_answer = drop.correct_answer
+    
+        if not keep.image_path and drop.image_path:
+            keep.image_path = drop.image_path
+            keep.image_width_cm = drop.image_width_cm
+            keep.image_height_cm = drop.image_height_cm
+            keep.image_keep_aspect = drop.image_keep_aspect
+    
+        # Editor nesmí při ukládání přepsat sloučená data starým obsahem
+        self._clear_editor()
+        self._trash_questions_by_ids([drop_id])
+        self._refresh_funny_answers_tab()
+
+    def _apply_bulk_field_changes(self, changes: List[dict], label: str) -> int:
+        """
+        Provede dávku změn polí otázek [{qid, field, old, new}] jako jednu transakci:
+        jedna obnova stromu, jedno uložení a jeden záznam v zásobníku pro vrácení.
+        """
+        self._autosave_timer.stop()
+        self._apply_editor_to_current_question(silent=True)
+        applied: List[dict] = []
+        by_id = self._questions_by_id()
+        for ch in changes:
+            q = by_id.get(ch["qid"])
+            if not q or (getattr(q, ch["field"], "") or "") != ch["old"]:
+                continue  # otázka mezitím zmizela nebo se změnila
+            setattr(q, ch["field"], ch["new"])
+            if ch["field"] == "text_html":
+                ensure_rich_ast(q)
+            applied.append({"qid": ch["qid"], "field": ch["field"], "old": ch["old"], "new": ch["new"]})
+        if not applied:
+            return 0
+        if not hasattr(self, "_bulk_edit_undo"):
+            self._bulk_edit_undo = []
+        self._bulk_edit_undo.append({"label": label, "changes": applied})
+        self._after_bulk_field_changes({ch["qid"] for ch in applied})
+        self.statusBar().showMessage(f"Hromadná náhrada: změněno {len(applied)} polí.", 4000)
+        return len(applied)
+
+    def _undo_bulk_field_changes(self) -> Tuple[int, int]:
+        """Vrátí poslední dávku hromadných změn. Vrací (vráceno, přeskočeno)."""
+        stack = getattr(self, "_bulk_edit_undo", [])
+        if not stack:
+            return 0, 0
+        self._autosave_timer.stop()
+        self._apply_editor_to_current_question(silent=True)
+        batch = stack.pop()
+        restored, skipped = 0, 0
+        touched = set()
+        by_id = self._questions_by_id()
+        for ch in reversed(batch["changes"]):
+            q = by_id.get(ch["qid"])
+            if not q or (getattr(q, ch["field"], "") or "") != ch["new"]:
+                skipped += 1
+                continue
+            setattr(q, ch["field"], ch["old"])
+            if ch["field"] == "text_html":
+                ensure_rich_ast(q)
+            touched.add(ch["qid"])
+            restored += 1
+        if touched:
+            self._after_bulk_field_changes(touched)
+        self.statusBar().showMessage(f"Vrácena hromadná změna {batch['label']}.", 4000)
+        return restored, skipped
+
+    def _after_bulk_field_changes(self, qids: set) -> None:
+        """Po dávce: obnoví strom (se zachováním rozbalení), editor a uloží jednou."""
+        selected = self._selected_question_ids()
+        expanded_before = self._capture_tree_expansion_state()
+        self._suppress_auto_expand = True
+        try:
+            self._refresh_tree()
+        finally:
+            self._suppress_auto_expand = False
+        self._apply_tree_expansion_state(expanded_before)
+        self._reselect_questions(selected)
+        # Editor zobrazuje změněnou otázku -> načíst znovu, aby ji autosave nepřepsal starým textem
+        cur = self._current_question_id
+        if cur in qids:
+            q = self._find_question_by_id(cur)
+            if q:
+                self._load_question_to_editor(q)
+                self._current_question_id = cur
+        self.save_data()
+
+    def _show_find_replace(self) -> None:
+        """Otevře hromadné Najít a nahradit."""
+        dlg = FindReplaceDialog(self)
+        dlg.exec()
+
+    def _show_near_duplicates(self) -> None:
+        """Otevře report téměř duplicitních otázek."""
+        self._apply_editor_to_current_question(silent=True)
+        dlg = NearDuplicatesDialog(self)
+        dlg.exec()
+
     def _on_rename_clicked(self) -> None:
         kind, meta = self._selected_node()
         if kind not in ("group", "subgroup"):
@@ -6936,8 +8605,12 @@ class MainWindow(QMainWindow):
                 # 1. Prohledání otázek v aktuální podskupině
                 for i, q in enumerate(sg.questions):
                     if q.id == self._current_question_id:
+                        old_type = q.type
                         q.type = "classic" if self.combo_type.currentIndex() == 0 else "bonus"
+                        if q.type != old_type:
+                            self._bump_model_revision()  # pooly otázek per typ jsou neplatné
                         q.text_html = self.text_edit.toHtml()
+                        ensure_rich_ast(q)  # NOVÉ: AST se přestaví jen při změně HTML
                         q.title = (
                             self.title_edit.text().strip()
                             or self._derive_title_from_html(
@@ -7051,6 +8724,7 @@ class MainWindow(QMainWindow):
 
                         q.funny_answers = new_funny
                         sg.questions[i] = q
+                        self._bank_stats_question_changed(q, sg.id)
 
                         label = "Klasická" if q.type == "classic" else "BONUS"
                         pts = q.points if q.type == "classic" else self._bonus_points_label(q)
@@ -7228,6 +8902,18 @@ class MainWindow(QMainWindow):
             if r: return r
         return None
 
+    def _questions_by_id(self) -> Dict[str, Question]:
+        """{qid: otázka} jedním průchodem stromu – pro dávky místo opakovaného _find_question_by_id."""
+        res: Dict[str, Question] = {}
+        def walk(lst: List[Subgroup]) -> None:
+            for sg in lst:
+                for q in sg.questions:
+                    res[q.id] = q
+                walk(sg.subgroups)
+        for g in self.root.groups:
+            walk(g.subgroups)
+        return res
+
     def _select_question(self, qid: str) -> None:
         def _walk(item: QTreeWidgetItem) -> Optional[QTreeWidgetItem]:
             meta = item.data(0, Qt.UserRole)
@@ -7451,8 +9137,77 @@ class MainWindow(QMainWindow):
 
     # -------------------- Filtr --------------------
 
+    def _get_question_index(self) -> QuestionIndex:
+        """Vrátí (lazy) sloupcový index otázek; zneplatňuje se při uložení a obnově stromu."""
+        idx = getattr(self, "_question_index", None)
+        if idx is None:
+            if not hasattr(self, "_search_plain_cache"):
+                self._search_plain_cache = {}
+            search = getattr(self, "_search_index", None)
+            idx = QuestionIndex(self.root.groups if self.root else [], self._search_plain_cache, search)
+            if search is not None:
+                # Fulltextový index musí odpovídat modelu, ze kterého se ověřuje
+                search.sync(idx.doc_texts())
+            self._question_index = idx
+        return idx
+
+    def _collect_search_texts(self) -> Dict[str, str]:
+        """{qid: název + čistý text} pro fulltextový index (čistý text z cache)."""
+        if not hasattr(self, "_search_plain_cache"):
+            self._search_plain_cache = {}
+        cache = self._search_plain_cache
+        texts: Dict[str, str] = {}
+        def walk(subs: List[Subgroup]) -> None:
+            for sg in subs:
+                for q in sg.questions:
+                    texts[q.id] = f"{(q.title or '').lower()}\n{cached_search_plain(q, cache)}"
+                walk(sg.subgroups)
+        for g in self.root.groups:
+            walk(g.subgroups)
+        return texts
+
+    def _init_search_index(self, fingerprint: str) -> None:
+        """Otevře perzistentní index v data/.cache (mmap); zastaralý přestaví na pozadí."""
+        cache_dir = self.data_path.parent / ".cache"
+        if getattr(self, "_search_index", None) is None or self._search_index.cache_dir != cache_dir:
+            if getattr(self, "_search_index", None) is not None:
+                self._search_index.close()
+            self._search_index = PersistentSearchIndex(cache_dir)
+        if not self._search_index.open(fingerprint) or self._search_index.needs_rebuild():
+            self._search_index.rebuild_async(self._collect_search_texts(), fingerprint)
+        self._invalidate_question_index()
+
+    def _update_search_index_after_save(self, payload: bytes) -> None:
+        """Po uložení promítne změny do delty indexu (s novým otiskem souboru)."""
+        search = getattr(self, "_search_index", None)
+        if search is None:
+            return
+        fingerprint = hashlib.sha256(payload).hexdigest()
+        texts = self._collect_search_texts()
+        search.sync(texts, fingerprint)
+        if search.needs_rebuild():
+            search.rebuild_async(texts, fingerprint)
+
+    def _invalidate_question_index(self) -> None:
+        self._question_index = None
+        # Volá se při uložení i obnově stromu (přesuny, importy, mazání) -> nová revize modelu
+        self._bump_model_revision()
+
+    def _bump_model_revision(self) -> None:
+        self._model_revision = getattr(self, "_model_revision", 0) + 1
+
+    def _get_question_pools(self) -> QuestionPools:
+        """Pooly id otázek per uzel a typ pro export; přestaví se jen po změně revize modelu."""
+        revision = getattr(self, "_model_revision", 0)
+        pools = getattr(self, "_question_pools", None)
+        if pools is None or pools.revision != revision:
+            pools = QuestionPools(self.root.groups if self.root else [], revision)
+            self._question_pools = pools
+        return pools
+
     def _apply_filter(self, text: str) -> None:
-        pat = (text or '').strip().lower()
+        raw = (text or '').strip()
+        pat = raw.lower()
     
         # 1) Při prvním použití NEPRÁZDNÉHO filtru ulož stav rozbalení
         if pat:
@@ -7460,27 +9215,12 @@ class MainWindow(QMainWindow):
                 # uložíme pouze jednou až do vymazání filtru
                 self._pre_filter_expansion_state = self._capture_tree_expansion_state()
     
-        def question_matches(qid: str) -> bool:
-            q = None
-            for g in self.root.groups:
-                stack = list(g.subgroups)
-                while stack:
-                    sg = stack.pop()
-                    for qq in sg.questions:
-                        if qq.id == qid:
-                            q = qq
-                            break
-                    if q:
-                        break
-                    stack.extend(sg.subgroups)
-                if q:
-                    break
-            if not q:
-                return False
-            plain = re.sub(r'<[^>]+>', ' ', q.text_html)
-            plain = _html.unescape(plain).lower()
-            title = (q.title or '').lower()
-            return (pat in title) or (pat in plain)
+        # ZMĚNA: dotaz se vyhodnotí jednou nad sloupcovým indexem (type:bonus points>=2 ...)
+        terms = parse_query(raw) if pat else []
+        matched_ids = self._get_question_index().match_ids(raw) if pat else set()
+        # Skupiny/podskupiny se podle názvu shodují jen u čistě textového dotazu
+        name_words = [t.value for t in terms if not t.field and not t.negate]
+        names_only = bool(name_words) and all(not t.field and not t.negate for t in terms)
     
         def expand_parents(it: QTreeWidgetItem) -> None:
             p = it.parent()
@@ -7501,9 +9241,10 @@ class MainWindow(QMainWindow):
             if not pat:
                 self_match = True
             elif kind in ('group', 'subgroup'):
-                self_match = pat in item.text(0).lower()
+                name = item.text(0).lower()
+                self_match = names_only and all(w in name for w in name_words)
             elif kind == 'question':
-                self_match = question_matches(meta.get('id'))
+                self_match = meta.get('id') in matched_ids
                 # Při aktivním filtru: shodná otázka → rozbalit její předky
                 if self_match and pat:
                     expand_parents(item)
@@ -8109,643 +9850,62 @@ class MainWindow(QMainWindow):
 
     def _convert_docx_to_pdf(self, docx_path: Path) -> Optional[Path]:
         """
-        Konvertuje DOCX na PDF pomocí LibreOffice (hledá spustitelný soubor i v /Applications).
+        Konvertuje DOCX na PDF pomocí LibreOffice (viz export_engine.convert_docx_to_pdf).
         Vrací cestu k PDF souboru nebo None pokud selhalo.
         """
-        import shutil
-        
-        # 1. Hledání spustitelného souboru LibreOffice
-        lo_candidates = [
-            "libreoffice",                                            # Standard Linux/PATH
-            "soffice",                                                # Generic bin
-            "/Applications/LibreOffice.app/Contents/MacOS/soffice",   # macOS standard path
-            "/usr/bin/libreoffice",
-            "/usr/local/bin/libreoffice",
-            r"C:\Program Files\LibreOffice\program\soffice.exe",      # Windows x64
-            r"C:\Program Files (x86)\LibreOffice\program\soffice.exe" # Windows x86
-        ]
-        
-        lo_executable = None
-        for cand in lo_candidates:
-            # shutil.which hledá v PATH, Path(cand).exists() hledá konkrétní soubor
-            if shutil.which(cand) or Path(cand).exists():
-                lo_executable = cand
-                break
-        
-        if not lo_executable:
-             QMessageBox.warning(
-                self, 
-                "LibreOffice nenalezen",
-                "Nemohu najít nainstalovaný LibreOffice.\n"
-                "Pokud jej máte nainstalovaný, ujistěte se, že je ve standardní složce "
-                "(/Applications/LibreOffice.app na macOS)."
-            )
-             return None
-
-        # 2. Samotná konverze
         try:
-            pdf_path = docx_path.with_suffix('.pdf')
-            
-            cmd = [
-                lo_executable,
-                '--headless',
-                '--convert-to', 'pdf',
-                '--outdir', str(pdf_path.parent),
-                str(docx_path)
-            ]
-            
-            # Spuštění procesu
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode != 0:
-                print(f"LibreOffice chyba (Code {result.returncode}):\nSTDERR: {result.stderr}\nSTDOUT: {result.stdout}")
-            
-            # Ověření, že PDF byl vytvořen
-            if pdf_path.exists():
-                return pdf_path
-            else:
-                # Někdy se stane, že returncode je 0, ale soubor nikde (např. sandbox issues)
-                return None
-                
-        except subprocess.TimeoutExpired:
-            QMessageBox.warning(self, "Chyba konverze", "Konverze trvala příliš dlouho (timeout).")
-            return None
-        except Exception as e:
-            QMessageBox.warning(self, "Chyba konverze", f"Neočekávaná chyba při konverzi PDF:\n{e}")
+            return convert_docx_to_pdf(docx_path)
+        except ExportError as e:
+            QMessageBox.warning(self, "Chyba konverze", str(e))
             return None
 
     def _merge_pdfs(self, pdf_paths: List[Path], output_path: Path, cleanup: bool = True) -> bool:
         """
-        Spojí více PDF souborů do jednoho.
-        Zkouší: PyPDF2 -> macOS join.py -> Ghostscript.
+        Spojí více PDF souborů do jednoho (PyPDF2 -> macOS join.py -> Ghostscript).
         Pokud vše selže, vyhodí chybovou hlášku s instrukcemi.
         """
-        success = False
-        missing_tools = []
-        
-        # 1. Zkusíme PyPDF2 (Preferované)
-        try:
-            from PyPDF2 import PdfMerger
-            merger = PdfMerger()
-            for pdf_path in pdf_paths:
-                if pdf_path.exists():
-                    merger.append(str(pdf_path))
-            merger.write(str(output_path))
-            merger.close()
-            success = True
-        except ImportError:
-            missing_tools.append("PyPDF2 (pip install PyPDF2)")
-            # Pokračujeme na fallback
-        except Exception as e:
-            print(f"Chyba PyPDF2: {e}")
-            # Pokračujeme na fallback
-
-        if not success:
-            # 2. Fallback: macOS Native Script nebo Ghostscript
-            success = self._merge_pdfs_subprocess(pdf_paths, output_path)
-            if not success:
-                missing_tools.append("Ghostscript (brew install ghostscript)")
-
-        # Pokud selhalo úplně
-        if not success:
-            msg = (
-                "Nepodařilo se sloučit PDF soubory.\n"
-                "Chybí potřebné nástroje.\n\n"
-                "Řešení (vyberte jedno):\n"
-                "1. Nainstalujte python knihovnu:  pip install PyPDF2\n"
-                "2. Nainstalujte Ghostscript:      brew install ghostscript\n\n"
-                "Jednotlivé PDF soubory byly ponechány ve složce."
-            )
-            QMessageBox.warning(self, "Chyba slučování PDF", msg)
-            # Vracíme False a NEPROVÁDÍME cleanup, aby uživateli zůstaly aspoň jednotlivé soubory
-            return False
-
-        # Vyčištění (pouze při úspěchu)
-        if success and cleanup:
-            for pdf_path in pdf_paths:
-                try:
-                    pdf_path.unlink()
-                except Exception as e:
-                    print(f"Nemohu smazat dočasný PDF {pdf_path}: {e}")
-        
-        return True
+        if merge_pdfs(pdf_paths, output_path, cleanup=cleanup):
+            return True
+        QMessageBox.warning(self, "Chyba slučování PDF", PDF_MERGE_HELP)
+        return False
 
+    def _export_image_cache(self, print_dpi: int = DEFAULT_PRINT_DPI) -> ImageCache:
+        """Cache obrázků převedených/zmenšených pro tisk (vedle cache vyhledávacího indexu)."""
+        return ImageCache(self.data_path.parent / ".cache" / "images", print_dpi)
 
-    def _merge_pdfs_subprocess(self, pdf_paths: List[Path], output_path: Path) -> bool:
-        """Fallback: slučování PDF pomocí externích nástrojů (macOS join.py nebo GS)."""
-        import sys
-        
-        # A. macOS Built-in Script (Automator)
-        # Tento skript je standardně přítomen na macOS
-        macos_join_script = "/System/Library/Automator/Combine PDF Pages.action/Contents/Resources/join.py"
-        if sys.platform == "darwin" and Path(macos_join_script).exists():
-            try:
-                cmd = [
-                    "python3",  # Použijeme systémový python nebo ten co běží
-                    macos_join_script,
-                    "-o", str(output_path)
-                ]
-                cmd.extend([str(p) for p in pdf_paths if p.exists()])
-                
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-                if result.returncode == 0:
-                    return True
-                else:
-                    print(f"macOS join.py failed: {result.stderr}")
-            except Exception as e:
-                print(f"macOS join.py exception: {e}")
+    def _export_render_cache(self) -> RenderCache:
+        """Cache vyrenderovaných verzí (DOCX/PDF) – opakovaný export nezměněných verzí je jen kopie."""
+        return RenderCache(self.data_path.parent / ".cache" / "render")
 
-        # B. Ghostscript
+    def _compile_export_template(self, template_path: Path,
+                                 image_cache: Optional[ImageCache] = None) -> Optional[CompiledTemplate]:
+        """Načte a zanalyzuje DOCX šablonu jednou pro celý export (None = chyba, už oznámená)."""
         try:
-            cmd = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite', f'-sOutputFile={output_path}']
-            cmd.extend([str(p) for p in pdf_paths if p.exists()])
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            return result.returncode == 0
-            
-        except FileNotFoundError:
-            # GS není nainstalován
-            print("Ghostscript (gs) nebyl nalezen.")
-            return False
+            return CompiledTemplate(template_path, image_cache=image_cache)
         except Exception as e:
-            print(f"Ghostscript error: {e}")
-            return False
+            QMessageBox.critical(self, "Export chyba", f"Nelze otevřít šablonu pomocí python-docx:\n{e}")
+            print(f"[ERROR] Nelze otevřít DOCX: {e}")
+            return None
 
     def _generate_docx_from_template(self, template_path: Path, output_path: Path,
-                                     simple_repl: Dict[str, str], rich_repl_html: Dict[str, object]) -> None:
+                                     simple_repl: Dict[str, str], rich_repl_html: Dict[str, object],
+                                     compiled: Optional[CompiledTemplate] = None) -> None:
         """
         Generuje DOCX. rich_repl_html může být:
          - Dict[str, str] -> {placeholder: html_content}
          - Dict[str, tuple] -> {placeholder: (html_content, image_path[, image_width_cm, image_height_cm])}
+        ZMĚNA: vlastní vyplnění dělá export_engine.CompiledTemplate. Při exportu více verzí
+        předává průvodce jednu zkompilovanou šablonu, takže se neotevírá pro každou verzi znovu.
         """
-        import docx
-        from docx.shared import Pt, Cm, RGBColor
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
-        from docx.oxml import OxmlElement
-        import os
-        
-        for ph, val in rich_repl_html.items():
-            if isinstance(val, tuple):
-                html_part, img_path = val[0], val[1]
-                if img_path:
-                    img_check = Path(img_path).exists() if isinstance(img_path, str) else False
-
-        # Parsing HTML
-        def parse_html_to_paragraphs(html):
-            # Zde voláme vaši existující třídu HTMLToDocxParser
-            parser = HTMLToDocxParser() 
-            parser.feed(html)
-            return parser.paragraphs
-
-        try:
-            doc = docx.Document(template_path)
-        except Exception as e:
-            QMessageBox.critical(self, "Export chyba", f"Nelze otevřít šablonu pomocí python-docx:\n{e}")
-            print(f"[ERROR] Nelze otevřít DOCX: {e}")
-            return
-
-        # -- HELPER: Extrakce a obnova Page Breaks --
-        def extract_page_breaks(paragraph):
-            breaks = []
-            p_elem = paragraph._p
-            for run_elem in p_elem.findall('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}r'):
-                for br_elem in run_elem.findall('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}br'):
-                    if br_elem.get('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}type') == 'page':
-                        breaks.append(br_elem)
-            return breaks
-        
-        def restore_page_breaks(paragraph, breaks):
-            if not breaks:
-                return
-            p_elem = paragraph._p
-            new_run = OxmlElement('w:r')
-            for br in breaks:
-                br_copy = br.__copy__()
-                new_run.append(br_copy)
-            p_elem.append(new_run)
-
-        # -- Helper: Vložení Rich Text bloku + Obrázku --
-        def insert_rich_question_block(paragraph, html_content, image_path=None, image_w_cm: float = 0.0, image_h_cm: float = 0.0):
-            
-            # 1. Parse HTML
-            paras_data = parse_html_to_paragraphs(html_content)
-        
-            # --- ZACHYTIT STYL PLACEHOLDERU JEŠTĚ PŘED CLEAR() ---
-            from copy import deepcopy
-            from docx.shared import Pt
-            from docx.oxml.ns import qn
-        
-            template_rPr = None
-            base_font_size = None
-            try:
-                src_run = paragraph.runs[0] if paragraph.runs else None
-                if src_run is not None:
-                    # 1) pokus přes API
-                    base_font_size = src_run.font.size
-                    # 2) doplněk: čti w:sz (half-points) přímo z rPr
-                    rPr = getattr(src_run._element, "rPr", None) if getattr(src_run, "_element", None) is not None else None
-                    if rPr is not None:
-                        template_rPr = deepcopy(rPr)
-                        if base_font_size is None:
-                            sz = rPr.find(qn("w:sz"))
-                            if sz is not None and getattr(sz, "val", None):
-                                base_font_size = Pt(int(sz.val) / 2.0)
-                # 3) fallback: velikost ze stylu odstavce
-                if base_font_size is None and paragraph.style and getattr(paragraph.style.font, "size", None):
-                    base_font_size = paragraph.style.font.size
-            except Exception:
-                pass
-        
-            def _apply_placeholder_style(run) -> None:
-                """Nejprve klon rPr placeholderu (rodina + další), pak VŽDY nastav velikost písma."""
-                if template_rPr is not None:
-                    try:
-                        run._element.rPr = deepcopy(template_rPr)
-                    except Exception:
-                        pass
-                if base_font_size:
-                    run.font.size = base_font_size
-                # run.font.name NENASTAVUJEME – řídí se rPr/styl šablony
-        
-            # Pokud je obsah prázdný a není ani obrázek -> vyčistit a konec
-            if not paras_data and not image_path: 
-                breaks = extract_page_breaks(paragraph)
-                paragraph.clear()
-                restore_page_breaks(paragraph, breaks)
-                return
-            
-            p_insert = paragraph._p
-            first_p_used = False
-        
-            # --- VLOŽENÍ TEXTU ---
-            if paras_data:
-                for i, p_data in enumerate(paras_data):
-                    if i == 0:
-                        new_p = paragraph
-                        breaks = extract_page_breaks(new_p)
-                        new_p.clear()
-                        first_p_used = True
-                    else:
-                        new_p = doc.add_paragraph()
-                        # minimal-change: přenést styl odstavce (zabraňuje pádu na default 12 pt)
-                        try:
-                            new_p.style = paragraph.style
-                        except Exception:
-                            pass
-                        p_insert.addnext(new_p._p)
-                        p_insert = new_p._p
-        
-                    # Zarovnání
-                    align = p_data.get('align', 'left')
-                    if align == 'center': new_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    elif align == 'right': new_p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    elif align == 'justify': new_p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                    else: new_p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                    
-                    # Mezerování
-                    new_p.paragraph_format.space_before = Pt(0)
-                    new_p.paragraph_format.space_after = Pt(0)
-        
-                    # Prefix (odrážky)
-                    if p_data.get('prefix'):
-                        new_p.paragraph_format.left_indent = Pt(48)
-                        new_p.paragraph_format.first_line_indent = Pt(-24)
-                        r_pref = new_p.add_run(p_data['prefix'])
-                        _apply_placeholder_style(r_pref)
-                    
-                    # Obsah (Runs)
-                    for r_data in p_data['runs']:
-                        text_content = r_data['text']
-                        parts = text_content.split('\n')
-                        for idx, part in enumerate(parts):
-                            if part:
-                                run = new_p.add_run(part)
-                                _apply_placeholder_style(run)  # <<< KLÍČOVÉ
-                                if r_data.get('b'): run.bold = True
-                                if r_data.get('i'): run.italic = True
-                                if r_data.get('u'): run.underline = True
-                                if r_data.get('color'):
-                                    try:
-                                        rgb = r_data['color']
-                                        run.font.color.rgb = RGBColor(int(rgb[:2], 16), int(rgb[2:4], 16), int(rgb[4:], 16))
-                                    except: pass
-                        
-                            if idx < len(parts) - 1:
-                                br = new_p.add_run()
-                                _apply_placeholder_style(br)  # <<< KLÍČOVÉ pro run s breakem
-                                br.add_break()
-            
-            # --- VLOŽENÍ OBRÁZKU ---
-            if image_path:
-                import shutil
-                import subprocess
-                import tempfile
-                
-                img_path_obj = Path(image_path) if isinstance(image_path, str) else image_path
-                final_img_path = img_path_obj
-        
-                if not img_path_obj.exists():
-                    print(f"[ERROR]   Obrázek NEEXISTUJE! {img_path_obj}")
-                    return
-        
-                # --- KONVERZE HEIC -> JPG (pro macOS) ---
-                is_heic = img_path_obj.suffix.lower() in ('.heic', '.heif')
-                temp_jpg = None
-                
-                if is_heic:
-                    try:
-                        # Vytvoříme dočasný soubor
-                        fd, temp_jpg = tempfile.mkstemp(suffix=".jpg")
-                        os.close(fd)
-                        
-                        # Použijeme systémový nástroj sips (macOS) nebo ImageMagick
-                        # Zkusíme sips (je na každém macu)
-                        cmd = ["sips", "-s", "format", "jpeg", str(img_path_obj), "--out", temp_jpg]
-                        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        
-                        final_img_path = Path(temp_jpg)
-                    except Exception as e:
-                        print(f"[ERROR]   Chyba konverze HEIC: {e}")
-                        # Fallback - zkusíme vložit originál, i když to asi selže
-                        final_img_path = img_path_obj
-        
-                # Vytvoříme nový odstavec pro obrázek
-                img_p = doc.add_paragraph()
-                if not paras_data:
-                    paragraph.clear()
-                    img_p = paragraph
-                else:
-                    # minimal-change: zachovat styl odstavce
-                    try:
-                        img_p.style = paragraph.style
-                    except Exception:
-                        pass
-                    p_insert.addnext(img_p._p)
-                    p_insert = img_p._p
-        
-                img_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                img_p.paragraph_format.space_before = Pt(6)
-                img_p.paragraph_format.space_after = Pt(6)
-                
-                try:
-                    run = img_p.add_run()
-                    _apply_placeholder_style(run)  # aby vložené popisky/mezery držely velikost
-                    # Pokud je 0, zachováme původní default (14 cm). Pokud je výška 0, necháme Word dopočítat poměr.
-                    w_use = float(image_w_cm or 0.0)
-                    h_use = float(image_h_cm or 0.0)
-                    if w_use <= 0.0 and h_use <= 0.0:
-                        w_use = 14.0
-        
-                    if w_use > 0.0 and h_use > 0.0:
-                        run.add_picture(str(final_img_path), width=Cm(w_use), height=Cm(h_use))
-                    elif w_use > 0.0:
-                        run.add_picture(str(final_img_path), width=Cm(w_use))
-                    else:
-                        run.add_picture(str(final_img_path), height=Cm(h_use)) 
-                except Exception as e:
-                    print(f"[ERROR] Chyba při vkládání obrázku: {e}")
-                finally:
-                    # Úklid dočasného souboru
-                    if temp_jpg and os.path.exists(temp_jpg):
-                        try:
-                            os.remove(temp_jpg)
-                        except: pass
-        
-            # --- OBNOVA PAGE BREAKS ---
-            if 'breaks' in locals() and breaks:
-                break_p = doc.add_paragraph()
-                # minimal-change: zachovat styl i na break odstavci
-                try:
-                    break_p.style = paragraph.style
-                except Exception:
-                    pass
-                p_insert.addnext(break_p._p)
-                restore_page_breaks(break_p, breaks)
-
-        # -- Helper: Zpracování jednoho odstavce (Inline i Block) --
-        def process_paragraph(p):
-            from copy import deepcopy
-            from docx.shared import Pt
-            from docx.oxml.ns import qn
-
-            def _extract_size_from_rPr(source_run):
-                """Vrátí Pt velikost z rPr/sz (half-points) nebo None."""
-                try:
-                    rPr = getattr(source_run._element, "rPr", None)
-                    if rPr is None:
-                        return None
-                    sz = rPr.find(qn("w:sz"))
-                    if sz is not None and getattr(sz, "val", None):
-                        hp = int(sz.val)  # w:sz je v half-points
-                        return Pt(hp / 2.0)
-                except Exception:
-                    pass
-                return None
-
-            full_text = p.text
-            if not ("<" in full_text or "{" in full_text):
-                return
-
-            # 1) BLOCK CHECK
-            txt_clean = full_text.strip()
-            matched_rich = None
-            for ph, val in rich_repl_html.items():
-                if isinstance(val, tuple):
-                    html_content, img_path = val[0], val[1]
-                else:
-                    html_content, img_path = val, None
-                if txt_clean == f"<{ph}>" or txt_clean == f"{{{ph}}}":
-                    matched_rich = (
-                        html_content,
-                        img_path,
-                        float((val[2] if len(val) > 2 else 0.0) or 0.0),
-                        float((val[3] if len(val) > 3 else 0.0) or 0.0),
-                    )
-                    break
-
-            if matched_rich:
-                insert_rich_question_block(p, matched_rich[0], matched_rich[1], matched_rich[2], matched_rich[3])
-                return
-
-            # 2) INLINE CHECK (zkráceno, bez obrázků)
-            keys_found: list[str] = []
-            for k in simple_repl.keys():
-                if f"<{k}>" in full_text or f"{{{k}}}" in full_text:
-                    keys_found.append(k)
-            for k in rich_repl_html.keys():
-                if f"<{k}>" in full_text or f"{{{k}}}" in full_text:
-                    keys_found.append(k)
-
-            if not keys_found:
+        if compiled is None:
+            compiled = self._compile_export_template(template_path)
+            if compiled is None:
                 return
 
-            # NOVĚ: rozlišíme, zda jde o placeholder Otazka\d+
-            is_question_placeholder = any(re.match(r"^Otazka\d+$", k) for k in keys_found)
-
-            # Segmentace
-            segments: list = [full_text]
-            all_repl_data: dict = {}
-            for k, v in simple_repl.items():
-                all_repl_data[k] = {"type": "simple", "val": v}
-            for k, val in rich_repl_html.items():
-                html = val[0] if isinstance(val, tuple) else val
-                all_repl_data[k] = {"type": "rich", "val": html}
-
-            for k in keys_found:
-                info = all_repl_data[k]
-                tokens = [f"<{k}>", f"{{{k}}}"]
-                for token in tokens:
-                    new_segments = []
-                    for seg in segments:
-                        if isinstance(seg, str):
-                            parts = seg.split(token)
-                            for i, part in enumerate(parts):
-                                if part:
-                                    new_segments.append(part)
-                                if i < len(parts) - 1:
-                                    new_segments.append(info)
-                        else:
-                            new_segments.append(seg)
-                    segments = new_segments
-
-            # --- ZACHYTIT STYL PLACEHOLDERU ---
-            base_bold = None
-            template_rPr = None
-            base_font_size = None
-
-            # 2a) najdeme run, který skutečně obsahuje některý token
-            tokens_all = []
-            for k in keys_found:
-                tokens_all.extend((f"<{k}>", f"{{{k}}}"))
-
-            source_run = None
-            for run in p.runs:
-                t = run.text or ""
-                if any(tok in t for tok in tokens_all):
-                    source_run = run
-                    break
-            if source_run is None:
-                # fallback: první neprázdný run
-                for run in p.runs:
-                    if (run.text or "").strip():
-                        source_run = run
-                        break
-
-            if source_run is not None:
-                base_bold = source_run.bold
-                base_font_size = source_run.font.size
-                if base_font_size is None:
-                    xml_size = _extract_size_from_rPr(source_run)
-                    if xml_size is not None:
-                        base_font_size = xml_size
-                try:
-                    rPr = getattr(source_run._element, "rPr", None)
-                    if rPr is not None:
-                        template_rPr = deepcopy(rPr)
-                except Exception:
-                    template_rPr = None
-
-            # 2b) fallback: velikost ze stylu odstavce (typické pro bullets)
-            try:
-                if (base_font_size is None) and p.style and getattr(p.style.font, "size", None):
-                    base_font_size = p.style.font.size
-            except Exception:
-                pass
-
-            # 2c) NOVĚ: poslední fallback – jen pro Otazka\d+ defaultně 9 pt
-            if base_font_size is None and is_question_placeholder:
-                base_font_size = Pt(9)
-
-            # Vyčistit obsah, ale zachovat vlastnosti odstavce
-            page_breaks = extract_page_breaks(p)
-            p.clear()
-
-            def _apply_placeholder_style(run):
-                """1) pokus o rPr z placeholderu, 2) VŽDY nastavit velikost, pokud ji známe."""
-                if template_rPr is not None:
-                    try:
-                        run._element.rPr = deepcopy(template_rPr)
-                    except Exception:
-                        pass
-                if base_font_size:
-                    run.font.size = base_font_size
-                # font-family úmyslně nenastavujeme – jde z rPr/stylu šablony
-
-            # Sestavení výsledku
-            for seg in segments:
-                if isinstance(seg, str):
-                    run = p.add_run(seg)
-                    _apply_placeholder_style(run)
-                elif isinstance(seg, dict):
-                    val = seg["val"]
-                    if seg["type"] == "simple":
-                        run = p.add_run(str(val))
-                        _apply_placeholder_style(run)
-                        if base_bold is not None:
-                            run.bold = base_bold
-                    elif seg["type"] == "rich":
-                        paras = parse_html_to_paragraphs(val)
-                        for p_idx, p_data in enumerate(paras):
-                            if p_idx > 0:
-                                p.add_run().add_break()
-                            for r_data in p_data["runs"]:
-                                text_content = r_data["text"]
-                                parts = text_content.split("\n")
-                                for idx_part, part in enumerate(parts):
-                                    if part:
-                                        run = p.add_run(part)
-                                        _apply_placeholder_style(run)  # nejprve velikost/styl
-                                        # pak jen b/i/u/color
-                                        if r_data.get("b"):
-                                            run.bold = True
-                                        if r_data.get("i"):
-                                            run.italic = True
-                                        if r_data.get("u"):
-                                            run.underline = True
-                                        if r_data.get("color"):
-                                            try:
-                                                rgb = r_data["color"]
-                                                run.font.color.rgb = RGBColor(
-                                                    int(rgb[:2], 16), int(rgb[2:4], 16), int(rgb[4:], 16)
-                                                )
-                                            except Exception:
-                                                pass
-                                    if idx_part < len(parts) - 1:
-                                        p.add_run().add_break()
-
-            restore_page_breaks(p, page_breaks)
-
-        # --- HLAVNÍ SMYČKA ---
-        
-        # 1. Body
-        for i, p in enumerate(doc.paragraphs):
-            
-            process_paragraph(p)
-            
-        # 2. Tables in Body
-        for table_idx, table in enumerate(doc.tables):
-            for row_idx, row in enumerate(table.rows):
-                for cell_idx, cell in enumerate(row.cells):
-                    for p in cell.paragraphs:
-                        process_paragraph(p)
-        
-        # 3. Headers / Footers
-        for section in doc.sections:
-            for h in [section.header, section.first_page_header]:
-                if h:
-                    for p in h.paragraphs: process_paragraph(p)
-            for f in [section.footer, section.first_page_footer]:
-                if f:
-                    for p in f.paragraphs: process_paragraph(p)
+        data = compiled.render_bytes(simple_repl, rich_repl_html)
 
         try:
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            doc.save(str(output_path))
+            compiled.save_bytes(data, output_path)
         except Exception as e:
             print(f"[ERROR] Chyba uložení: {e}")
             import traceback
@@ -9223,4 +10383,5 @@ def main() -> int:
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # pracovní procesy exportu v zabalené aplikaci
     sys.exit(main())
@@ -0,0 +1,38 @@
+"""Regresní testy jádra exportu (bez GUI): python -m pytest -q"""
+import io
+import re
+import sys
+import zipfile
+from pathlib import Path
+
+import docx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from export_engine import CompiledTemplate  # noqa: E402
+
+
+def _rendered_order(template_path, simple_repl, rich_repl_html, markers):
+    data = CompiledTemplate(str(template_path)).render_bytes(simple_repl, rich_repl_html)
+    xml = zipfile.ZipFile(io.BytesIO(data)).read("word/document.xml").decode("utf-8")
+    return re.findall("|".join(markers), xml)
+
+
+def test_placeholder_in_table_before_body(tmp_path):
+    """Tabulka s placeholderem nad placeholdery těla nesmí posunout obsah slotů."""
+    doc = docx.Document()
+    doc.add_table(rows=1, cols=1).cell(0, 0).text = "{DatumČas}"
+    doc.add_paragraph("<PoznamkaVerze>")
+    doc.add_paragraph("<Otázka1>")
+    doc.add_paragraph("<BONUS1>")
+    doc.add_paragraph("Jméno: <Student>")
+    template = tmp_path / "sablona.docx"
+    doc.save(str(template))
+
+    order = _rendered_order(
+        template,
+        {"DatumČas": "DATUM", "PoznamkaVerze": "VERZE", "Student": "STUDENT"},
+        {"Otázka1": "<p>OTAZKA</p>", "BONUS1": "<p>BONUS</p>"},
+        ["DATUM", "VERZE", "OTAZKA", "BONUS", "STUDENT"],
+    )
+    assert order == ["DATUM", "VERZE", "OTAZKA", "BONUS", "STUDENT"]